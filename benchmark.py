@@ -0,0 +1,622 @@
+"""
+Offline load test for the bot. Runs the real handlers and jobs from main.py against a fake Telegram
+Bot API (a telegram.request.BaseRequest answering locally) and a fake genai.Client, both with
+configurable latency and failure rates, so no token or network access is needed.
+
+N simulated users each send /start, pick a level and then send notes for a few rounds; afterwards
+the daily quiz job runs once for all of them. Reported: end-to-end latency percentiles per step,
+throughput, event loop stalls and the per-stage metrics from metrics.py.
+
+    python benchmark.py --users 50 --rounds 3 --save-baseline   # record a baseline
+    python benchmark.py --users 50 --rounds 3 --compare         # fail (exit 1) on regressions
+
+Bot settings are read from the environment as usual (e.g. NOTE_COALESCE_SECONDS, AI_MAX_CONCURRENCY).
+The run uses a fresh temporary database unless --database is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "QuizPal", "username": "quizpal_benchmark_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+PHRASES = [
+    "break the ice", "call it a day", "on the fence", "worn out", "chill out", "look forward to",
+    "get over", "run out of", "make up your mind", "under the weather", "hit the books", "piece of cake",
+    "once in a blue moon", "cut corners", "give up", "take after", "bring up", "figure out", "keep an eye on",
+    "spill the beans", "the last straw", "back to square one", "by the way", "come across", "put off",
+    "in the long run", "let someone down", "hang out", "make ends meet", "on the same page",
+]
+
+LEVELS = ("A1", "A2", "B1", "B2", "C1", "C2")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    """End-to-end latencies per scenario step, plus how many times a step timed out."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.timeouts: Dict[str, int] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.samples.setdefault(name, []).append(seconds)
+
+    def timeout(self, name: str) -> None:
+        self.timeouts[name] = self.timeouts.get(name, 0) + 1
+
+    def report(self, wall_seconds: float) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for name in sorted(set(self.samples) | set(self.timeouts)):
+            values = sorted(self.samples.get(name, []))
+            report[name] = {
+                "count": len(values),
+                "timeouts": self.timeouts.get(name, 0),
+                "per_second": len(values) / wall_seconds if wall_seconds else 0.0,
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": (values[-1] if values else 0.0) * 1000,
+            }
+        return report
+
+
+class LoopStallMonitor:
+    """Measures how late a periodic sleep wakes up; the lateness is time the event loop was blocked."""
+
+    def __init__(self, interval: float = 0.01, threshold: float = 0.005):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def report(self) -> Dict[str, float]:
+        lags = sorted(self.lags)
+        stalls = [lag for lag in lags if lag > self.threshold]
+        return {
+            "samples": len(lags),
+            "p99_lag_ms": percentile(lags, 0.99) * 1000,
+            "max_lag_ms": (lags[-1] if lags else 0.0) * 1000,
+            "stalls": len(stalls),
+            "stalled_ms": sum(stalls) * 1000,
+        }
+
+
+# --- Fake Telegram Bot API ---
+
+class FakeTelegramBackend:
+    """
+    State shared by the FakeTelegramRequest objects of one bot: answers Bot API methods after a
+    random latency, fails a share of them (429 flood control, 502 server errors) and lets the
+    simulated users wait for what the bot sends to their chat.
+    """
+
+    def __init__(self, rng: random.Random, latency: float, jitter: float, flood_rate: float, error_rate: float):
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.error_rate = error_rate
+        self.calls: Dict[str, int] = {}
+        self.failures: Dict[str, int] = {}
+        self._message_id = 0
+        self._waiters: Dict[int, List[Tuple[Callable[[str, Dict[str, Any]], bool], asyncio.Future]]] = {}
+
+    def expect(self, chat_id: int, predicate: Callable[[str, Dict[str, Any]], bool]) -> asyncio.Future:
+        """Future resolved with the time of the next call to chat_id matching predicate(method, params)."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append((predicate, future))
+        return future
+
+    async def handle(self, method: str, params: Dict[str, Any]) -> Tuple[int, bytes]:
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+        roll = self.rng.random()
+        if roll < self.flood_rate:
+            return self._fail(method, 429, "Too Many Requests: retry after 1", {"retry_after": 1})
+        if roll < self.flood_rate + self.error_rate:
+            return self._fail(method, 502, "Bad Gateway")
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+        result = self._result(method, params)
+        self._notify(method, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _fail(self, method: str, status: int, description: str, parameters: Optional[Dict[str, Any]] = None) -> Tuple[int, bytes]:
+        self.failures[method] = self.failures.get(method, 0) + 1
+        body = {"ok": False, "error_code": status, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return status, json.dumps(body).encode()
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getMe":
+            return BOT_USER
+        if method not in ("sendMessage", "sendPoll", "editMessageText", "editMessageReplyMarkup"):
+            return True
+        self._message_id += 1
+        chat_id = params.get("chat_id")
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip('-').isdigit() else -1001, "type": "private"},
+            "from": BOT_USER,
+        }
+        if method == "sendPoll":
+            options = params.get("options") or []
+            message["poll"] = {
+                "id": str(self._message_id),
+                "question": params.get("question", ""),
+                "options": [{"text": option if isinstance(option, str) else option.get("text", ""), "voter_count": 0} for option in options],
+                "total_voter_count": 0,
+                "is_closed": False,
+                "is_anonymous": bool(params.get("is_anonymous")),
+                "type": "quiz",
+                "allows_multiple_answers": False,
+                "correct_option_id": params.get("correct_option_id"),
+            }
+        else:
+            message["text"] = params.get("text", "")
+        return message
+
+    def _notify(self, method: str, params: Dict[str, Any]) -> None:
+        try:
+            chat_id = int(params.get("chat_id"))
+        except (TypeError, ValueError):
+            return
+        now = time.perf_counter()
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+        remaining = []
+        for predicate, future in waiters:
+            if future.done():
+                continue
+            if predicate(method, params):
+                future.set_result(now)
+            else:
+                remaining.append((predicate, future))
+        self._waiters[chat_id] = remaining
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Bot API transport that never leaves the process (see FakeTelegramBackend)."""
+
+    def __init__(self, backend: FakeTelegramBackend):
+        self.backend = backend
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return 5.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None, *args, **kwargs) -> Tuple[int, bytes]:
+        params = request_data.parameters if request_data else {}
+        return await self.backend.handle(url.rsplit('/', 1)[-1], params)
+
+
+# --- Fake Gemini client ---
+
+class FakeGenaiClient:
+    """
+    Stand-in for genai.Client: answers generate_content / generate_content_stream (sync and aio)
+    with well-formed quiz JSON for the phrases in the prompt, after a random latency, and fails a
+    share of the calls.
+    """
+
+    def __init__(self, rng: random.Random, latency: float, jitter: float, failure_rate: float, chunk_size: int = 60):
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self.failures = 0
+        self.models = SimpleNamespace(generate_content=self._generate_sync)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._generate, generate_content_stream=self._generate_stream))
+
+    def _call_latency(self) -> float:
+        self.calls += 1
+        return max(0.0, self.rng.gauss(self.latency, self.jitter))
+
+    def _check_failure(self) -> None:
+        if self.rng.random() < self.failure_rate:
+            self.failures += 1
+            raise RuntimeError("Fake AI backend failure")
+
+    def _generate_sync(self, model: str, contents: str, config: Dict[str, Any]) -> SimpleNamespace:
+        time.sleep(self._call_latency())
+        self._check_failure()
+        return self._response(self._reply_text(contents), contents, config)
+
+    async def _generate(self, model: str, contents: str, config: Dict[str, Any]) -> SimpleNamespace:
+        await asyncio.sleep(self._call_latency())
+        self._check_failure()
+        return self._response(self._reply_text(contents), contents, config)
+
+    async def _generate_stream(self, model: str, contents: str, config: Dict[str, Any]):
+        latency = self._call_latency()
+        text = self._reply_text(contents)
+        chunks = [text[start:start + self.chunk_size] for start in range(0, len(text), self.chunk_size)]
+
+        async def stream():
+            await asyncio.sleep(latency * 0.3) # Time to first token
+            self._check_failure()
+            for number, chunk in enumerate(chunks, start=1):
+                await asyncio.sleep(latency * 0.7 / len(chunks))
+                last = number == len(chunks)
+                yield SimpleNamespace(text=chunk, prompt_feedback=None,
+                                      usage_metadata=self._usage(text, contents, config) if last else None)
+        return stream()
+
+    def _response(self, text: str, contents: str, config: Dict[str, Any]) -> SimpleNamespace:
+        return SimpleNamespace(text=text, prompt_feedback=None, usage_metadata=self._usage(text, contents, config))
+
+    @staticmethod
+    def _usage(text: str, contents: str, config: Dict[str, Any]) -> SimpleNamespace:
+        prompt_tokens = (len(config.get("system_instruction", "")) + len(contents)) // 4
+        output_tokens = len(text) // 4
+        return SimpleNamespace(prompt_token_count=prompt_tokens, cached_content_token_count=0,
+                               candidates_token_count=output_tokens, total_token_count=prompt_tokens + output_tokens)
+
+    def _reply_text(self, contents: str) -> str:
+        user_input = contents.split("User Input:\n", 1)[-1]
+        puzzle_request = re.search(r"Choose (\d+) different", user_input)
+        if puzzle_request:
+            phrases = self.rng.sample(PHRASES, min(len(PHRASES), int(puzzle_request.group(1))))
+            return json.dumps({"quiz": [self._item(phrase) for phrase in phrases], "notes": {}})
+        sections = re.split(r"### Section \d+\n", user_input)[1:]
+        if sections:
+            results = [{"section": number, "quiz": [self._item(phrase) for phrase in self._phrases(section)], "notes": {}}
+                       for number, section in enumerate(sections, start=1)]
+            return json.dumps({"results": results})
+        return json.dumps({"quiz": [self._item(phrase) for phrase in self._phrases(user_input)],
+                           "notes": {"message": "Here's your quiz! 😊"}})
+
+    @staticmethod
+    def _phrases(text: str) -> List[str]:
+        text = re.sub(r"\n\n\(\d+ sections.*$", "", text, flags=re.S)
+        return [part.strip() for part in re.split(r"[,\n]", text) if part.strip()]
+
+    def _item(self, phrase: str) -> Dict[str, Any]:
+        answer_index = self.rng.randrange(4)
+        options = [f"I {phrase} every morning.", f"They {phrase} the door.", f"She felt {phrase} after the trip.", f"We {phrase} at noon."]
+        options[answer_index] = f"Correct use of '{phrase}'."
+        return {"phrase": phrase, "question": f"Which sentence uses '{phrase}' correctly?",
+                "options": options, "answer_index": answer_index, "explanation": f"'{phrase}' fits this context."}
+
+
+# --- Simulated traffic ---
+
+class Simulation:
+    """Feeds synthetic updates of simulated users into the application's update queue."""
+
+    def __init__(self, application, backend: FakeTelegramBackend, recorder: LatencyRecorder, args, rng: random.Random):
+        self.application = application
+        self.backend = backend
+        self.recorder = recorder
+        self.args = args
+        self.rng = rng
+        self._update_id = 0
+        self._message_id = 0
+        self.daily_polls = 0
+        self.daily_seconds = 0.0
+
+    def _next_ids(self) -> Tuple[int, int]:
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def _message_update(self, user_id: int, text: str) -> Dict[str, Any]:
+        update_id, message_id = self._next_ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def _callback_update(self, user_id: int, data: str) -> Dict[str, Any]:
+        update_id, message_id = self._next_ids()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                        "from": BOT_USER, "text": "Select your level"},
+        }}
+
+    async def _put(self, data: Dict[str, Any]) -> None:
+        from telegram import Update
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    async def _wait(self, name: str, future: asyncio.Future, started: float) -> bool:
+        try:
+            self.recorder.add(name, await asyncio.wait_for(future, timeout=self.args.timeout) - started)
+            return True
+        except asyncio.TimeoutError:
+            self.recorder.timeout(name)
+            return False
+
+    async def user(self, index: int) -> None:
+        user_id = 100000 + index
+        await asyncio.sleep(self.rng.random() * self.args.ramp_up) # Users don't all arrive at once
+
+        reply = self.backend.expect(user_id, lambda method, params: method == "sendMessage")
+        started = time.perf_counter()
+        await self._put(self._message_update(user_id, "/start"))
+        await self._wait("start", reply, started)
+
+        edited = self.backend.expect(user_id, lambda method, params: method == "editMessageText")
+        started = time.perf_counter()
+        await self._put(self._callback_update(user_id, f"level_{self.rng.choice(LEVELS)}"))
+        await self._wait("level_choice", edited, started)
+
+        for _ in range(self.args.rounds):
+            phrases = self.rng.sample(PHRASES, self.rng.randint(2, 5))
+            if self.rng.random() < self.args.burst_ratio: # Notes typed as several quick messages
+                messages = phrases
+            else:
+                messages = [", ".join(phrases)]
+            first_poll = self.backend.expect(user_id, lambda method, params: method == "sendPoll")
+            finished = self.backend.expect(user_id, lambda method, params: method == "sendMessage"
+                                           and not str(params.get("text", "")).startswith("🔍"))
+            started = time.perf_counter()
+            for number, text in enumerate(messages):
+                if number:
+                    await asyncio.sleep(self.args.burst_gap)
+                await self._put(self._message_update(user_id, text))
+            if await self._wait("quiz_complete", finished, started):
+                if first_poll.done():
+                    self.recorder.add("quiz_first_poll", first_poll.result() - started)
+                else:
+                    first_poll.cancel()
+                    self.recorder.timeout("quiz_first_poll")
+            await asyncio.sleep(self.rng.expovariate(1 / self.args.think_seconds) if self.args.think_seconds else 0)
+
+    async def daily_job(self, main_module) -> None:
+        from telegram.ext import CallbackContext
+        polls_before = self.backend.calls.get("sendPoll", 0)
+        started = time.perf_counter()
+        await main_module.daily_quiz_job(CallbackContext(self.application))
+        self.recorder.add("daily_job", time.perf_counter() - started)
+
+        # Delivery is done once the outbox has nothing left to send
+        while True:
+            pending = (await main_module.db_manager.count_outbox()).get("pending", 0)
+            if not pending and not main_module.outbox.in_flight:
+                break
+            if time.perf_counter() - started > self.args.timeout * 10:
+                self.recorder.timeout("daily_delivery")
+                return
+            await asyncio.sleep(0.05)
+        self.daily_seconds = time.perf_counter() - started
+        self.recorder.add("daily_delivery", self.daily_seconds)
+        self.daily_polls = self.backend.calls.get("sendPoll", 0) - polls_before
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test with fake Telegram and Gemini backends.")
+    parser.add_argument("--users", type=int, default=50, help="Simulated users")
+    parser.add_argument("--rounds", type=int, default=3, help="Notes each user sends after picking a level")
+    parser.add_argument("--think-seconds", type=float, default=1.0, help="Mean pause between a user's rounds")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds over which users start")
+    parser.add_argument("--burst-ratio", type=float, default=0.3, help="Share of notes sent as several quick messages")
+    parser.add_argument("--burst-gap", type=float, default=0.3, help="Seconds between the messages of a burst")
+    parser.add_argument("--ai-latency", type=float, default=1.5, help="Mean AI call latency in seconds")
+    parser.add_argument("--ai-jitter", type=float, default=0.5)
+    parser.add_argument("--ai-failure-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="Mean Bot API call latency in seconds")
+    parser.add_argument("--telegram-jitter", type=float, default=0.02)
+    parser.add_argument("--telegram-flood-rate", type=float, default=0.0, help="Share of Bot API calls answered with 429")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="Share of Bot API calls answered with 502")
+    parser.add_argument("--unthrottled", action="store_true", help="Lift the bot's Telegram send rate limits")
+    parser.add_argument("--skip-daily", action="store_true", help="Don't run the daily quiz job")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds to wait for each expected reply")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database", help="SQLite file to use instead of a fresh temporary one")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="Also write the results JSON to this file")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare with the baseline, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression when comparing")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args: argparse.Namespace, workdir: str) -> None:
+    """Settings for the bot modules; must run before config is imported."""
+    os.environ["DATABASE_NAME"] = args.database or os.path.join(workdir, "benchmark.db")
+    os.environ.setdefault("LOG_FILE", os.path.join(workdir, "benchmark.log"))
+    os.environ["LOG_LEVEL"] = args.log_level
+    os.environ["TELEGRAM_TOKEN"] = "123456:BENCHMARK"
+    os.environ["GOOGLE_AI_TOKEN"] = "benchmark"
+    os.environ["PROCESS_ROLE"] = "single"
+    os.environ["STATUS_PORT"] = "0"
+    os.environ["METRICS_LOG_SECONDS"] = "0"
+    if args.unthrottled:
+        for name in ("BROADCAST_GLOBAL_RATE", "BROADCAST_PER_CHAT_RATE", "BROADCAST_PER_CHAT_BURST"):
+            os.environ[name] = "1000000"
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    import main as bot
+    import utilities
+    from metrics import stage_seconds, stage_errors
+    from telegram.ext import Application
+    from update_processor import PendingLimitQueue
+
+    rng = random.Random(args.seed)
+    backend = FakeTelegramBackend(rng, args.telegram_latency, args.telegram_jitter, args.telegram_flood_rate, args.telegram_error_rate)
+    ai_client = FakeGenaiClient(rng, args.ai_latency, args.ai_jitter, args.ai_failure_rate)
+    utilities.ai_model = ai_client
+
+    application = (
+        Application.builder()
+        .token(os.environ["TELEGRAM_TOKEN"])
+        .request(FakeTelegramRequest(backend))
+        .get_updates_request(FakeTelegramRequest(backend))
+        .concurrent_updates(bot.update_processor)
+        .update_queue(PendingLimitQueue())
+        .updater(None)
+        .build()
+    )
+    bot.register_handlers(application)
+
+    recorder = LatencyRecorder()
+    monitor = LoopStallMonitor()
+    simulation = Simulation(application, backend, recorder, args, rng)
+    stage_seconds.interval_summary() # Start the stage summary from here
+
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        monitor.start()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(simulation.user(index) for index in range(args.users)))
+            users_seconds = time.perf_counter() - started
+            if not args.skip_daily:
+                await simulation.daily_job(bot)
+        finally:
+            wall_seconds = time.perf_counter() - started
+            await monitor.stop()
+            await application.stop()
+            await bot.post_shutdown(application)
+    bot.db_manager.close_connection()
+
+    latencies = recorder.report(wall_seconds)
+    quizzes = latencies.get("quiz_complete", {}).get("count", 0)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("output", "baseline", "save_baseline", "compare", "database", "log_level")},
+        "wall_seconds": wall_seconds,
+        "throughput": {
+            "quizzes_per_second": quizzes / users_seconds if users_seconds else 0.0,
+            "telegram_calls_per_second": sum(backend.calls.values()) / wall_seconds if wall_seconds else 0.0,
+            "daily_polls_per_second": simulation.daily_polls / simulation.daily_seconds if simulation.daily_seconds else 0.0,
+        },
+        "latency": latencies,
+        "event_loop": monitor.report(),
+        "telegram": {"calls": dict(backend.calls), "failures": dict(backend.failures)},
+        "ai": {"calls": ai_client.calls, "failures": ai_client.failures, "usage": utilities.ai_usage.stats()},
+        "stages": {f"{stage}.{operation}": {"count": stats["count"], "mean_ms": stats["mean"] * 1000,
+                                            "p50_ms": stats["p50"] * 1000, "p95_ms": stats["p95"] * 1000}
+                   for (stage, operation), stats in sorted(stage_seconds.interval_summary().items())},
+        "errors": {".".join(key): value for key, value in sorted(stage_errors._values.items())},
+        "components": {"quiz_generator": bot.quiz_generator.stats(), "user_cache": bot.user_cache.stats(),
+                       "notes": bot.note_coalescer.stats(), "updates": bot.update_processor.stats()},
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Lines describing every metric that got worse than the baseline by more than `tolerance`."""
+    regressions = []
+    for name, stats in results["latency"].items():
+        before = baseline.get("latency", {}).get(name)
+        if not before:
+            continue
+        for field in ("p50_ms", "p95_ms", "p99_ms"):
+            if before[field] > 0 and stats[field] > before[field] * (1 + tolerance):
+                regressions.append(f"{name} {field}: {before[field]:.1f} -> {stats[field]:.1f}")
+        if stats["timeouts"] > before["timeouts"]:
+            regressions.append(f"{name} timeouts: {before['timeouts']} -> {stats['timeouts']}")
+    for name, value in results["throughput"].items():
+        before = baseline.get("throughput", {}).get(name, 0)
+        if before > 0 and value < before * (1 - tolerance):
+            regressions.append(f"{name}: {before:.2f} -> {value:.2f}")
+    stalled, stalled_before = results["event_loop"]["stalled_ms"], baseline.get("event_loop", {}).get("stalled_ms", 0)
+    if stalled_before > 0 and stalled > stalled_before * (1 + tolerance):
+        regressions.append(f"event loop stalled_ms: {stalled_before:.1f} -> {stalled:.1f}")
+    return regressions
+
+
+def print_report(results: Dict[str, Any]) -> None:
+    print(f"Wall time {results['wall_seconds']:.1f}s, "
+          + ", ".join(f"{name} {value:.2f}" for name, value in results["throughput"].items()))
+    print(f"{'step':<18}{'count':>7}{'timeouts':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in results["latency"].items():
+        print(f"{name:<18}{stats['count']:>7}{stats['timeouts']:>10}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    loop = results["event_loop"]
+    print(f"Event loop: p99 lag {loop['p99_lag_ms']:.1f} ms, max lag {loop['max_lag_ms']:.1f} ms, "
+          f"{loop['stalls']} stalls, {loop['stalled_ms']:.0f} ms stalled")
+    print(f"Telegram calls: {results['telegram']['calls']}, AI calls: {results['ai']['calls']}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="quizpal-benchmark-") as workdir:
+        configure_environment(args, workdir)
+        results = asyncio.run(run(args))
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+            exit_code = 1
+        else:
+            with open(args.baseline, encoding="utf-8") as file:
+                baseline = json.load(file)
+            if baseline.get("settings") != results["settings"]:
+                print("Warning: the baseline was recorded with different settings.")
+            regressions = compare(results, baseline, args.tolerance)
+            for line in regressions:
+                print(f"REGRESSION {line}")
+            print(f"{len(regressions)} regressions against the baseline of {baseline.get('timestamp')}.")
+            exit_code = 1 if regressions else 0
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+        print(f"Baseline saved to {args.baseline}.")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
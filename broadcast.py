@@ -0,0 +1,192 @@
+import asyncio
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, Optional, TypeVar, Union
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from config import (
+    logger,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_GLOBAL_RATE,
+    BROADCAST_PER_CHAT_RATE,
+    BROADCAST_PER_CHAT_BURST,
+    BROADCAST_MAX_RETRIES,
+    BROADCAST_PROGRESS_FLUSH
+)
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: callers may drive the balance negative
+    and then sleep until their token would have been refilled, so waiters are served in order.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Takes one token and returns how long the caller has to wait before using it."""
+        self._refill()
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def try_take(self) -> float:
+        """Takes one token only if one is available. Returns 0.0 if taken, else the seconds until one is."""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back all new reservations for at least `seconds` (e.g. after a RetryAfter)."""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class TelegramRateLimiter:
+    """Applies Telegram's global and per-chat send limits and retries calls that hit flood control."""
+
+    def __init__(self,
+                 global_rate: float = BROADCAST_GLOBAL_RATE,
+                 per_chat_rate: float = BROADCAST_PER_CHAT_RATE,
+                 max_retries: int = BROADCAST_MAX_RETRIES,
+                 per_chat_burst: float = BROADCAST_PER_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self.retry_after_count = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000: # Forget chats whose bucket has fully refilled
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, capacity=self.per_chat_burst)
+        return bucket
+
+    async def run(self, chat_id, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Runs `call` (a zero-argument coroutine factory) once both limits allow it.
+        RetryAfter pauses the global bucket and retries; other network errors retry with backoff.
+        """
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await call()
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.retry_after_count += 1
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after}s.")
+                self.global_bucket.pause(e.retry_after)
+                self._chat_bucket(chat_id).pause(e.retry_after)
+            except BadRequest:
+                raise # Retrying won't fix a malformed request
+            except NetworkError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = 2 ** attempt
+                logger.warning(f"Network error sending to chat {chat_id}: {e}. Retrying in {delay}s.")
+                await asyncio.sleep(delay)
+            attempt += 1
+
+
+class Broadcaster:
+    """
+    Sends to many chats concurrently. Progress is recorded per run_id in the database,
+    so running the same run_id again only sends to chats that were not reached yet
+    (unless track_progress is off, for callers whose sends are idempotent anyway).
+    """
+
+    def __init__(self, db_manager, concurrency: int = BROADCAST_CONCURRENCY, progress_flush: int = BROADCAST_PROGRESS_FLUSH):
+        self.db_manager = db_manager
+        self.concurrency = concurrency
+        self.progress_flush = progress_flush
+
+    async def run(self,
+                  run_id: str,
+                  recipients: Union[Iterable[Any], AsyncIterable[Any]],
+                  send: Callable[[Any], Awaitable[None]],
+                  chat_id_of: Callable[[Any], int] = lambda recipient: recipient,
+                  track_progress: bool = True
+                  ) -> Dict[str, int]:
+        """
+        Calls `send(recipient)` for every recipient whose chat is not yet done in this run.
+        Recipients are chat ids unless `chat_id_of` says how to get one. Returns sent/failed/skipped counts.
+        """
+        already_sent = await self.db_manager.get_broadcast_sent_chat_ids(run_id) if track_progress else set()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        completed = []
+        stats = {"sent": 0, "failed": 0, "skipped": 0}
+
+        async def flush_progress():
+            if completed:
+                chat_ids = completed[:]
+                completed.clear()
+                await self.db_manager.mark_broadcast_sent(run_id, chat_ids)
+
+        async def worker():
+            while True:
+                recipient = await queue.get()
+                chat_id = chat_id_of(recipient)
+                try:
+                    await send(recipient)
+                    stats["sent"] += 1
+                    if track_progress:
+                        completed.append(chat_id)
+                    if len(completed) >= self.progress_flush:
+                        await flush_progress()
+                except Exception as e:
+                    stats["failed"] += 1
+                    logger.error(f"Broadcast {run_id}: failed to send to chat {chat_id}: {e}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        async def enqueue(recipient):
+            if chat_id_of(recipient) in already_sent:
+                stats["skipped"] += 1
+            else:
+                await queue.put(recipient) # Waits while the workers are busy, so pages are fetched as needed
+
+        try:
+            if hasattr(recipients, "__aiter__"):
+                async for recipient in recipients:
+                    await enqueue(recipient)
+            else:
+                for recipient in recipients:
+                    await enqueue(recipient)
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await flush_progress()
+
+        logger.info(f"Broadcast {run_id} finished: {stats}")
+        return stats
@@ -0,0 +1,59 @@
+import hashlib
+import json
+from typing import List, Optional, Union
+
+from telegram.error import TelegramError
+
+from config import logger, CHANNEL_ID
+
+
+def poll_content_hash(question: str, options: List[str], correct_option_id: int) -> str:
+    """Identifies a poll by its content, so the same question is only posted once."""
+    raw = json.dumps([question.strip(), [option.strip() for option in options], correct_option_id], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ChannelPublisher:
+    """
+    Posts quiz polls to CHANNEL_ID through the outbox, so channel sends never block user delivery.
+    Polls are deduplicated by content hash across the daily job and user quizzes; posted hashes are
+    kept in the channel_posts table (and used as outbox idempotency keys) so restarts don't repost them.
+    """
+
+    def __init__(self, db_manager, outbox, channel_id: Optional[Union[int, str]] = CHANNEL_ID):
+        self.db_manager = db_manager
+        self.outbox = outbox
+        self.channel_id = channel_id or None # An int id, or an @channelname
+        self.posted = 0
+        self.duplicates = 0
+
+    async def resolve(self, bot) -> None:
+        """Replaces an @channelname by the channel's chat id, the id Telegram reports in updates and errors."""
+        if not isinstance(self.channel_id, str):
+            return
+        try:
+            self.channel_id = (await bot.get_chat(self.channel_id)).id
+            logger.info(f"Channel {CHANNEL_ID} has chat id {self.channel_id}.")
+        except TelegramError as e:
+            logger.warning(f"Could not look up channel {self.channel_id}, posting by name: {e}")
+
+    async def publish(self, question: str, options: List[str], correct_option_id: int, explanation: Optional[str]) -> bool:
+        """Queues a poll for the channel unless the same poll was already posted or queued. Never waits for the send."""
+        if not self.channel_id:
+            return False
+        content_hash = poll_content_hash(question, options, correct_option_id)
+        if await self.db_manager.is_channel_poll_posted(content_hash):
+            self.duplicates += 1
+            logger.debug("Skipping duplicate channel poll %.12s.", content_hash)
+            return False
+        queued = await self.outbox.send_poll(
+            self.channel_id, question, options, correct_option_id, explanation,
+            is_anonymous=True, # Channel polls are anonymous
+            idempotency_key=f"channel_poll:{content_hash}"
+        )
+        if not queued:
+            self.duplicates += 1
+            return False
+        await self.db_manager.mark_channel_poll_posted(content_hash) # The outbox delivers it from here, even across restarts
+        self.posted += 1
+        return True
@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List, Set
+
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, ContextTypes
+
+from config import logger, LEADER_LEASE_SECONDS, INBOX_POLL_SECONDS, INBOX_BATCH_SIZE
+
+
+def update_shard(update: Update, shards: int) -> int:
+    """Worker shard of an update: its user's id (or chat id) modulo the number of workers."""
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % shards
+
+
+class UpdateInbox:
+    """
+    The SQLite queue between the ingress process and the workers. The ingress stores every update
+    under its shard; each worker claims its own shard's updates in arrival order and has its
+    Application handle them exactly like updates from polling or a webhook.
+    An update is only deleted once it has been handled. Updates a worker had claimed when it died
+    are handled again by its successor (at-least-once; quiz sends are idempotent per update id).
+    """
+
+    def __init__(self, db_manager, shards: int, batch_size: int = INBOX_BATCH_SIZE, poll_seconds: float = INBOX_POLL_SECONDS):
+        self.db_manager = db_manager
+        self.shards = shards
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.forwarded = 0
+        self.consumed = 0
+        self._handled: List[int] = []
+        self._handling: Set[asyncio.Task] = set()
+
+    async def forward_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Ingress handler (group -1): stores the update for its worker and stops local handling."""
+        if await self.db_manager.add_inbox_update(update_shard(update, self.shards), update.to_json()):
+            self.forwarded += 1
+        else:
+            logger.error(f"Could not forward update {update.update_id} to its worker.")
+        raise ApplicationHandlerStop
+
+    async def consume(self, application: Application, shard: int) -> None:
+        """Worker loop: hands this shard's stored updates to the application and deletes them once handled."""
+        released = await self.db_manager.release_inbox_updates(shard)
+        logger.info(f"Worker consuming updates of shard {shard}/{self.shards} ({released} unfinished updates taken over).")
+        try:
+            while True:
+                await self._delete_handled()
+                if len(self._handling) >= self.batch_size: # Let the handlers catch up first
+                    await asyncio.sleep(self.poll_seconds)
+                    continue
+                rows = await self.db_manager.take_inbox_updates(shard, self.batch_size - len(self._handling))
+                for update_id, payload in rows:
+                    try:
+                        update = Update.de_json(json.loads(payload), application.bot)
+                    except Exception as e:
+                        logger.error(f"Dropping unreadable update from the inbox: {e}")
+                        self._handled.append(update_id)
+                        continue
+                    task = asyncio.create_task(self._handle(application, update_id, update))
+                    self._handling.add(task)
+                    task.add_done_callback(self._handling.discard)
+                if len(rows) < self.batch_size:
+                    await asyncio.sleep(self.poll_seconds)
+        finally:
+            # Unfinished updates stay claimed and are released by the next worker of this shard
+            await asyncio.gather(*self._handling, return_exceptions=True)
+            await self._delete_handled()
+
+    async def _handle(self, application: Application, update_id: int, update: Update) -> None:
+        # Same path as Application's own update fetcher: the update processor, then the handlers
+        try:
+            await application.update_processor.process_update(update, application.process_update(update))
+            self.consumed += 1
+        except Exception as e: # Handler errors go to the error handler; this is anything else, retrying won't help
+            logger.error(f"Error handling update {update.update_id} from the inbox: {e}", exc_info=True)
+        self._handled.append(update_id)
+
+    async def _delete_handled(self) -> None:
+        if self._handled:
+            handled, self._handled = self._handled, []
+            if not await self.db_manager.delete_inbox_updates(handled):
+                self._handled[:0] = handled # Retried with the next batch
+
+
+class LeaderLease:
+    """
+    A lease row in SQLite that at most one process holds at a time. Holders renew it well before
+    it expires; if the holder dies, another process takes it over after `ttl_seconds`.
+    """
+
+    def __init__(self, db_manager, name: str = "jobs", ttl_seconds: float = LEADER_LEASE_SECONDS, role: str = "single"):
+        self.db_manager = db_manager
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{role}"
+        self.is_leader = False
+
+    async def hold(self) -> bool:
+        """Takes or renews the lease. Returns True while this process is the leader."""
+        was_leader = self.is_leader
+        self.is_leader = await self.db_manager.acquire_lease(self.name, self.owner, self.ttl_seconds)
+        if self.is_leader != was_leader:
+            logger.info(f"Process {self.owner} {'became' if self.is_leader else 'is no longer'} the {self.name} leader.")
+        return self.is_leader
+
+    async def release(self) -> None:
+        if self.is_leader:
+            await self.db_manager.release_lease(self.name, self.owner)
+            self.is_leader = False
+
+    def leader_only(self, job: Callable[[ContextTypes.DEFAULT_TYPE], Awaitable[None]]):
+        """Wraps a job callback so it only runs in the process holding the lease."""
+        @functools.wraps(job)
+        async def wrapper(context: ContextTypes.DEFAULT_TYPE) -> None:
+            if not await self.hold():
+                logger.debug("Skipping job %s: not the %s leader.", job.__name__, self.name)
+                return
+            await job(context)
+        return wrapper
+
+
+async def run_without_updater(application: Application, consume: Callable[[Application], Awaitable[None]]) -> None:
+    """
+    Runs an Application built with .updater(None) until SIGINT/SIGTERM, with `consume` supplying
+    its updates. post_init/post_shutdown are called like run_polling does.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        consumer = asyncio.create_task(consume(application))
+        try:
+            await stop.wait()
+        finally:
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+def run_cluster(script_path: str, worker_count: int) -> None:
+    """
+    Supervisor: starts one ingress and `worker_count` worker processes of `script_path`,
+    restarts any that exit unexpectedly, and stops them all on SIGINT/SIGTERM.
+    """
+    def spawn(role: str, index: int = 0) -> subprocess.Popen:
+        env = dict(os.environ, PROCESS_ROLE=role, WORKER_INDEX=str(index), WORKER_COUNT=str(worker_count))
+        process = subprocess.Popen([sys.executable, script_path], env=env)
+        logger.info(f"Started {role} process {index} (pid {process.pid}).")
+        return process
+
+    processes: Dict[tuple, subprocess.Popen] = {("ingress", 0): spawn("ingress")}
+    for index in range(worker_count):
+        processes[("worker", index)] = spawn("worker", index)
+
+    stopping = []
+    def request_stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    while not stopping:
+        time.sleep(1)
+        for (role, index), process in list(processes.items()):
+            if process.poll() is not None and not stopping:
+                logger.error(f"{role} process {index} exited with code {process.returncode}, restarting it.")
+                processes[(role, index)] = spawn(role, index)
+
+    logger.info("Stopping cluster...")
+    for process in processes.values():
+        if process.poll() is None:
+            process.terminate()
+    for (role, index), process in processes.items():
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{role} process {index} did not stop in time, killing it.")
+            process.kill()
@@ -3,6 +3,8 @@ import logging
 import os
 from dotenv import load_dotenv
 
+from logging_setup import setup_logging, SAMPLED # SAMPLED is re-exported for the handlers
+
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -12,42 +14,145 @@ if not TELEGRAM_TOKEN:
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 if not CHANNEL_ID:
     print("Warning: CHANNEL_ID not found in environment variables or .env file. Some features might not work.")
+elif CHANNEL_ID.strip().lstrip("-").isdigit():
+    CHANNEL_ID = int(CHANNEL_ID) # Same type as the chat ids Telegram reports (outbox sharding, blocked chats)
 
 GOOGLE_AI_TOKEN = os.getenv("GOOGLE_AI_TOKEN")
 if not GOOGLE_AI_TOKEN:
     raise ValueError("GOOGLE_AI_TOKEN not found in environment variables or .env file")
 
 DATABASE_NAME = os.getenv("DATABASE_NAME", "quizpal_default.db")
+DB_READER_THREADS = int(os.getenv("DB_READER_THREADS", "4")) # Threads (and connections) serving reads
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "256")) # Max writes grouped into one commit
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000")) # User profiles kept in memory
+USER_ACTIVITY_FLUSH_SECONDS = int(os.getenv("USER_ACTIVITY_FLUSH_SECONDS", "30")) # How often last-seen timestamps are written
+
+# --- AI Generation ---
+AI_MODEL_NAME = os.getenv("AI_MODEL_NAME", "gemini-2.0-flash")
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8")) # Max AI requests in flight at once
+AI_TIMEOUT_SECONDS = float(os.getenv("AI_TIMEOUT_SECONDS", "60")) # Per-call timeout for AI requests
+AI_BATCH_WINDOW_SECONDS = float(os.getenv("AI_BATCH_WINDOW_SECONDS", "0.3")) # How long to collect requests into one call
+AI_BATCH_MAX_SIZE = int(os.getenv("AI_BATCH_MAX_SIZE", "8")) # Max requests per batched call, 1 disables batching
+AI_STREAMING = os.getenv("AI_STREAMING", "true").lower() in ("1", "true", "yes") # Stream user quizzes and send each poll as soon as it is generated
+
+# --- Per-User Limits ---
+NOTE_COALESCE_SECONDS = float(os.getenv("NOTE_COALESCE_SECONDS", "2")) # Quiet time after a user's last message before their notes go to the AI
+NOTE_COALESCE_MAX_SECONDS = float(os.getenv("NOTE_COALESCE_MAX_SECONDS", "8")) # Longest the first message of a burst waits for more
+AI_USER_MAX_CALLS = int(os.getenv("AI_USER_MAX_CALLS", "5")) # AI generations a user may trigger per period (0 = no limit)
+AI_USER_PERIOD_SECONDS = float(os.getenv("AI_USER_PERIOD_SECONDS", "60")) # Period of AI_USER_MAX_CALLS
+
+# --- Quiz Cache ---
+QUIZ_CACHE_MAX_SIZE = int(os.getenv("QUIZ_CACHE_MAX_SIZE", "1024")) # In-memory entries
+QUIZ_CACHE_TTL_SECONDS = int(os.getenv("QUIZ_CACHE_TTL_SECONDS", "3600")) # In-memory lifetime
+QUIZ_CACHE_DB_TTL_DAYS = int(os.getenv("QUIZ_CACHE_DB_TTL_DAYS", "30")) # SQLite lifetime, 0 = never expire
+
+CEFR_LEVELS = ('A1', 'A2', 'B1', 'B2', 'C1', 'C2')
+
+# --- Daily Puzzles ---
+DAILY_PUZZLE_COUNT = int(os.getenv("DAILY_PUZZLE_COUNT", "3")) # Puzzles sent per daily run
+PUZZLE_STOCK_TARGET = int(os.getenv("PUZZLE_STOCK_TARGET", "21")) # Unconsumed puzzles to keep per level (a week by default)
+PUZZLE_GENERATION_BATCH = int(os.getenv("PUZZLE_GENERATION_BATCH", "6")) # Puzzles requested per AI call
+PUZZLE_GENERATION_MAX_REQUESTS = int(os.getenv("PUZZLE_GENERATION_MAX_REQUESTS", "12")) # AI call budget per top-up run
+PUZZLE_GENERATION_MAX_TOKENS = int(os.getenv("PUZZLE_GENERATION_MAX_TOKENS", "200000")) # AI token budget per top-up run (0 = no limit)
+PUZZLE_GENERATION_TIME = os.getenv("PUZZLE_GENERATION_TIME", "03:00") # Quiet-hours top-up, server time (HH:MM)
+DELIVERY_WINDOWS = os.getenv("DELIVERY_WINDOWS", "true").lower() in ("1", "true", "yes") # Deliver at each user's own time; false = everyone at DAILY_DELIVERY_TIME server time
+DAILY_DELIVERY_TIME = os.getenv("DAILY_DELIVERY_TIME", "07:30") # Delivery time (HH:MM, local) for users who haven't chosen one
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "") # IANA timezone (e.g. Europe/Berlin) of users who haven't chosen one; empty = server time
+DELIVERY_JITTER_MINUTES = float(os.getenv("DELIVERY_JITTER_MINUTES", "15")) # Each user's sends are delayed by a stable offset up to this, spreading a bucket's load
+DELIVERY_CATCHUP_MINUTES = int(os.getenv("DELIVERY_CATCHUP_MINUTES", "15")) # Missed minute buckets (restart, lease handover) still delivered this late
+CHANNEL_POST_RETENTION_DAYS = int(os.getenv("CHANNEL_POST_RETENTION_DAYS", "30")) # A poll isn't posted to the channel again within this many days
+
+# --- Broadcasts (daily puzzle fan-out) ---
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20")) # Chats sent to in parallel
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25")) # Messages/second across all chats (Telegram allows ~30)
+BROADCAST_PER_CHAT_RATE = float(os.getenv("BROADCAST_PER_CHAT_RATE", "1")) # Messages/second to a single chat
+BROADCAST_PER_CHAT_BURST = float(os.getenv("BROADCAST_PER_CHAT_BURST", "5")) # Messages a chat may get at once before the per-chat rate applies (a quiz)
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3")) # Retries after RetryAfter/network errors
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500")) # Users fetched per page while streaming recipients
+BROADCAST_PROGRESS_FLUSH = int(os.getenv("BROADCAST_PROGRESS_FLUSH", "50")) # Completed chats per progress write
+
+# --- Outbox (durable queue for all poll/broadcast sends) ---
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "16")) # Sender coroutines; each chat always maps to the same one, keeping its order
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200")) # Rows claimed from the database at a time
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300")) # Claimed rows are retried after this if the process dies
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")) # Attempts before a message is dead-lettered
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "2")) # First retry delay, doubled per attempt
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "900"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5")) # Idle check for retries that became due
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7")) # Sent/dead rows (and their idempotency keys) are kept this long
+
+# --- Poll Answers ---
+POLL_ANSWER_FLUSH_SECONDS = float(os.getenv("POLL_ANSWER_FLUSH_SECONDS", "1")) # Buffered sent polls and answers are written this often
+POLL_ANSWER_BATCH_SIZE = int(os.getenv("POLL_ANSWER_BATCH_SIZE", "1000")) # ...or as soon as this many are buffered
+POLL_ANSWER_RETRY_SECONDS = float(os.getenv("POLL_ANSWER_RETRY_SECONDS", "60")) # Answers whose poll isn't indexed yet (sent by another process) are retried this long
+POLL_INDEX_RETENTION_DAYS = int(os.getenv("POLL_INDEX_RETENTION_DAYS", "7")) # Answers to polls sent longer ago are not counted
+
+# --- Reviews (spaced repetition of missed quiz items) ---
+REVIEW_INTERVALS_HOURS = [float(hours) for hours in os.getenv("REVIEW_INTERVALS_HOURS", "20,68,164,500").split(",")] # Wait before each review; a right answer moves to the next
+REVIEW_TICK_SECONDS = int(os.getenv("REVIEW_TICK_SECONDS", "60")) # How often due reviews are sent
+REVIEW_BATCH_SIZE = int(os.getenv("REVIEW_BATCH_SIZE", "1000")) # Due reviews read per query
+REVIEW_MAX_PER_USER = int(os.getenv("REVIEW_MAX_PER_USER", "3")) # Reviews a user gets at once; the rest wait REVIEW_RESEND_HOURS
+REVIEW_RESEND_HOURS = float(os.getenv("REVIEW_RESEND_HOURS", "24")) # An unanswered review is sent again after this
+
+# --- Update Ingestion ---
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower() # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Public HTTPS URL of the reverse proxy that forwards to the bot, e.g. https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443")) # Port of the built-in webhook server (plain HTTP, TLS ends at the proxy)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram") # Path the built-in server accepts updates on
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") # Required in webhook mode; Telegram sends it in X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")) # Concurrent HTTPS connections Telegram may open
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32")) # Updates (of different chats) handled at the same time
+UPDATE_SHARDS = int(os.getenv("UPDATE_SHARDS", "16")) # Chat groups that queue depth is reported for
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "4096")) # Updates queued or in progress before polling/webhook intake waits (PendingLimitQueue)
+STATUS_HOST = os.getenv("STATUS_HOST", "0.0.0.0")
+STATUS_PORT = int(os.getenv("STATUS_PORT", "8080")) # Serves /health and /metrics (workers use STATUS_PORT + 1 + WORKER_INDEX); 0 disables it
+METRICS_LOG_SECONDS = int(os.getenv("METRICS_LOG_SECONDS", "300")) # How often a metrics summary is logged, 0 disables it
+
+# --- Process Model ---
+# "single": one process does everything. "cluster": starts one "ingress" process (receives updates, sends the outbox)
+# and WORKER_COUNT "worker" processes (run the handlers for their share of users). Scheduled jobs run in whichever
+# process holds the jobs lease.
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "single").lower()
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "4"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0")) # Set by the cluster supervisor for each worker
+INBOX_POLL_SECONDS = float(os.getenv("INBOX_POLL_SECONDS", "0.05")) # How often an idle worker checks for new updates
+INBOX_BATCH_SIZE = int(os.getenv("INBOX_BATCH_SIZE", "100")) # Updates a worker takes at a time
+OUTBOX_CROSS_PROCESS_POLL_SECONDS = float(os.getenv("OUTBOX_CROSS_PROCESS_POLL_SECONDS", "0.2")) # Outbox check interval when other processes enqueue
+LEADER_LEASE_SECONDS = float(os.getenv("LEADER_LEASE_SECONDS", "30")) # A dead leader's jobs move to another process after this
 
 # --- Logger Setup ---
 LOG_LEVEL_STR = os.getenv('LOG_LEVEL', 'INFO').upper()
 LOG_FILE = os.getenv('LOG_FILE', 'app.log') # Default log file name if not in .env
 LOG_FORMAT = os.getenv('LOG_FORMAT', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOG_JSON = os.getenv('LOG_JSON', 'false').lower() in ("1", "true", "yes") # One JSON object per line instead of LOG_FORMAT
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(20 * 1024 * 1024))) # Rotate when the file reaches this size, 0 = no size limit
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight') # Time-based rotation (TimedRotatingFileHandler `when`), empty = off
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '14')) # Rotated files kept
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1')) # Share of high-volume per-message lines that are logged
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000')) # Records waiting for the writer thread; more are dropped
 
 # Convert string log level to logging constant
 log_level = getattr(logging, LOG_LEVEL_STR, logging.INFO)
 
-# Create logger
-logger = logging.getLogger("QuizPalBot") # Application-specific logger name
-logger.setLevel(log_level)
-
-# Create handlers if they don't already exist to prevent duplication during reloads
-if not logger.handlers:
-    # File Handler
-    fh = logging.FileHandler(LOG_FILE)
-    fh.setLevel(log_level)
-
-    # Console Handler
-    ch = logging.StreamHandler()
-    ch.setLevel(log_level)
+# Cluster processes each write their own file, rotating one file from several processes is not safe
+if PROCESS_ROLE in ("ingress", "worker"):
+    root, extension = os.path.splitext(LOG_FILE)
+    LOG_FILE = f"{root}.{PROCESS_ROLE}{WORKER_INDEX if PROCESS_ROLE == 'worker' else ''}{extension}"
 
-    # Create formatter and attach to handlers
-    formatter = logging.Formatter(LOG_FORMAT)
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-
-    # Add handlers to logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+# Create logger. Records go through a queue to a writer thread, so logging never blocks the event loop
+logger = logging.getLogger("QuizPalBot") # Application-specific logger name
+log_listener = setup_logging(
+    logger,
+    log_level,
+    LOG_FILE,
+    LOG_FORMAT,
+    json_output=LOG_JSON,
+    max_bytes=LOG_MAX_BYTES,
+    rotate_when=LOG_ROTATE_WHEN,
+    backup_count=LOG_BACKUP_COUNT,
+    sample_rate=LOG_SAMPLE_RATE,
+    queue_size=LOG_QUEUE_SIZE
+)
 
-logger.info("Configuration loaded and logger initialized.")
\ No newline at end of file
+logger.info("Configuration loaded and logger initialized.")
@@ -0,0 +1,1315 @@
+import asyncio
+import datetime
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from config import logger, DATABASE_NAME, DB_READER_THREADS, DB_WRITE_BATCH_MAX, BROADCAST_PAGE_SIZE
+from metrics import timed
+
+
+class DailyRecipient(NamedTuple):
+    """The only user fields a daily broadcast needs."""
+    user_id: int
+    level: Optional[str]
+
+
+class OutboxMessage(NamedTuple):
+    """A claimed outbox row, ready to be sent."""
+    id: int
+    chat_id: int
+    method: str
+    payload: str
+    attempts: int
+
+
+class PollAnswer(NamedTuple):
+    """A user's answer to a quiz poll, as received in a poll_answer update."""
+    poll_id: str
+    user_id: int
+    option: Optional[int]
+    answered_at: float # Unix time
+
+
+class AnsweredItem(NamedTuple):
+    """An answer matched to its quiz item and counted."""
+    user_id: int
+    item_key: str
+    correct: bool
+    answered_at: float
+
+
+class DueReview(NamedTuple):
+    """A review to send: the user and the outbox payload of the quiz item's poll."""
+    user_id: int
+    item_key: str
+    payload: str
+
+
+class DatabaseManager:
+    """
+    Async-facing SQLite access. The event loop never touches a connection:
+    reads run on a small pool of reader threads, each with its own connection, and all writes go
+    to one writer thread that applies whatever is queued as a single transaction (group commit).
+    Every public method is a coroutine; writes resolve once their transaction has been committed.
+    """
+
+    def __init__(self, db_name: str = DATABASE_NAME, reader_threads: int = DB_READER_THREADS):
+        self.db_name = db_name
+        self.conn = None # Writer connection, only used by the writer thread after startup
+        self._reader_connections = []
+        self._reader_lock = threading.Lock()
+        self._local = threading.local()
+        self._write_queue: "queue.Queue" = queue.Queue()
+        try:
+            self.conn = self._connect()
+            logger.info(f"Successfully connected to database: {self.db_name}")
+            self._create_tables()
+        except sqlite3.Error as e:
+            logger.error(f"Error connecting to database {self.db_name}: {e}")
+            raise
+
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix="db-reader")
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: transactions are managed explicitly by the writer
+        conn = sqlite3.connect(self.db_name, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer and vice versa
+        conn.execute("PRAGMA synchronous=NORMAL") # Durable at checkpoints, no fsync per commit in WAL mode
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000") # ~16 MB page cache per connection
+        return conn
+
+    def _create_tables(self):
+        cursor = self.conn.cursor()
+        try:
+            # 0 for False, 1 for True
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL UNIQUE,
+                username TEXT,
+                level TEXT CHECK(level IN ('A1', 'A2', 'B1', 'B2', 'C1', 'C2')),
+                daily_puzzle INTEGER DEFAULT 1,
+                timestamp DATETIME NOT NULL
+            )
+            ''')
+            # Covers the keyset-paginated daily broadcast scan (see iter_daily_puzzle_users)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_daily_puzzle ON users (daily_puzzle, user_id, level)")
+            # Added later: preferred daily delivery time (minutes after local midnight) and IANA timezone, NULL = the defaults
+            user_columns = {row[1] for row in cursor.execute("PRAGMA table_info(users)").fetchall()}
+            for column, column_type in (("delivery_minute", "INTEGER"), ("timezone", "TEXT")):
+                if column not in user_columns:
+                    cursor.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+            # Covers the per-minute delivery bucket lookup (see get_delivery_bucket_users)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_delivery ON users (timezone, delivery_minute, user_id, level) WHERE daily_puzzle = 1")
+            # AI quiz responses keyed on normalized input + level + prompt version
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quiz_cache (
+                cache_key TEXT PRIMARY KEY,
+                prompt_version TEXT NOT NULL,
+                level TEXT,
+                input_text TEXT NOT NULL,
+                response TEXT NOT NULL,
+                timestamp DATETIME NOT NULL
+            )
+            ''')
+            # Single generated quiz items, one per (phrase, level, prompt version)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS phrase_items (
+                phrase TEXT NOT NULL,
+                level TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                item TEXT NOT NULL,
+                timestamp DATETIME NOT NULL,
+                PRIMARY KEY (phrase, level, prompt_version)
+            )
+            ''')
+            # Broadcast runs (e.g. one daily puzzle run per day) and the chats each run already reached
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_runs (
+                run_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                started_at DATETIME NOT NULL,
+                finished_at DATETIME
+            )
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_progress (
+                run_id TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                timestamp DATETIME NOT NULL,
+                PRIMARY KEY (run_id, chat_id)
+            )
+            ''')
+            # Content hashes of polls already posted to the channel
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS channel_posts (
+                content_hash TEXT PRIMARY KEY,
+                timestamp DATETIME NOT NULL
+            )
+            ''')
+            # Daily puzzle bank; items with id <= the level's cursor have been consumed
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS puzzle_bank (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                level TEXT NOT NULL DEFAULT '', -- '' = not tied to a level
+                question_type TEXT,
+                item TEXT NOT NULL,
+                source TEXT,
+                timestamp DATETIME NOT NULL
+            )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_puzzle_bank_level ON puzzle_bank (level, id)")
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS puzzle_bank_cursor (
+                level TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            )
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS puzzle_bank_imports (
+                source TEXT PRIMARY KEY,
+                item_count INTEGER NOT NULL,
+                timestamp DATETIME NOT NULL
+            )
+            ''')
+            # Durable outbound queue of Telegram sends; rows stay after delivery for idempotency
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT UNIQUE,
+                chat_id INTEGER NOT NULL,
+                method TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'sent', 'dead')),
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL, -- Unix time; pushed forward while a row is claimed or backing off
+                last_error TEXT,
+                timestamp DATETIME NOT NULL
+            )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at, id) WHERE status = 'pending'")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox (chat_id) WHERE status = 'pending'")
+            # Chats that blocked the bot (dead letters); nothing is queued for them until they come back
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS blocked_chats (
+                chat_id INTEGER PRIMARY KEY,
+                reason TEXT,
+                timestamp DATETIME NOT NULL
+            )
+            ''')
+            # Updates received by the ingress process, waiting for the worker that owns their shard
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS update_inbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                shard INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                timestamp DATETIME NOT NULL,
+                taken INTEGER NOT NULL DEFAULT 0 -- 1 while the worker is handling it; deleted once handled
+            )
+            ''')
+            if "taken" not in {row[1] for row in cursor.execute("PRAGMA table_info(update_inbox)").fetchall()}: # Added later
+                cursor.execute("ALTER TABLE update_inbox ADD COLUMN taken INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_update_inbox_shard ON update_inbox (shard, id)")
+            # Named leases; the owner of the "jobs" lease is the only process running scheduled jobs
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL -- Unix time
+            )
+            ''')
+            # Sent user polls: which user, quiz item and correct option a poll id belongs to (pruned after a while)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS poll_index (
+                poll_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                item_key TEXT NOT NULL,
+                correct_option INTEGER NOT NULL,
+                sent_at REAL NOT NULL -- Unix time
+            ) WITHOUT ROWID
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_poll_index_sent_at ON poll_index (sent_at)")
+            # Quiz items by item_key (the outbox payload of the poll), stored once however often they are sent
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quiz_items (
+                item_key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL
+            ) WITHOUT ROWID
+            ''')
+            # One row per answered poll
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS poll_answers (
+                poll_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                item_key TEXT NOT NULL,
+                chosen_option INTEGER,
+                correct INTEGER NOT NULL, -- 0 or 1
+                answered_at REAL NOT NULL -- Unix time
+            ) WITHOUT ROWID
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_poll_answers_user ON poll_answers (user_id, answered_at)")
+            # Per-user totals, incremented as answers are recorded
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                answered INTEGER NOT NULL DEFAULT 0,
+                correct INTEGER NOT NULL DEFAULT 0,
+                last_answer_at REAL -- Unix time
+            )
+            ''')
+            # Spaced-repetition reviews of missed quiz items; the index lets each tick read only the due ones
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reviews (
+                user_id INTEGER NOT NULL,
+                item_key TEXT NOT NULL,
+                due_at REAL NOT NULL, -- Unix time
+                streak INTEGER NOT NULL DEFAULT 0, -- Right answers since the last wrong one
+                lapses INTEGER NOT NULL DEFAULT 0, -- Wrong answers
+                paused INTEGER NOT NULL DEFAULT 0, -- 1 while the user's daily puzzles are off
+                PRIMARY KEY (user_id, item_key)
+            ) WITHOUT ROWID
+            ''')
+            if "paused" not in {row[1] for row in cursor.execute("PRAGMA table_info(reviews)").fetchall()}: # Added later
+                cursor.execute("ALTER TABLE reviews ADD COLUMN paused INTEGER NOT NULL DEFAULT 0")
+                cursor.execute("UPDATE reviews SET paused = 1 WHERE user_id IN (SELECT user_id FROM users WHERE daily_puzzle = 0)")
+            cursor.execute("DROP INDEX IF EXISTS idx_reviews_due") # Replaced by the partial index below
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_reviews_due_active ON reviews (due_at, user_id) WHERE paused = 0")
+            logger.info("Database tables checked/created successfully.")
+        except sqlite3.Error as e:
+            logger.error(f"Error creating tables: {e}")
+
+    # --- Execution plumbing ---
+
+    def _reader_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._reader_lock:
+                self._reader_connections.append(conn)
+        return conn
+
+    def _run_read(self, fn: Callable, args: tuple):
+        return fn(self._reader_connection(), *args)
+
+    async def _read(self, fn: Callable, *args):
+        """Runs fn(conn, *args) on a reader thread. Timed in the metrics under the calling method's name."""
+        if not self.conn:
+            raise sqlite3.ProgrammingError("Database connection not established.")
+        with timed("db", sys._getframe(1).f_code.co_name):
+            return await asyncio.wrap_future(self._readers.submit(self._run_read, fn, args))
+
+    async def _write(self, fn: Callable, *args):
+        """
+        Queues fn(conn, *args) for the writer thread and waits until its transaction is committed.
+        Timed (including the wait for the group commit) under the calling method's name.
+        """
+        if not self.conn:
+            raise sqlite3.ProgrammingError("Database connection not established.")
+        with timed("db", sys._getframe(1).f_code.co_name):
+            future: Future = Future()
+            self._write_queue.put((fn, args, future))
+            return await asyncio.wrap_future(future)
+
+    def pending_writes(self) -> int:
+        """Writes queued for the writer thread and not yet picked up."""
+        return self._write_queue.qsize()
+
+    def _writer_loop(self):
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Group commit: everything already queued goes into the same transaction
+            while len(batch) < DB_WRITE_BATCH_MAX:
+                try:
+                    item = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write_queue.put(None) # Finish this batch, then stop
+                    break
+                batch.append(item)
+            try:
+                self._apply_batch(batch)
+            except Exception as e: # Keep the thread alive, or every later write would wait forever
+                logger.error(f"Database writer: unexpected error applying {len(batch)} writes: {e}", exc_info=True)
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _apply_batch(self, batch):
+        # Writes whose caller was cancelled while queued are dropped; the others can't be cancelled from now on
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        results = []
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for fn, args, future in batch:
+                # A savepoint per write, so one failing write doesn't undo the others
+                self.conn.execute("SAVEPOINT write_op")
+                try:
+                    results.append((future, fn(self.conn, *args), None))
+                    self.conn.execute("RELEASE write_op")
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO write_op")
+                    self.conn.execute("RELEASE write_op")
+                    results.append((future, None, e))
+            self.conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Database group commit of {len(batch)} writes failed: {e}")
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # --- Users ---
+
+    async def add_or_update_user(self,
+                                 user_id: int,
+                                 username: Optional[str] = None,
+                                 level: Optional[str] = None,
+                                 daily_puzzle: Optional[bool] = None,
+                                 delivery_minute: Optional[int] = None,
+                                 timezone: Optional[str] = None
+                                 ) -> bool:
+        try:
+            return await self._write(self._add_or_update_user, user_id, username, level, daily_puzzle, delivery_minute, timezone)
+        except sqlite3.IntegrityError as e:
+            logger.error(f"Integrity error for user {user_id} (Username: {username}): {e}. User might already exist or other constraint violation.")
+            return False
+        except sqlite3.Error as e:
+            logger.error(f"Database error for user {user_id} (Username: {username}): {e}")
+            return False
+
+    def _add_or_update_user(self, conn, user_id, username, level, daily_puzzle, delivery_minute=None, timezone=None) -> bool:
+        current_timestamp = datetime.datetime.now()
+        cursor = conn.cursor()
+
+        # Check if user exists
+        cursor.execute("SELECT id FROM users WHERE user_id = ?", (user_id,))
+        existing_user_row = cursor.fetchone()
+
+        if existing_user_row:  # User exists, update them
+            update_parts = []
+            params = []
+
+            if username is not None:
+                update_parts.append("username = ?")
+                params.append(username)
+            if level is not None:
+                update_parts.append("level = ?")
+                params.append(level)
+            if daily_puzzle is not None: # If a preference for daily_puzzle is explicitly passed
+                update_parts.append("daily_puzzle = ?")
+                params.append(1 if daily_puzzle else 0) # Convert boolean to 0 or 1
+                # Reviews are sent with the daily puzzles, so they pause and resume with them
+                cursor.execute("UPDATE reviews SET paused = ? WHERE user_id = ?", (0 if daily_puzzle else 1, user_id))
+            if delivery_minute is not None:
+                update_parts.append("delivery_minute = ?")
+                params.append(delivery_minute)
+            if timezone is not None:
+                update_parts.append("timezone = ?")
+                params.append(timezone)
+            if not update_parts:
+                cursor.execute("UPDATE users SET timestamp = ? WHERE user_id = ?",
+                                (current_timestamp, user_id))
+                logger.info(f"User {user_id} timestamp updated (no other fields provided for update).")
+            else:
+                update_parts.append("timestamp = ?")
+                params.append(current_timestamp)
+
+                set_clause = ", ".join(update_parts)
+                params.append(user_id)  # For the WHERE clause
+
+                sql_update_query = f"UPDATE users SET {set_clause} WHERE user_id = ?"
+                cursor.execute(sql_update_query, tuple(params))
+                updated_fields_log = [part.split(' ')[0] for part in update_parts] # e.g., ['username', 'level', 'timestamp']
+                logger.info(f"User {user_id} updated. Fields: {updated_fields_log}.")
+
+        else:  # New user, insert them
+            # 1 = True/ 0 = False
+            daily_puzzle_value_to_insert = 1 # Default to True for new users if not specified
+            if daily_puzzle is not None:
+                daily_puzzle_value_to_insert = 1 if daily_puzzle else 0
+
+            cursor.execute('''
+                INSERT INTO users (user_id, username, level, timestamp, daily_puzzle, delivery_minute, timezone)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, username, level, current_timestamp, daily_puzzle_value_to_insert, delivery_minute, timezone))
+            if not daily_puzzle_value_to_insert: # Reviews recorded before the user row existed
+                cursor.execute("UPDATE reviews SET paused = 1 WHERE user_id = ?", (user_id,))
+            logger.info(f"User {username} (ID: {user_id}) added with level {level}, daily_puzzle set to {bool(daily_puzzle_value_to_insert)}.")
+        return True
+
+    async def touch_users(self, last_seen: Dict[int, datetime.datetime]) -> bool:
+        """Sets the timestamp of many users at once, adding users that don't exist yet."""
+        rows = list(last_seen.items())
+        def write(conn):
+            conn.executemany('''
+                INSERT INTO users (user_id, timestamp) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET timestamp = excluded.timestamp
+            ''', rows)
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error updating timestamps for {len(rows)} users: {e}")
+            return False
+
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Retrieves all data for a user by their user_id."""
+        try:
+            user_data = await self._read(self._get_user, user_id)
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching user {user_id}: {e}")
+            return None
+        if user_data:
+            logger.debug(f"User data found for user_id {user_id}: {user_data}")
+        else:
+            logger.info(f"No user found with user_id {user_id}.")
+        return user_data
+
+    def _get_user(self, conn, user_id) -> Optional[Dict[str, Any]]:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, user_id, username, level, timestamp, daily_puzzle, delivery_minute, timezone FROM users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        # Get column names from cursor.description
+        columns = [description[0] for description in cursor.description]
+        return _user_row_to_dict(columns, row)
+
+    async def get_users_with_daily_puzzle_enabled(self) -> List[Dict[str, Any]]:
+        """Retrieves all users who have the daily_puzzle preference set to True (1)."""
+        try:
+            users_list = await self._read(self._get_users_with_daily_puzzle_enabled)
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching users with daily puzzle enabled: {e}")
+            return [] # Return an empty list in case of an error
+        logger.debug(f"Found {len(users_list)} users with daily puzzle enabled.")
+        return users_list
+
+    def _get_users_with_daily_puzzle_enabled(self, conn) -> List[Dict[str, Any]]:
+        cursor = conn.cursor()
+        # Select all columns for users where daily_puzzle is 1 (True)
+        cursor.execute("""
+            SELECT id, user_id, username, level, timestamp, daily_puzzle
+            FROM users
+            WHERE daily_puzzle = 1
+        """)
+        columns = [description[0] for description in cursor.description]
+        return [_user_row_to_dict(columns, row) for row in cursor.fetchall()]
+
+    async def iter_daily_puzzle_users(self, page_size: int = BROADCAST_PAGE_SIZE) -> AsyncIterator[DailyRecipient]:
+        """
+        Streams users with daily_puzzle enabled, ordered by user_id, one page at a time (keyset pagination),
+        so a broadcast can start after the first page instead of after a full scan.
+        """
+        last_user_id = None
+        while True:
+            try:
+                rows = await self._read(self._get_daily_puzzle_users_page, last_user_id, page_size)
+            except sqlite3.Error as e:
+                logger.error(f"Error fetching users with daily puzzle enabled after user {last_user_id}: {e}")
+                return
+            for row in rows:
+                yield DailyRecipient(*row)
+            if len(rows) < page_size:
+                return
+            last_user_id = rows[-1][0]
+
+    def _get_daily_puzzle_users_page(self, conn, last_user_id, page_size) -> List[tuple]:
+        # Chats that blocked the bot are skipped (a primary key lookup per row)
+        if last_user_id is None:
+            return conn.execute(
+                "SELECT user_id, level FROM users WHERE daily_puzzle = 1 "
+                "AND user_id NOT IN (SELECT chat_id FROM blocked_chats) ORDER BY user_id LIMIT ?",
+                (page_size,)).fetchall()
+        return conn.execute(
+            "SELECT user_id, level FROM users WHERE daily_puzzle = 1 AND user_id > ? "
+            "AND user_id NOT IN (SELECT chat_id FROM blocked_chats) ORDER BY user_id LIMIT ?",
+            (last_user_id, page_size)).fetchall()
+
+    async def get_delivery_timezones(self) -> List[Optional[str]]:
+        """Distinct timezones of users with daily_puzzle enabled (None for users on the default timezone)."""
+        try:
+            return await self._read(lambda conn: [row[0] for row in conn.execute(
+                "SELECT DISTINCT timezone FROM users WHERE daily_puzzle = 1")])
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching delivery timezones: {e}")
+            return [None]
+
+    async def get_delivery_bucket_users(self, timezone: Optional[str], minute: int, include_unset: bool = False) -> List[DailyRecipient]:
+        """
+        Users with daily_puzzle enabled whose delivery time in `timezone` (None = default timezone) is
+        `minute` (after local midnight); with include_unset also those who never set a time.
+        Blocked chats are skipped. Reads only the bucket, through idx_users_delivery.
+        """
+        def read(conn):
+            rows = []
+            for delivery_minute in ([minute, None] if include_unset else [minute]):
+                rows += conn.execute(
+                    "SELECT user_id, level FROM users WHERE daily_puzzle = 1 AND timezone IS ? AND delivery_minute IS ? "
+                    "AND user_id NOT IN (SELECT chat_id FROM blocked_chats)",
+                    (timezone, delivery_minute)).fetchall()
+            return [DailyRecipient(*row) for row in rows]
+        try:
+            return await self._read(read)
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching delivery bucket {timezone}/{minute}: {e}")
+            return []
+
+    async def get_daily_puzzle_levels(self) -> List[str]:
+        """Distinct levels of users with daily_puzzle enabled ('' for users without a level)."""
+        try:
+            return await self._read(lambda conn: sorted({row[0] or '' for row in conn.execute(
+                "SELECT DISTINCT level FROM users WHERE daily_puzzle = 1")}))
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching daily puzzle levels: {e}")
+            return []
+
+    async def get_all_user_ids(self) -> List[int]:
+        """Retrieves all user_ids from the database."""
+        try:
+            user_ids = await self._read(lambda conn: [row[0] for row in conn.execute("SELECT user_id FROM users")])
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching all user IDs: {e}")
+            return []
+        logger.debug(f"Retrieved {len(user_ids)} user IDs.")
+        return user_ids
+
+    # --- Quiz cache / phrase items ---
+
+    async def get_cached_quiz(self, cache_key: str, max_age: Optional[datetime.timedelta] = None) -> Optional[str]:
+        """Returns the cached AI response JSON for cache_key, or None if missing/expired."""
+        def read(conn):
+            if max_age is not None:
+                row = conn.execute("SELECT response FROM quiz_cache WHERE cache_key = ? AND timestamp >= ?",
+                                   (cache_key, datetime.datetime.now() - max_age)).fetchone()
+            else:
+                row = conn.execute("SELECT response FROM quiz_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+            return row[0] if row else None
+        try:
+            return await self._read(read)
+        except sqlite3.Error as e:
+            logger.error(f"Error reading quiz cache entry {cache_key}: {e}")
+            return None
+
+    async def save_cached_quiz(self, cache_key: str, prompt_version: str, level: Optional[str], input_text: str, response: str) -> bool:
+        """Stores (or replaces) an AI response in the quiz cache."""
+        def write(conn):
+            conn.execute('''
+                INSERT OR REPLACE INTO quiz_cache (cache_key, prompt_version, level, input_text, response, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (cache_key, prompt_version, level, input_text, response, datetime.datetime.now()))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing quiz cache entry {cache_key}: {e}")
+            return False
+
+    async def delete_quiz_cache(self, keep_prompt_version: Optional[str] = None) -> int:
+        """
+        Deletes cached quizzes and stored phrase items.
+        If keep_prompt_version is given, only entries of other prompt versions are removed.
+        """
+        def write(conn):
+            removed = 0
+            for table in ("quiz_cache", "phrase_items"):
+                if keep_prompt_version is not None:
+                    cursor = conn.execute(f"DELETE FROM {table} WHERE prompt_version != ?", (keep_prompt_version,))
+                else:
+                    cursor = conn.execute(f"DELETE FROM {table}")
+                removed += cursor.rowcount
+            return removed
+        try:
+            removed = await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error clearing quiz cache: {e}")
+            return 0
+        logger.info(f"Removed {removed} quiz cache entries.")
+        return removed
+
+    async def get_phrase_items(self, phrases: List[str], level: str, prompt_version: str) -> Dict[str, str]:
+        """Returns {phrase: item JSON} for the given phrases that already have a stored quiz item."""
+        if not phrases:
+            return {}
+        placeholders = ", ".join("?" for _ in phrases)
+        def read(conn):
+            return dict(conn.execute(f'''
+                SELECT phrase, item FROM phrase_items
+                WHERE level = ? AND prompt_version = ? AND phrase IN ({placeholders})
+            ''', (level, prompt_version, *phrases)).fetchall())
+        try:
+            return await self._read(read)
+        except sqlite3.Error as e:
+            logger.error(f"Error reading phrase items for level {level}: {e}")
+            return {}
+
+    async def save_phrase_items(self, items: Dict[str, str], level: str, prompt_version: str) -> bool:
+        """Stores (or replaces) quiz items given as {phrase: item JSON}."""
+        if not items:
+            return True
+        current_timestamp = datetime.datetime.now()
+        def write(conn):
+            conn.executemany('''
+                INSERT OR REPLACE INTO phrase_items (phrase, level, prompt_version, item, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(phrase, level, prompt_version, item, current_timestamp) for phrase, item in items.items()])
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing phrase items for level {level}: {e}")
+            return False
+
+    # --- Broadcast runs ---
+
+    async def start_broadcast_run(self, run_id: str, payload: str) -> bool:
+        """Registers a broadcast run with its payload. Does nothing if the run already exists."""
+        def write(conn):
+            conn.execute("INSERT OR IGNORE INTO broadcast_runs (run_id, payload, started_at) VALUES (?, ?, ?)",
+                         (run_id, payload, datetime.datetime.now()))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error starting broadcast run {run_id}: {e}")
+            return False
+
+    async def get_broadcast_run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the run's payload and timestamps, or None if the run was never started."""
+        def read(conn):
+            cursor = conn.execute("SELECT run_id, payload, started_at, finished_at FROM broadcast_runs WHERE run_id = ?", (run_id,))
+            row = cursor.fetchone()
+            if row:
+                columns = [description[0] for description in cursor.description]
+                return dict(zip(columns, row))
+            return None
+        try:
+            return await self._read(read)
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching broadcast run {run_id}: {e}")
+            return None
+
+    async def get_unfinished_broadcast_run_ids(self) -> List[str]:
+        """Returns the ids of runs that were started but never finished (e.g. interrupted by a restart)."""
+        try:
+            return await self._read(lambda conn: [row[0] for row in conn.execute(
+                "SELECT run_id FROM broadcast_runs WHERE finished_at IS NULL ORDER BY started_at")])
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching unfinished broadcast runs: {e}")
+            return []
+
+    async def finish_broadcast_run(self, run_id: str) -> bool:
+        def write(conn):
+            conn.execute("UPDATE broadcast_runs SET finished_at = ? WHERE run_id = ?", (datetime.datetime.now(), run_id))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error finishing broadcast run {run_id}: {e}")
+            return False
+
+    async def get_broadcast_sent_chat_ids(self, run_id: str) -> set:
+        """Returns the chat ids that already received this run's broadcast."""
+        try:
+            return await self._read(lambda conn: {row[0] for row in conn.execute(
+                "SELECT chat_id FROM broadcast_progress WHERE run_id = ?", (run_id,))})
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching broadcast progress for {run_id}: {e}")
+            return set()
+
+    async def mark_broadcast_sent(self, run_id: str, chat_ids: List[int]) -> bool:
+        """Records that the given chats received this run's broadcast."""
+        current_timestamp = datetime.datetime.now()
+        rows = [(run_id, chat_id, current_timestamp) for chat_id in chat_ids]
+        def write(conn):
+            conn.executemany("INSERT OR IGNORE INTO broadcast_progress (run_id, chat_id, timestamp) VALUES (?, ?, ?)", rows)
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error recording broadcast progress for {run_id}: {e}")
+            return False
+
+    async def prune_broadcast_progress(self, max_age: datetime.timedelta) -> int:
+        """Deletes progress rows older than max_age, except those of unfinished runs (still needed to resume them)."""
+        cutoff = datetime.datetime.now() - max_age
+        def write(conn):
+            return conn.execute('''
+                DELETE FROM broadcast_progress
+                WHERE timestamp < ? AND run_id NOT IN (SELECT run_id FROM broadcast_runs WHERE finished_at IS NULL)
+            ''', (cutoff,)).rowcount
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error pruning broadcast progress: {e}")
+            return 0
+
+    # --- Channel posts ---
+
+    async def is_channel_poll_posted(self, content_hash: str) -> bool:
+        try:
+            return await self._read(lambda conn: conn.execute(
+                "SELECT 1 FROM channel_posts WHERE content_hash = ?", (content_hash,)).fetchone() is not None)
+        except sqlite3.Error as e:
+            logger.error(f"Error checking channel post {content_hash}: {e}")
+            return False
+
+    async def mark_channel_poll_posted(self, content_hash: str) -> bool:
+        def write(conn):
+            conn.execute("INSERT OR IGNORE INTO channel_posts (content_hash, timestamp) VALUES (?, ?)",
+                         (content_hash, datetime.datetime.now()))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error recording channel post {content_hash}: {e}")
+            return False
+
+    async def prune_channel_posts(self, max_age: datetime.timedelta) -> int:
+        """Forgets channel posts older than max_age; the same poll may then be posted again."""
+        cutoff = datetime.datetime.now() - max_age
+        def write(conn):
+            return conn.execute("DELETE FROM channel_posts WHERE timestamp < ?", (cutoff,)).rowcount
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error pruning channel posts: {e}")
+            return 0
+
+    # --- Puzzle bank ---
+
+    async def add_puzzles(self, items: List[Dict[str, Any]], level: str = '', source: Optional[str] = None) -> int:
+        """Appends quiz items to the puzzle bank queue of `level`. Returns how many were added."""
+        try:
+            return await self._write(self._add_puzzles, items, level, source)
+        except sqlite3.Error as e:
+            logger.error(f"Error adding {len(items)} puzzles for level '{level}': {e}")
+            return 0
+
+    def _add_puzzles(self, conn, items, level, source) -> int:
+        current_timestamp = datetime.datetime.now()
+        conn.executemany('''
+            INSERT INTO puzzle_bank (level, question_type, item, source, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(level or '', item.get('question_type'), json.dumps(item, ensure_ascii=False), source, current_timestamp)
+              for item in items])
+        return len(items)
+
+    async def import_puzzles(self, items: List[Dict[str, Any]], source: str, level: str = '') -> int:
+        """
+        One-time import of puzzles from `source` (e.g. a puzzles.json path).
+        Returns the number of imported items, or 0 if this source was imported before.
+        """
+        def write(conn):
+            if conn.execute("SELECT 1 FROM puzzle_bank_imports WHERE source = ?", (source,)).fetchone():
+                return 0
+            count = self._add_puzzles(conn, items, level, source)
+            conn.execute("INSERT INTO puzzle_bank_imports (source, item_count, timestamp) VALUES (?, ?, ?)",
+                         (source, count, datetime.datetime.now()))
+            return count
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error importing puzzles from {source}: {e}")
+            return 0
+
+    async def dequeue_puzzles(self, count: int, level: str = '') -> List[Dict[str, Any]]:
+        """
+        Takes the next `count` unconsumed puzzles of `level` and advances its cursor, in one transaction.
+        Cost depends only on `count`, not on the size of the bank.
+        """
+        def write(conn):
+            row = conn.execute("SELECT last_id FROM puzzle_bank_cursor WHERE level = ?", (level,)).fetchone()
+            last_id = row[0] if row else 0
+            rows = conn.execute("SELECT id, item FROM puzzle_bank WHERE level = ? AND id > ? ORDER BY id LIMIT ?",
+                                (level, last_id, count)).fetchall()
+            if rows:
+                conn.execute('''
+                    INSERT INTO puzzle_bank_cursor (level, last_id) VALUES (?, ?)
+                    ON CONFLICT(level) DO UPDATE SET last_id = excluded.last_id
+                ''', (level, rows[-1][0]))
+            return [json.loads(item) for _, item in rows]
+        try:
+            puzzles = await self._write(write)
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logger.error(f"Error taking puzzles from the bank for level '{level}': {e}")
+            return []
+        logger.debug(f"Took {len(puzzles)} puzzles from the bank for level '{level}'.")
+        return puzzles
+
+    async def get_recent_puzzle_phrases(self, level: str, limit: int = 100) -> List[str]:
+        """Phrases of the most recently added puzzles of `level`, used to avoid generating repeats."""
+        def read(conn):
+            return [row[0] for row in conn.execute('''
+                SELECT json_extract(item, '$.phrase') FROM puzzle_bank
+                WHERE level = ? AND json_extract(item, '$.phrase') IS NOT NULL
+                ORDER BY id DESC LIMIT ?
+            ''', (level, limit))]
+        try:
+            return await self._read(read)
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching recent puzzle phrases for level '{level}': {e}")
+            return []
+
+    async def count_available_puzzles(self, level: str = '') -> int:
+        """Number of puzzles of `level` that have not been consumed yet."""
+        def read(conn):
+            return conn.execute('''
+                SELECT COUNT(*) FROM puzzle_bank
+                WHERE level = ? AND id > IFNULL((SELECT last_id FROM puzzle_bank_cursor WHERE level = ?), 0)
+            ''', (level, level)).fetchone()[0]
+        try:
+            return await self._read(read)
+        except sqlite3.Error as e:
+            logger.error(f"Error counting puzzles for level '{level}': {e}")
+            return 0
+
+    # --- Outbox ---
+
+    async def enqueue_outbox(self, chat_id: int, method: str, payload: str, idempotency_key: Optional[str] = None,
+                             not_before: Optional[float] = None) -> bool:
+        """
+        Queues a send, due at not_before (Unix time) or right away. Returns False if a message with the same idempotency key was queued before,
+        or if the chat has blocked the bot.
+        """
+        def write(conn):
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO outbox (idempotency_key, chat_id, method, payload, next_attempt_at, timestamp)
+                SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM blocked_chats WHERE chat_id = ?)
+            ''', (idempotency_key, chat_id, method, payload, not_before or time.time(), datetime.datetime.now(), chat_id))
+            return cursor.rowcount > 0
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error queueing {method} for chat {chat_id}: {e}")
+            return False
+
+    async def claim_due_outbox(self, limit: int, lease_seconds: float) -> List[OutboxMessage]:
+        """
+        Takes up to `limit` due pending rows, oldest first, and pushes their next attempt `lease_seconds`
+        ahead, so they are not claimed again while being sent (or are retried if the process dies).
+        """
+        def write(conn):
+            now = time.time()
+            rows = conn.execute('''
+                SELECT id, chat_id, method, payload, attempts FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?", [(now + lease_seconds, row[0]) for row in rows])
+            return [OutboxMessage(*row) for row in rows]
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error claiming outbox messages: {e}")
+            return []
+
+    async def release_outbox(self, message_ids: List[int]) -> bool:
+        """Makes claimed rows that were never attempted due again right away (e.g. on shutdown)."""
+        def write(conn):
+            now = time.time()
+            conn.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ? AND status = 'pending'",
+                             [(now, message_id) for message_id in message_ids])
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error releasing {len(message_ids)} outbox messages: {e}")
+            return False
+
+    async def get_next_outbox_attempt(self) -> Optional[float]:
+        """Unix time at which the next pending row becomes due, or None if nothing is pending."""
+        try:
+            return await self._read(lambda conn: conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()[0])
+        except sqlite3.Error as e:
+            logger.error(f"Error reading the next outbox attempt: {e}")
+            return None
+
+    async def mark_outbox_sent(self, message_id: int) -> bool:
+        def write(conn):
+            conn.execute("UPDATE outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL WHERE id = ?", (message_id,))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error marking outbox message {message_id} as sent: {e}")
+            return False
+
+    async def retry_outbox_later(self, message_id: int, next_attempt_at: float, error: str) -> bool:
+        def write(conn):
+            conn.execute("UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                         (next_attempt_at, error, message_id))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error rescheduling outbox message {message_id}: {e}")
+            return False
+
+    async def mark_outbox_dead(self, message_id: int, error: str) -> bool:
+        """Gives up on one message (kept with status 'dead' for inspection)."""
+        def write(conn):
+            conn.execute("UPDATE outbox SET status = 'dead', attempts = attempts + 1, last_error = ? WHERE id = ?", (error, message_id))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error dead-lettering outbox message {message_id}: {e}")
+            return False
+
+    async def block_chat(self, chat_id: int, reason: str) -> int:
+        """Records that a chat blocked the bot and dead-letters everything still pending for it. Returns that count."""
+        def write(conn):
+            conn.execute('''
+                INSERT INTO blocked_chats (chat_id, reason, timestamp) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET reason = excluded.reason, timestamp = excluded.timestamp
+            ''', (chat_id, reason, datetime.datetime.now()))
+            return conn.execute("UPDATE outbox SET status = 'dead', last_error = ? WHERE chat_id = ? AND status = 'pending'",
+                                (reason, chat_id)).rowcount
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error blocking chat {chat_id}: {e}")
+            return 0
+
+    async def unblock_chat(self, chat_id: int) -> bool:
+        """Called when a blocked chat talks to the bot again."""
+        def write(conn):
+            return conn.execute("DELETE FROM blocked_chats WHERE chat_id = ?", (chat_id,)).rowcount > 0
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error unblocking chat {chat_id}: {e}")
+            return False
+
+    async def count_outbox(self) -> Dict[str, int]:
+        """Number of outbox rows per status."""
+        try:
+            return await self._read(lambda conn: dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()))
+        except sqlite3.Error as e:
+            logger.error(f"Error counting outbox messages: {e}")
+            return {}
+
+    async def prune_outbox(self, max_age: datetime.timedelta) -> int:
+        """Deletes sent and dead rows older than max_age (their idempotency keys are forgotten)."""
+        cutoff = datetime.datetime.now() - max_age
+        def write(conn):
+            return conn.execute("DELETE FROM outbox WHERE status != 'pending' AND timestamp < ?", (cutoff,)).rowcount
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error pruning the outbox: {e}")
+            return 0
+
+    # --- Poll answers ---
+
+    async def add_poll_index(self, entries: List[tuple], items: Dict[str, str]) -> bool:
+        """
+        Stores sent polls, as (poll_id, user_id, item_key, correct_option, sent_at) tuples,
+        and the payloads of their quiz items by item_key.
+        """
+        def write(conn):
+            conn.executemany("INSERT OR IGNORE INTO quiz_items (item_key, payload) VALUES (?, ?)", list(items.items()))
+            conn.executemany('''
+                INSERT OR REPLACE INTO poll_index (poll_id, user_id, item_key, correct_option, sent_at) VALUES (?, ?, ?, ?, ?)
+            ''', entries)
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error storing {len(entries)} sent polls: {e}")
+            return False
+
+    async def record_poll_answers(self, answers: List[PollAnswer]) -> Tuple[List[AnsweredItem], List[PollAnswer]]:
+        """
+        Records a batch of answers in one transaction and adds them to the users' totals.
+        Returns the answers counted, and those whose poll is not in the poll index (yet).
+        Repeated answers and answers by someone other than the poll's user (a forwarded poll) are ignored.
+        """
+        def write(conn):
+            counted: List[AnsweredItem] = []
+            unmatched: List[PollAnswer] = []
+            totals: Dict[int, list] = {}
+            for answer in answers:
+                row = conn.execute("SELECT user_id, item_key, correct_option FROM poll_index WHERE poll_id = ?", (answer.poll_id,)).fetchone()
+                if row is None:
+                    unmatched.append(answer)
+                    continue
+                user_id, item_key, correct_option = row
+                if user_id != answer.user_id:
+                    continue
+                correct = answer.option == correct_option
+                inserted = conn.execute('''
+                    INSERT OR IGNORE INTO poll_answers (poll_id, user_id, item_key, chosen_option, correct, answered_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (answer.poll_id, user_id, item_key, answer.option, int(correct), answer.answered_at)).rowcount
+                if inserted:
+                    counted.append(AnsweredItem(user_id, item_key, correct, answer.answered_at))
+                    total = totals.setdefault(user_id, [0, 0, 0.0])
+                    total[0] += 1
+                    total[1] += int(correct)
+                    total[2] = max(total[2], answer.answered_at)
+            conn.executemany('''
+                INSERT INTO user_stats (user_id, answered, correct, last_answer_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    answered = user_stats.answered + excluded.answered,
+                    correct = user_stats.correct + excluded.correct,
+                    last_answer_at = MAX(COALESCE(user_stats.last_answer_at, 0), excluded.last_answer_at)
+            ''', [(user_id, *total) for user_id, total in totals.items()])
+            return counted, unmatched
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error recording {len(answers)} poll answers: {e}")
+            return [], list(answers) # Tried again with the next batch
+
+    async def get_user_stats(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """The user's answer totals (answered, correct, last_answer_at), or None before their first answer."""
+        def read(conn):
+            row = conn.execute("SELECT answered, correct, last_answer_at FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+            return dict(zip(("answered", "correct", "last_answer_at"), row)) if row else None
+        try:
+            return await self._read(read)
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching answer stats for user {user_id}: {e}")
+            return None
+
+    async def prune_poll_index(self, max_age: datetime.timedelta) -> int:
+        """Forgets polls sent more than max_age ago; later answers to them are not counted."""
+        cutoff = time.time() - max_age.total_seconds()
+        def write(conn):
+            return conn.execute("DELETE FROM poll_index WHERE sent_at < ?", (cutoff,)).rowcount
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error pruning the poll index: {e}")
+            return 0
+
+    # --- Reviews (spaced repetition) ---
+
+    async def update_reviews(self, answered: List[AnsweredItem], intervals_hours: List[float]) -> int:
+        """
+        Reschedules reviews from counted answers. A wrong answer (re)starts the item's review at the
+        first interval; a right answer to an item under review moves it to the next interval, and
+        past the last one the item is learned and its review is deleted. Right answers to items that
+        were never missed don't create reviews. Returns the number of reviews changed.
+        """
+        def write(conn):
+            changed = 0
+            for item in answered:
+                if not item.correct:
+                    conn.execute('''
+                        INSERT INTO reviews (user_id, item_key, due_at, streak, lapses, paused)
+                        VALUES (?, ?, ?, 0, 1, NOT EXISTS (SELECT 1 FROM users WHERE user_id = ? AND daily_puzzle = 1))
+                        ON CONFLICT(user_id, item_key) DO UPDATE SET due_at = excluded.due_at, streak = 0, lapses = reviews.lapses + 1
+                    ''', (item.user_id, item.item_key, item.answered_at + intervals_hours[0] * 3600, item.user_id))
+                    changed += 1
+                    continue
+                row = conn.execute("SELECT streak FROM reviews WHERE user_id = ? AND item_key = ?", (item.user_id, item.item_key)).fetchone()
+                if row is None:
+                    continue
+                streak = row[0] + 1
+                if streak >= len(intervals_hours):
+                    conn.execute("DELETE FROM reviews WHERE user_id = ? AND item_key = ?", (item.user_id, item.item_key))
+                else:
+                    conn.execute("UPDATE reviews SET due_at = ?, streak = ? WHERE user_id = ? AND item_key = ?",
+                                 (item.answered_at + intervals_hours[streak] * 3600, streak, item.user_id, item.item_key))
+                changed += 1
+            return changed
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error updating reviews for {len(answered)} answers: {e}")
+            return 0
+
+    async def take_due_reviews(self, limit: int, per_user: int, resend_seconds: float) -> List[DueReview]:
+        """
+        Claims up to `limit` due reviews (oldest first, through the partial (due_at, user_id) index of
+        reviews that aren't paused) by moving them resend_seconds ahead, so an unanswered review comes back
+        later instead of next tick. Returns at most `per_user` reviews per user with the item's poll payload;
+        the user's other claimed reviews wait for their new due time. Reviews of users with daily puzzles
+        off are paused and not read here; due reviews whose quiz item is gone are deleted.
+        """
+        now = time.time()
+        def write(conn):
+            conn.execute('''
+                DELETE FROM reviews
+                WHERE paused = 0 AND due_at <= ? AND NOT EXISTS (SELECT 1 FROM quiz_items q WHERE q.item_key = reviews.item_key)
+            ''', (now,))
+            rows = conn.execute('''
+                SELECT r.user_id, r.item_key, q.payload
+                FROM reviews r
+                JOIN quiz_items q ON q.item_key = r.item_key
+                WHERE r.paused = 0 AND r.due_at <= ?
+                ORDER BY r.due_at
+                LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany("UPDATE reviews SET due_at = ? WHERE user_id = ? AND item_key = ?",
+                             [(now + resend_seconds, user_id, item_key) for user_id, item_key, _ in rows])
+            due: List[DueReview] = []
+            taken: Dict[int, int] = {}
+            for user_id, item_key, payload in rows:
+                if taken.get(user_id, 0) >= per_user:
+                    continue
+                taken[user_id] = taken.get(user_id, 0) + 1
+                due.append(DueReview(user_id, item_key, payload))
+            return due
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error taking due reviews: {e}")
+            return []
+
+    async def count_due_reviews(self) -> int:
+        try:
+            return await self._read(lambda conn: conn.execute("SELECT COUNT(*) FROM reviews WHERE paused = 0 AND due_at <= ?", (time.time(),)).fetchone()[0])
+        except sqlite3.Error as e:
+            logger.error(f"Error counting due reviews: {e}")
+            return 0
+
+    # --- Multi-process: update inbox and leases ---
+
+    async def add_inbox_update(self, shard: int, payload: str) -> bool:
+        def write(conn):
+            conn.execute("INSERT INTO update_inbox (shard, payload, timestamp) VALUES (?, ?, ?)",
+                         (shard, payload, datetime.datetime.now()))
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error storing update for shard {shard}: {e}")
+            return False
+
+    async def take_inbox_updates(self, shard: int, limit: int) -> List[Tuple[int, str]]:
+        """
+        Claims the oldest `limit` unclaimed updates of a shard and returns them as (id, payload), in
+        arrival order. They stay in the table until delete_inbox_updates, so a crash doesn't lose them.
+        """
+        def write(conn):
+            rows = conn.execute('''
+                UPDATE update_inbox SET taken = 1
+                WHERE id IN (SELECT id FROM update_inbox WHERE shard = ? AND taken = 0 ORDER BY id LIMIT ?)
+                RETURNING id, payload
+            ''', (shard, limit)).fetchall()
+            return sorted(rows)
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error taking updates for shard {shard}: {e}")
+            return []
+
+    async def delete_inbox_updates(self, update_ids: List[int]) -> bool:
+        """Removes handled updates from the inbox."""
+        def write(conn):
+            conn.executemany("DELETE FROM update_inbox WHERE id = ?", [(update_id,) for update_id in update_ids])
+            return True
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error deleting {len(update_ids)} handled inbox updates: {e}")
+            return False
+
+    async def release_inbox_updates(self, shard: int) -> int:
+        """Unclaims a shard's updates (called when its worker starts: the previous one may have died before handling them)."""
+        def write(conn):
+            return conn.execute("UPDATE update_inbox SET taken = 0 WHERE shard = ? AND taken = 1", (shard,)).rowcount
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error releasing updates of shard {shard}: {e}")
+            return 0
+
+    async def count_inbox(self) -> Dict[int, int]:
+        """Updates waiting per shard."""
+        try:
+            return await self._read(lambda conn: dict(conn.execute("SELECT shard, COUNT(*) FROM update_inbox GROUP BY shard").fetchall()))
+        except sqlite3.Error as e:
+            logger.error(f"Error counting inbox updates: {e}")
+            return {}
+
+    async def acquire_lease(self, name: str, owner: str, ttl_seconds: float) -> bool:
+        """Takes or renews the lease `name` for `owner`. Fails while another owner holds an unexpired lease."""
+        def write(conn):
+            now = time.time()
+            conn.execute('''
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            ''', (name, owner, now + ttl_seconds, now))
+            return conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0] == owner
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error acquiring lease {name}: {e}")
+            return False
+
+    async def release_lease(self, name: str, owner: str) -> bool:
+        def write(conn):
+            return conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)).rowcount > 0
+        try:
+            return await self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Error releasing lease {name}: {e}")
+            return False
+
+    async def ping(self) -> bool:
+        """True if a reader can query the database (used by the health check)."""
+        try:
+            return await self._read(lambda conn: conn.execute("SELECT 1").fetchone()[0] == 1)
+        except sqlite3.Error as e:
+            logger.error(f"Database health check failed: {e}")
+            return False
+
+    def close_connection(self):
+        """Flushes pending writes, stops the worker threads and closes all connections."""
+        if not self.conn:
+            logger.info("No active database connection to close.")
+            return
+        self._write_queue.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        try:
+            for conn in self._reader_connections:
+                conn.close()
+            self.conn.close()
+            self.conn = None
+            logger.info("Database connection closed.")
+        except sqlite3.Error as e:
+            logger.error(f"Error closing database connection: {e}")
+
+
+def _user_row_to_dict(columns: List[str], row: tuple) -> Dict[str, Any]:
+    user_data = dict(zip(columns, row))
+    # Convert daily_puzzle from 0/1 to True/False for easier use in Python
+    if user_data.get('daily_puzzle') is not None:
+        user_data['daily_puzzle'] = bool(user_data['daily_puzzle'])
+    else: # Handle case where it might be NULL if not properly defaulted or if schema was manually altered
+        user_data['daily_puzzle'] = True # Default to True if NULL for some reason
+    return user_data
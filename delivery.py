@@ -0,0 +1,126 @@
+import datetime
+import time
+import zlib
+from typing import Dict, List, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from config import (
+    logger,
+    DAILY_DELIVERY_TIME,
+    DEFAULT_TIMEZONE,
+    DELIVERY_JITTER_MINUTES,
+    DELIVERY_CATCHUP_MINUTES
+)
+from database import DailyRecipient
+
+TIMEZONE_CACHE_SECONDS = 600
+
+
+def parse_delivery_time(text: str) -> Optional[int]:
+    """"HH:MM" as minutes after midnight, or None if it isn't a valid time of day."""
+    try:
+        parsed = datetime.datetime.strptime(text.strip(), "%H:%M")
+    except ValueError:
+        return None
+    return parsed.hour * 60 + parsed.minute
+
+
+def format_delivery_time(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def get_timezone(name: Optional[str]) -> Optional[datetime.tzinfo]:
+    """The IANA timezone `name`, or None (server time) for an empty name. Raises ValueError for unknown names."""
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"Unknown timezone: {name}") from e
+
+
+class DeliveryScheduler:
+    """
+    Splits the daily puzzle delivery into minute buckets. Each user has a delivery time in their
+    own timezone (DAILY_DELIVERY_TIME in DEFAULT_TIMEZONE unless they chose one), so every minute
+    only the users whose local time matches are due. due_recipients() returns the users of every
+    bucket since the previous call (at most catchup_minutes back, e.g. after a restart or when the
+    jobs lease moves), with one indexed query per timezone in use and bucket, grouped by their local
+    date. open_since() is the oldest local date that may still have users due.
+    jitter_seconds() spreads each bucket's sends over jitter_minutes, the same offset for a user every day.
+    """
+
+    def __init__(self,
+                 db_manager,
+                 default_time: str = DAILY_DELIVERY_TIME,
+                 default_timezone: str = DEFAULT_TIMEZONE,
+                 jitter_minutes: float = DELIVERY_JITTER_MINUTES,
+                 catchup_minutes: int = DELIVERY_CATCHUP_MINUTES):
+        self.db_manager = db_manager
+        self.default_minute = parse_delivery_time(default_time)
+        if self.default_minute is None:
+            raise ValueError(f"DAILY_DELIVERY_TIME must be HH:MM, got '{default_time}'")
+        self.default_timezone = get_timezone(default_timezone)
+        self.jitter_seconds_max = jitter_minutes * 60
+        self.catchup_minutes = catchup_minutes
+        self._last_bucket: Optional[int] = None # Unix minute of the last bucket dispatched
+        self._timezones: List[Optional[str]] = []
+        self._timezones_at = 0.0
+
+    async def due_recipients(self, now: Optional[float] = None) -> Dict[datetime.date, List[DailyRecipient]]:
+        """Users whose delivery minute came up since the previous call (each user at most once), by their local date."""
+        current = int((now or time.time()) // 60)
+        first = current - self.catchup_minutes
+        if self._last_bucket is not None:
+            first = max(first, self._last_bucket + 1)
+        timezones = await self._get_timezones()
+
+        recipients = {}
+        for bucket in range(first, current + 1):
+            moment = datetime.datetime.fromtimestamp(bucket * 60, datetime.timezone.utc)
+            for name in timezones:
+                try:
+                    local = moment.astimezone(get_timezone(name) if name else self.default_timezone)
+                except ValueError:
+                    continue # Stored before the name became unknown to this system's tz database
+                minute = local.hour * 60 + local.minute
+                for recipient in await self.db_manager.get_delivery_bucket_users(name, minute, include_unset=minute == self.default_minute):
+                    recipients[recipient.user_id] = (local.date(), recipient)
+        self._last_bucket = current
+        if recipients:
+            logger.info(f"Delivery buckets {first}..{current}: {len(recipients)} users due.")
+        by_date: Dict[datetime.date, List[DailyRecipient]] = {}
+        for day, recipient in recipients.values():
+            by_date.setdefault(day, []).append(recipient)
+        return by_date
+
+    def open_since(self, now: Optional[float] = None) -> datetime.date:
+        """
+        The oldest local date whose buckets may still come up (or be caught up on) in a timezone in use.
+        Nobody is due on earlier dates anymore, so their runs can be finished.
+        """
+        moment = datetime.datetime.fromtimestamp((now or time.time()) - self.catchup_minutes * 60, datetime.timezone.utc)
+        dates = []
+        for name in self._timezones or [None]:
+            try:
+                dates.append(moment.astimezone(get_timezone(name) if name else self.default_timezone).date())
+            except ValueError:
+                continue
+        return min(dates)
+
+    def jitter_seconds(self, user_id: int) -> float:
+        """A stable per-user delay in [0, jitter_minutes) minutes."""
+        if self.jitter_seconds_max <= 0:
+            return 0.0
+        return zlib.crc32(str(user_id).encode()) / 2 ** 32 * self.jitter_seconds_max
+
+    async def _get_timezones(self) -> List[Optional[str]]:
+        """Timezones in use, re-read every few minutes (the default timezone is always included)."""
+        if time.monotonic() - self._timezones_at > TIMEZONE_CACHE_SECONDS:
+            self._timezones = sorted(set(await self.db_manager.get_delivery_timezones()) | {None}, key=lambda name: name or "")
+            self._timezones_at = time.monotonic()
+        return self._timezones
+
+    def refresh_timezones(self) -> None:
+        """Re-reads the timezones in use on the next call (after a user picked a new one in this process)."""
+        self._timezones_at = 0.0
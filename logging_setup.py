@@ -0,0 +1,151 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import Dict, List, Optional
+
+# Pass as extra= on high-volume per-message lines; SamplingFilter keeps only a share of them
+SAMPLED = {"sampled": True}
+
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    Rotates at the `when` interval (like TimedRotatingFileHandler) and also whenever the file would
+    grow past max_bytes. Files rotated twice in one interval get a counter suffix instead of overwriting.
+    """
+
+    def __init__(self, filename: str, when: str = "midnight", max_bytes: int = 0, backup_count: int = 7, encoding: str = "utf-8"):
+        self.max_bytes = max_bytes
+        self.timed = bool(when)
+        super().__init__(filename, when=when or "midnight", backupCount=backup_count, encoding=encoding, delay=True)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.timed and int(time.time()) >= self.rolloverAt:
+            return True
+        if self.max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.stream.tell() + len(self.format(record)) + 1 >= self.max_bytes:
+                return True
+        return False
+
+    def rotation_filename(self, default_name: str) -> str:
+        name, number = default_name, 1
+        while os.path.exists(name): # A size rollover within the same interval
+            name, number = f"{default_name}.{number}", number + 1
+        return name
+
+    def getFilesToDelete(self) -> List[str]:
+        """Oldest rotated files beyond backupCount, counter-suffixed ones included."""
+        directory, base_name = os.path.split(self.baseFilename)
+        rotated = [os.path.join(directory, name) for name in os.listdir(directory or ".") if name.startswith(base_name + ".")]
+        rotated.sort(key=os.path.getmtime)
+        return rotated[:-self.backupCount] if len(rotated) > self.backupCount else []
+
+    def doRollover(self) -> None:
+        timed_rollover = int(time.time()) >= self.rolloverAt
+        rollover_at = self.rolloverAt
+        super().doRollover()
+        if not (self.timed and timed_rollover):
+            self.rolloverAt = rollover_at # A size rollover doesn't move the next timed one
+
+
+class SamplingFilter(logging.Filter):
+    """Passes every record except those marked with SAMPLED, of which it keeps 1 in `every` per message template."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._seen: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or self.every == 1:
+            return True
+        if not self.every:
+            return False
+        count = self._seen.get(record.msg, 0)
+        self._seen[record.msg] = count + 1
+        return count % self.every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, process, message, extra fields and exception."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES:
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread as they are: unlike QueueHandler, the message is not
+    formatted on the caller's thread (so %-style arguments must not be mutated after logging).
+    When the queue is full the record is dropped and counted instead of blocking the event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(logger: logging.Logger,
+                  level: int,
+                  log_file: str,
+                  log_format: str,
+                  json_output: bool = False,
+                  max_bytes: int = 0,
+                  rotate_when: str = "midnight",
+                  backup_count: int = 7,
+                  sample_rate: float = 1.0,
+                  queue_size: int = 10000) -> Optional[QueueListener]:
+    """
+    Sends the logger's records through a bounded queue to a listener thread that writes them to a
+    rotating log file and the console. Returns the started listener (stopped again at exit).
+    """
+    if logger.handlers: # Already set up (e.g. module reloaded)
+        return None
+    formatter: logging.Formatter = JsonFormatter() if json_output else logging.Formatter(log_format)
+    handlers: List[logging.Handler] = [
+        SizedTimedRotatingFileHandler(log_file, when=rotate_when, max_bytes=max_bytes, backup_count=backup_count),
+        logging.StreamHandler(),
+    ]
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.setLevel(level)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # Flushes what is still queued
+    return listener
@@ -1,22 +1,75 @@
-from datetime import time as dt_time
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import List
+from datetime import date as dt_date, datetime as dt_datetime, timedelta as dt_timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    PollAnswerHandler
 )
 
-from config import logger, TELEGRAM_TOKEN
+from config import (
+    logger,
+    SAMPLED,
+    TELEGRAM_TOKEN,
+    USER_ACTIVITY_FLUSH_SECONDS,
+    DAILY_PUZZLE_COUNT,
+    PUZZLE_GENERATION_TIME,
+    OUTBOX_RETENTION_DAYS,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS,
+    STATUS_HOST,
+    STATUS_PORT,
+    METRICS_LOG_SECONDS,
+    PROCESS_ROLE,
+    WORKER_COUNT,
+    WORKER_INDEX,
+    OUTBOX_POLL_SECONDS,
+    OUTBOX_CROSS_PROCESS_POLL_SECONDS,
+    LEADER_LEASE_SECONDS,
+    POLL_INDEX_RETENTION_DAYS,
+    CHANNEL_POST_RETENTION_DAYS,
+    REVIEW_TICK_SECONDS,
+    DELIVERY_WINDOWS,
+    DAILY_DELIVERY_TIME,
+    DEFAULT_TIMEZONE
+)
 
 from utilities import (
-    get_quiz_from_ai,
     send_poll_to_user_and_channel,
-    read_puzzles_from_file,
+    import_puzzles_from_file,
+    ai_usage,
     DatabaseManager
 )
+from quiz_generation import QuizGenerator
+from broadcast import Broadcaster, TelegramRateLimiter
+from channel_publisher import ChannelPublisher
+from outbox import Outbox
+from status_server import StatusServer
+from metrics import metrics, instrumented, stage_seconds
+from update_processor import PendingLimitQueue, PerChatUpdateProcessor
+from user_limits import NoteCoalescer
+from cluster import UpdateInbox, LeaderLease, run_without_updater, run_cluster
+from user_cache import UserProfileCache
+from poll_tracker import PollTracker
+from reviews import ReviewScheduler
+from delivery import DeliveryScheduler, parse_delivery_time, format_delivery_time, get_timezone
+from puzzle_stock import PuzzleStocker
+from quiz_validation import validate_quiz
 
 try:
     db_manager = DatabaseManager()
@@ -24,13 +77,37 @@ except Exception as e:
     logger.critical(f"Failed to initialize DatabaseManager: {e}. Bot cannot start properly.", exc_info=True)
     exit()
 
+quiz_generator = QuizGenerator(db_manager)
+rate_limiter = TelegramRateLimiter()
+broadcaster = Broadcaster(db_manager)
+poll_tracker = PollTracker(db_manager, on_counted=lambda answered: review_scheduler.record_answers(answered)) # review_scheduler is defined below
+# Only the single process or the cluster's ingress sends from the outbox (one process owns the rate limits)
+SENDS_OUTBOX = PROCESS_ROLE in ("single", "ingress")
+outbox = Outbox(db_manager, rate_limiter,
+                poll_seconds=OUTBOX_POLL_SECONDS if PROCESS_ROLE == "single" else OUTBOX_CROSS_PROCESS_POLL_SECONDS,
+                on_sent=poll_tracker.on_poll_sent) # Indexes sent user polls so their answers can be matched
+channel_publisher = ChannelPublisher(db_manager, outbox)
+user_cache = UserProfileCache(db_manager)
+review_scheduler = ReviewScheduler(db_manager, outbox)
+delivery_scheduler = DeliveryScheduler(db_manager)
+daily_runs = {} # run_id -> puzzles by level of the current daily runs (one per local date in use), loaded once per process
+status_server = StatusServer(STATUS_HOST, STATUS_PORT + 1 + WORKER_INDEX if PROCESS_ROLE == "worker" else STATUS_PORT)
+update_processor = PerChatUpdateProcessor()
+note_coalescer = NoteCoalescer(lambda updates, context: make_quiz(updates, context)) # make_quiz is defined below
+update_inbox = UpdateInbox(db_manager, shards=WORKER_COUNT)
+leader_lease = LeaderLease(db_manager, role=PROCESS_ROLE)
+puzzle_stocker = PuzzleStocker(db_manager)
+daily_recipients = metrics.counter("quizpal_daily_recipients_total", "Daily puzzle recipients by result.", ("result",))
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message and ask for language level."""
     user = update.effective_user
     chat_id = update.effective_chat.id
-    logger.info(f"Start command received from user {user.id} ({user.username or 'N/A'}) in chat {chat_id}.")
+    logger.info("Start command received from user %s (%s) in chat %s.", user.id, user.username or 'N/A', chat_id)
 
-    db_manager.add_or_update_user(user_id=user.id, username=user.username or user.first_name)
+    await user_cache.update(user_id=user.id, username=user.username or user.first_name)
+    if await outbox.unblock_chat(chat_id):
+        logger.info(f"Chat {chat_id} is back after blocking the bot, daily puzzles resume.")
 
     welcome_text = (
         "🎉 Welcome to the Quiz Bot! 🎉\n"
@@ -55,14 +132,23 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Display and edit user's settings"""
     user = update.effective_user
     chat_id = update.effective_chat.id
-    logger.info(f"Settings command received from user {user.id} ({user.username or 'N/A'}) in chat {chat_id}.")
+    logger.info("Settings command received from user %s (%s) in chat %s.", user.id, user.username or 'N/A', chat_id)
 
-    user_data = db_manager.get_user(user.id)
+    user_data = await user_cache.get_profile(user.id)
+    if not user_data:
+        await update.message.reply_text("Please use /start first so I can set up your profile. 😊")
+        return
     if user_data['daily_puzzle'] == True:
         daily_puzzle = '✅'
     else:
         daily_puzzle = '❌'
     user_status = f"🌎 English Level: {user_data['level']}\n🧩 Sending Daily Puzzle: {daily_puzzle}"
+    if DELIVERY_WINDOWS:
+        user_status += f"\n⏰ Delivery Time: {delivery_time_text(user_data)} (change it with /delivery)"
+    answer_stats = await db_manager.get_user_stats(user.id)
+    if answer_stats and answer_stats['answered']:
+        accuracy = answer_stats['correct'] / answer_stats['answered']
+        user_status += f"\n🎯 Quiz Answers: {answer_stats['correct']}/{answer_stats['answered']} correct ({accuracy:.0%})"
 
     settings_text = (
         "⚙️ Bot Settings ⚙️\n\n"
@@ -89,7 +175,7 @@ async def settings_choice_callback(update: Update, context: ContextTypes.DEFAULT
     if update.callback_query:
         user = update.effective_user
         chat_id = update.effective_chat.id
-        logger.info(f"Settings, CallBackQuery command received from user {user.id} ({user.username or 'N/A'}) in chat {chat_id}.")
+        logger.info("Settings, CallBackQuery command received from user %s (%s) in chat %s.", user.id, user.username or 'N/A', chat_id)
 
         query = update.callback_query
         data = query.data
@@ -112,10 +198,10 @@ async def settings_choice_callback(update: Update, context: ContextTypes.DEFAULT
             await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
             return
         elif data in ["settingsـdaily_active", "settingsـdaily_deactive"]:
-            logger.debug(f"User choice daily settings")
+            logger.debug("User choice daily settings")
 
             if data == "settingsـdaily_deactive":
-                db_manager.add_or_update_user(chat_id, daily_puzzle=False)
+                await user_cache.update(chat_id, daily_puzzle=False)
                 daily_puzzle_text = (
                     "Your daily puzzle has been successfully deactivated. ✅\n\n"
                     "But daily quiz puzzle is so helpful and fun, don't you wanna activate it again😢?\n"
@@ -125,7 +211,7 @@ async def settings_choice_callback(update: Update, context: ContextTypes.DEFAULT
                 await message_to_reply.reply_text(daily_puzzle_text)
 
             elif data == "settingsـdaily_active":
-                db_manager.add_or_update_user(chat_id, daily_puzzle=True)
+                await user_cache.update(chat_id, daily_puzzle=True)
                 daily_puzzle_text = (
                     "Your daily puzzle has been successfully activated. ✅\n\n"
                     "Daily quiz puzzle is so fun and can improve your English significantly\n"
@@ -135,15 +221,62 @@ async def settings_choice_callback(update: Update, context: ContextTypes.DEFAULT
                 await message_to_reply.reply_text(daily_puzzle_text)
 
 
+async def delivery_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/delivery [HH:MM] [Area/City]: shows or sets when (in the user's timezone) the daily puzzle arrives."""
+    user = update.effective_user
+    logger.info("Delivery command received from user %s with args %s.", user.id, context.args)
+
+    user_data = await user_cache.get_profile(user.id)
+    if not user_data:
+        await update.message.reply_text("Please use /start first so I can set up your profile. 😊")
+        return
+
+    delivery_minute, timezone = None, None
+    for arg in context.args or []:
+        minute = parse_delivery_time(arg)
+        if minute is not None:
+            delivery_minute = minute
+            continue
+        try:
+            get_timezone(arg)
+            timezone = arg
+        except ValueError:
+            await update.message.reply_text(
+                f"🤔 I don't understand '{arg}'. Use a time like 08:15 and/or a timezone like Europe/Berlin, "
+                "e.g. /delivery 08:15 Europe/Berlin"
+            )
+            return
+
+    if delivery_minute is not None or timezone is not None:
+        if not await user_cache.update(user.id, delivery_minute=delivery_minute, timezone=timezone):
+            await update.message.reply_text("Sorry, there was an issue saving your delivery time. Please try again. 😥")
+            return
+        if timezone is not None:
+            delivery_scheduler.refresh_timezones()
+        user_data = await user_cache.get_profile(user.id)
+
+    await update.message.reply_text(
+        f"⏰ Your daily puzzle arrives at {delivery_time_text(user_data)}.\n"
+        "To change it, send e.g. /delivery 08:15 Europe/Berlin"
+    )
+
+
+def delivery_time_text(user_data: dict) -> str:
+    """The user's delivery time and timezone, with the defaults filled in."""
+    minute = user_data.get('delivery_minute')
+    timezone = user_data.get('timezone') or DEFAULT_TIMEZONE or "server time"
+    return f"{format_delivery_time(minute) if minute is not None else DAILY_DELIVERY_TIME} ({timezone})"
+
+
 async def level_choice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle user's language level selection."""
     query = update.callback_query
     await query.answer() # Acknowledge callback
     user = update.effective_user
     chosen_level = query.data.split('_')[1] # Extracts "A1" from "level_A1"
-    logger.info(f"User {user.id} ({user.username or 'N/A'}) chose level: {chosen_level}")
+    logger.info("User %s (%s) chose level: %s", user.id, user.username or 'N/A', chosen_level)
 
-    success = db_manager.add_or_update_user(user_id=user.id, username=user.username or user.first_name, level=chosen_level)
+    success = await user_cache.update(user_id=user.id, username=user.username or user.first_name, level=chosen_level)
 
     if success:
         # await query.edit_message_text(text=f"Great! Your level is set to {chosen_level}. ✨\nNow, send me your notes, and I'll create a quiz for you!")
@@ -153,32 +286,44 @@ async def level_choice_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 async def quiz_maker_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Process user's notes and send a quiz."""
+    """Collects user's notes; notes sent in quick succession become one quiz (see make_quiz)."""
     user = update.effective_user
     chat_id = update.effective_chat.id
-    user_notes = update.message.text
 
-    logger.info(f"Quiz maker triggered by user {user.id} in chat {chat_id} with notes: '{user_notes[:50]}...'")
-    db_manager.add_or_update_user(user.id)
-    await update.message.reply_text("🔍 Got your notes! Generating a fun quiz for you... This might take a moment. 😊")
+    logger.info("Quiz maker triggered by user %s in chat %s with notes: '%.50s...'", user.id, chat_id, update.message.text, extra=SAMPLED)
+    user_cache.touch(user.id) # Last-seen timestamp, written in batches by flush_user_activity_job
+    if note_coalescer.add(chat_id, update, context): # Only the first message of a burst gets a reply
+        await update.message.reply_text("🔍 Got your notes! Generating a fun quiz for you... This might take a moment. 😊")
+
 
-    user_level = db_manager.get_user(user.id)['level']
+@instrumented("handler")
+async def make_quiz(updates: List[Update], context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Generates and sends one quiz for the notes of one or more messages of the same chat."""
+    started = time.monotonic()
+    update = updates[-1] # Replies go to the latest message
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    user_notes = "\n".join(u.message.text for u in updates)
+    quiz_key = updates[0].update_id # Identifies this quiz in the outbox idempotency keys
+
+    user_data = await user_cache.get_profile(user.id)
+    user_level = user_data['level'] if user_data else None
     if not user_level:
         logger.warning(f"User {user.id} tried to generate quiz without setting a level. Prompting to /start.")
         await update.message.reply_text("Please set your English level first using the /start command. Then send your notes!")
         return
 
-    quiz_response = get_quiz_from_ai(user_notes, user_level=user_level)
-
-    if not quiz_response or not quiz_response.get('quiz'):
-        logger.error(f"Failed to get valid quiz structure from AI for user {user.id}.")
-        error_message = quiz_response.get('notes', {}).get('message', "😓 Oops, something went wrong while creating your quiz. Please try again or send different notes.")
-        await update.message.reply_text(error_message)
-        return
-
-    logger.info(f"AI response for user {user.id}: {str(quiz_response)[:200]}...")
-
-    for item in quiz_response['quiz']:
+    send_failed = False
+    sent_items = 0
+
+    async def send_item(item) -> None:
+        """Queues each quiz item as soon as the generator has it (streamed items arrive one by one)."""
+        nonlocal send_failed, sent_items
+        if send_failed:
+            return # Stop if one poll fails, or continue carefully
+        sent_items += 1
+        if sent_items == 1: # What the user waits for before anything shows up
+            stage_seconds.observe(time.monotonic() - started, stage="handler", operation="make_quiz_first_poll")
         try:
             await send_poll_to_user_and_channel(
                 context,
@@ -186,12 +331,27 @@ async def quiz_maker_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 item['question'],
                 item['options'],
                 item['answer_index'],
-                explanation=item['explanation'] if item.get('explanation') else "Great job! Keep practicing to master this topic! 🌟" # Default explanation
+                explanation=item['explanation'] if item.get('explanation') else "Great job! Keep practicing to master this topic! 🌟", # Default explanation
+                channel_publisher=channel_publisher,
+                outbox=outbox,
+                idempotency_key=f"quiz:{quiz_key}:{sent_items}" # A redelivered update doesn't send its polls twice
             )
         except Exception as e:
+            send_failed = True
             logger.error(f"Error sending poll item for user {user.id}: {e}", exc_info=True)
             await update.message.reply_text("😓 Oops, there was an issue sending one of the quiz questions. Let's try the rest or you can send new notes.")
-            break # Stop if one poll fails, or continue carefully
+
+    quiz_response = await quiz_generator.generate(user_notes, user_level, on_item=send_item, user_id=user.id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Quiz generator stats: %s", quiz_generator.stats())
+
+    if not quiz_response or not quiz_response.get('quiz'):
+        logger.error(f"Failed to get valid quiz structure from AI for user {user.id}.")
+        error_message = quiz_response.get('notes', {}).get('message', "😓 Oops, something went wrong while creating your quiz. Please try again or send different notes.")
+        await update.message.reply_text(error_message)
+        return
+
+    logger.info("AI response for user %s: %.200s...", user.id, quiz_response, extra=SAMPLED)
 
     # Handle AI notes
     ai_notes = quiz_response.get('notes', {})
@@ -207,48 +367,195 @@ async def quiz_maker_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if note_text_parts:
             final_note_text = "📝 **A quick note:**\n" + "\n".join(note_text_parts)
             final_note_text += "\n\nThe world of knowledge is endless! Don't you want to learn more? I'm here and all ears! 👂"
-            await update.message.reply_text(final_note_text, parse_mode='Markdown')
+            # Through the outbox, so the note arrives after the queued polls
+            await outbox.send_message(chat_id, final_note_text, idempotency_key=f"quiz:{quiz_key}:notes", parse_mode='Markdown')
         elif not quiz_response['quiz']: # No quiz and no specific notes, but AI might have a general message
              await update.message.reply_text(ai_notes.get('message', "All done for now! 😄"))
         else: # Quiz sent, no specific notes
-            await update.message.reply_text("🎯 Your quiz is ready! Answer the questions above and let's see how you do! 😄")
+            await outbox.send_message(chat_id, "🎯 Your quiz is ready! Answer the questions above and let's see how you do! 😄",
+                                      idempotency_key=f"quiz:{quiz_key}:notes")
+
+
+async def take_daily_puzzles() -> dict:
+    """
+    Takes today's puzzles from the bank for every level that has daily puzzle users.
+    Pre-generated puzzles of the level come first; the shared puzzles.json pool fills any shortfall.
+    Puzzles that don't fit Telegram's poll limits are repaired, or skipped if they can't be.
+    """
+    puzzles_by_level = {}
+    for level in await db_manager.get_daily_puzzle_levels():
+        puzzles = await db_manager.dequeue_puzzles(DAILY_PUZZLE_COUNT, level) if level else []
+        puzzles = validate_quiz(puzzles)[0]
+        if len(puzzles) < DAILY_PUZZLE_COUNT:
+            puzzles += validate_quiz(await db_manager.dequeue_puzzles(DAILY_PUZZLE_COUNT - len(puzzles)))[0]
+        if puzzles:
+            puzzles_by_level[level] = puzzles
+        else:
+            logger.warning(f"Daily quiz job: No puzzles left for level '{level or 'unset'}'.")
+    return puzzles_by_level
+
+
+@leader_lease.leader_only
+@instrumented("job")
+async def stock_puzzles_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Off-peak job that pre-generates per-level puzzles, so the daily job never waits on the AI."""
+    logger.info("Executing puzzle stock top-up job...")
+    await puzzle_stocker.top_up()
+
+
+def daily_explanation(data: dict) -> str:
+    return data['explanation'] if data.get('explanation') else "This was your daily challenge! Keep it up! 💪"
+
+
+async def load_daily_run(run_id: str) -> dict:
+    """
+    Puzzles by level of the daily run `run_id`: read back from the run if it was started before
+    (by this or another process), otherwise taken from the bank and stored as a new run.
+    The channel gets each puzzle once per run (deduplicated, on its own queue).
+    """
+    if run_id in daily_runs:
+        return daily_runs[run_id]
+    run = await db_manager.get_broadcast_run(run_id)
+    if run:
+        puzzles_by_level = json.loads(run['payload'])
+        if isinstance(puzzles_by_level, list): # Runs started before puzzles were per level
+            puzzles_by_level = {'': puzzles_by_level}
+        logger.info(f"Daily quiz: continuing run {run_id}.")
+    else:
+        puzzles_by_level = await take_daily_puzzles()
+        if puzzles_by_level:
+            await db_manager.start_broadcast_run(run_id, json.dumps(puzzles_by_level, ensure_ascii=False))
+        else:
+            logger.warning(f"Daily quiz: No puzzle data found to send for run {run_id}.")
 
+    for puzzle_data in puzzles_by_level.values():
+        for data in puzzle_data:
+            await channel_publisher.publish(data['question'], data['options'], data['answer_index'], daily_explanation(data))
+    while len(daily_runs) >= 3: # Local dates of the timezones in use span at most three days
+        daily_runs.pop(next(iter(daily_runs)))
+    daily_runs[run_id] = puzzles_by_level
+    return puzzles_by_level
 
-async def daily_quiz_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Scheduled job to send a daily quiz puzzle."""
-    logger.info("Executing daily quiz job...")
-    puzzle_data = read_puzzles_from_file() # Using the file-based puzzle reader
 
+async def send_daily_puzzle(run_id: str, puzzles_by_level: dict, recipient, not_before=None) -> None:
+    """Queues the user's puzzles in the outbox; keyed per run, so a resumed run never queues them twice."""
+    user_id = recipient.user_id
+    puzzle_data = puzzles_by_level.get(recipient.level or '') or puzzles_by_level.get('')
     if not puzzle_data:
-        logger.warning("Daily quiz job: No puzzle data found to send.")
+        logger.debug("No daily puzzle for level '%s' of user %s, skipping.", recipient.level, user_id)
         return
+    await outbox.send_message(user_id, "It's time for your daily English puzzle! 🧩🏫", idempotency_key=f"{run_id}:{user_id}:intro",
+                              not_before=not_before)
+    for number, data in enumerate(puzzle_data):
+        await outbox.send_poll(user_id, data['question'], data['options'], data['answer_index'], daily_explanation(data),
+                               idempotency_key=f"{run_id}:{user_id}:{number}", not_before=not_before)
+    logger.debug("Queued daily puzzle for user %s", user_id)
 
-    all_user_ids = db_manager.get_users_with_daily_puzzle_enabled()
-    if not all_user_ids:
-        logger.info("Daily quiz job: No users found in the database to send puzzles to.")
+
+@leader_lease.leader_only
+@instrumented("job")
+async def daily_quiz_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Scheduled job to send a daily quiz puzzle to every user at once, matched to each user's level
+    (used when DELIVERY_WINDOWS is off; delivery_tick_job sends at each user's own time otherwise).
+    Each day is one broadcast run; if a run is interrupted, running the job again for the same
+    run id (context.job.data) resends the same puzzles only to users that were not reached yet.
+    """
+    run_id = (context.job and context.job.data) or f"daily_quiz:{dt_date.today().isoformat()}"
+    logger.info(f"Executing daily quiz job (run {run_id})...")
+
+    run = await db_manager.get_broadcast_run(run_id)
+    if run and run['finished_at']:
+        logger.info(f"Daily quiz job: run {run_id} already finished, nothing to do.")
+        return
+    puzzles_by_level = await load_daily_run(run_id)
+    if not puzzles_by_level:
         return
 
-    for user in all_user_ids:
-        user_id = user['user_id']
-        try:
-            await context.bot.send_message(chat_id=user_id, text="It's time for your daily English puzzle! 🧩🏫")
-            for data in puzzle_data:
-                await send_poll_to_user_and_channel(
-                    context,
-                    user_id,
-                    data['question'],
-                    data['options'],
-                    data['answer_index'],
-                    explanation=data['explanation'] if data.get('explanation') else "This was your daily challenge! Keep it up! 💪"
-                )
-            logger.info(f"Sent daily puzzle to user {user_id}")
-        except Exception as e:
-            logger.error(f"Failed to send daily puzzle to user {user_id}: {e}", exc_info=True)
-            # Consider how to handle users who have blocked the bot or other errors
+    recipients = db_manager.iter_daily_puzzle_users()
+    stats = await broadcaster.run(run_id, recipients, lambda recipient: send_daily_puzzle(run_id, puzzles_by_level, recipient),
+                                  chat_id_of=lambda recipient: recipient.user_id)
+    for result, count in stats.items():
+        daily_recipients.inc(count, result=result)
+    if not any(stats.values()):
+        logger.info("Daily quiz job: No users found in the database to send puzzles to.")
+    await db_manager.finish_broadcast_run(run_id)
+
+@leader_lease.leader_only
+@instrumented("job")
+async def delivery_tick_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Every minute: queues the puzzles of their local date's run for the users whose delivery time
+    just came up, each delayed by their jitter, so the daily load arrives as a steady stream instead
+    of one spike. Runs of dates that have passed in every timezone in use are finished.
+    """
+    now = time.time()
+    for day, recipients in (await delivery_scheduler.due_recipients(now)).items():
+        run_id = f"daily_quiz:{day.isoformat()}"
+        puzzles_by_level = await load_daily_run(run_id)
+        if not puzzles_by_level:
+            continue
+        async def send(recipient, run_id=run_id, puzzles_by_level=puzzles_by_level) -> None:
+            await send_daily_puzzle(run_id, puzzles_by_level, recipient, not_before=now + delivery_scheduler.jitter_seconds(recipient.user_id))
+        # No progress rows: the per-user outbox keys of run_id already prevent double sends
+        stats = await broadcaster.run(run_id, recipients, send, chat_id_of=lambda recipient: recipient.user_id, track_progress=False)
+        for result, count in stats.items():
+            daily_recipients.inc(count, result=result)
+
+    open_since = f"daily_quiz:{delivery_scheduler.open_since(now).isoformat()}"
+    for run_id in await db_manager.get_unfinished_broadcast_run_ids():
+        if run_id.startswith("daily_quiz:") and run_id < open_since: # ISO dates sort by date
+            await db_manager.finish_broadcast_run(run_id)
+            logger.info(f"Daily quiz run {run_id} finished, its last delivery bucket has passed.")
+
+@leader_lease.leader_only
+@instrumented("job")
+async def prune_outbox_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Deletes delivered and dead outbox rows, and progress of finished broadcasts, older than OUTBOX_RETENTION_DAYS."""
+    pruned = await db_manager.prune_outbox(dt_timedelta(days=OUTBOX_RETENTION_DAYS))
+    logger.info(f"Pruned {pruned} old outbox rows. Outbox: {await outbox.stats()}")
+    pruned = await db_manager.prune_broadcast_progress(dt_timedelta(days=OUTBOX_RETENTION_DAYS))
+    logger.info(f"Pruned {pruned} old broadcast progress rows.")
+
+@leader_lease.leader_only
+@instrumented("job")
+async def prune_poll_index_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Forgets sent polls older than POLL_INDEX_RETENTION_DAYS (answers and totals are kept)."""
+    pruned = await db_manager.prune_poll_index(dt_timedelta(days=POLL_INDEX_RETENTION_DAYS))
+    logger.info(f"Pruned {pruned} old poll index rows. Poll answers: {poll_tracker.stats()}")
+
+@leader_lease.leader_only
+@instrumented("job")
+async def prune_channel_posts_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Forgets channel posts older than CHANNEL_POST_RETENTION_DAYS."""
+    pruned = await db_manager.prune_channel_posts(dt_timedelta(days=CHANNEL_POST_RETENTION_DAYS))
+    logger.info(f"Pruned {pruned} old channel posts.")
+
+@leader_lease.leader_only
+@instrumented("job")
+async def review_tick_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends the spaced-repetition reviews that are due."""
+    await review_scheduler.tick()
+
+async def metrics_summary_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Logs count and latency per stage operation since the previous summary."""
+    logger.info(f"Metrics ({PROCESS_ROLE}): {metrics.summary()}")
+
+async def flush_user_activity_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodically writes the batched "last seen" timestamps to the database."""
+    await user_cache.flush()
+
 
 async def error_handler_telegram(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log Errors caused by Updates and send a user-friendly message."""
-    logger.error(f"Update {update} caused error: {context.error}", exc_info=context.error)
+    # Only the ids: formatting the whole Update is slow and would put user messages into the log
+    if isinstance(update, Update):
+        logger.error("Update %s (chat %s, user %s) caused error: %s", update.update_id,
+                     update.effective_chat.id if update.effective_chat else None,
+                     update.effective_user.id if update.effective_user else None,
+                     context.error, exc_info=context.error)
+    else:
+        logger.error("Error outside of an update (%s): %s", type(update).__name__, context.error, exc_info=context.error)
     if isinstance(update, Update) and update.effective_message:
         try:
             await update.effective_message.reply_text(
@@ -259,6 +566,121 @@ async def error_handler_telegram(update: object, context: ContextTypes.DEFAULT_T
             logger.error(f"Error sending error message to user: {e}")
 
 
+async def leadership_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keeps (or tries to take) the jobs lease. A process that just became leader resumes interrupted runs."""
+    was_leader = leader_lease.is_leader
+    if await leader_lease.hold() and not was_leader and not DELIVERY_WINDOWS: # delivery_tick_job catches up by itself
+        for run_id in await db_manager.get_unfinished_broadcast_run_ids():
+            if run_id == f"daily_quiz:{dt_date.today().isoformat()}":
+                context.job_queue.run_once(daily_quiz_job, when=5, data=run_id, name=f"resume_{run_id}")
+                logger.info(f"Scheduled resume of interrupted broadcast run {run_id}.")
+
+
+def register_metric_collectors() -> None:
+    """Exposes the components' own counters and queue depths on /metrics."""
+    quiz_cache, phrase_store = quiz_generator.quiz_cache, quiz_generator.phrase_store
+    metrics.collect("quizpal_quiz_cache_lookups_total", "Whole-quiz cache lookups by result.",
+                    lambda: {"memory_hit": quiz_cache.memory_hits, "db_hit": quiz_cache.db_hits, "miss": quiz_cache.misses},
+                    label="result", kind="counter")
+    metrics.collect("quizpal_quiz_cache_hit_ratio", "Share of whole-quiz lookups served from the cache.", lambda: quiz_cache.stats()["hit_rate"])
+    metrics.collect("quizpal_phrase_store_lookups_total", "Per-phrase item lookups by result.",
+                    lambda: {"hit": phrase_store.hits, "miss": phrase_store.misses}, label="result", kind="counter")
+    metrics.collect("quizpal_user_cache_lookups_total", "User profile cache lookups by result.",
+                    lambda: {"hit": user_cache.hits, "miss": user_cache.misses}, label="result", kind="counter")
+    metrics.collect("quizpal_ai_rate_limited_total", "AI generations refused by the per-user rate limit.",
+                    lambda: quiz_generator.user_rate_limiter.limited, kind="counter")
+    metrics.collect("quizpal_updates", "Updates being processed or waiting for their chat or a slot.",
+                    lambda: {key: value for key, value in update_processor.stats().items() if key in ("running", "waiting", "active_chats")},
+                    label="state")
+    metrics.collect("quizpal_open_note_bursts", "Chats whose notes are still being collected.", lambda: note_coalescer.stats()["open_bursts"])
+    metrics.collect("quizpal_log_records_dropped_total", "Log records dropped because the log queue was full.",
+                    lambda: sum(getattr(handler, "dropped", 0) for handler in logger.handlers), kind="counter")
+    metrics.collect("quizpal_poll_answers_total", "Poll answers received, counted (matched to a sent quiz poll), correct and dropped.",
+                    lambda: {key: value for key, value in poll_tracker.stats().items() if key in ("answers", "counted", "correct", "dropped")},
+                    label="result", kind="counter")
+    metrics.collect("quizpal_poll_tracker_buffered", "Sent polls and answers waiting to be written.", lambda: poll_tracker.stats()["buffered"])
+    metrics.collect("quizpal_reviews_due", "Spaced-repetition reviews that are due.", db_manager.count_due_reviews)
+    metrics.collect("quizpal_reviews_sent_total", "Review polls queued.", lambda: review_scheduler.sent, kind="counter")
+    metrics.collect("quizpal_db_pending_writes", "Writes queued for the database writer thread.", db_manager.pending_writes)
+    if SENDS_OUTBOX:
+        metrics.collect("quizpal_outbox_rows", "Outbox rows by status.", db_manager.count_outbox, label="status")
+        metrics.collect("quizpal_outbox_in_flight", "Outbox messages claimed and not yet attempted.", lambda: outbox.in_flight)
+        metrics.collect("quizpal_telegram_retry_after_total", "Telegram flood-control replies (RetryAfter).",
+                        lambda: rate_limiter.retry_after_count, kind="counter")
+    if PROCESS_ROLE != "single":
+        metrics.collect("quizpal_inbox_updates", "Updates waiting in the inbox, by worker shard.", db_manager.count_inbox, label="shard")
+
+
+async def metrics_endpoint():
+    """/metrics: this process's metrics in the Prometheus text format."""
+    return 200, "text/plain; version=0.0.4", await metrics.render()
+
+
+async def health_check(application: Application):
+    """/health: 200 while the bot is running and the database answers, 503 otherwise."""
+    database_ok = await db_manager.ping()
+    healthy = application.running and database_ok
+    body = json.dumps({
+        "status": "ok" if healthy else "unavailable",
+        "mode": BOT_MODE,
+        "role": PROCESS_ROLE,
+        "leader": leader_lease.is_leader,
+        "bot_running": application.running,
+        "database": database_ok,
+        "outbox": await db_manager.count_outbox(),
+        "updates": {**update_processor.stats(), "intake_waits": application.update_queue.paused},
+        "notes": note_coalescer.stats(),
+        "poll_answers": poll_tracker.stats(),
+        **({"inbox": await db_manager.count_inbox()} if PROCESS_ROLE != "single" else {}),
+    })
+    return (200 if healthy else 503), "application/json", body + "\n"
+
+
+async def post_init(application: Application) -> None:
+    """Starts background workers once the bot is initialized."""
+    await quiz_generator.invalidate() # Drop entries generated with an older prompt template
+    await import_puzzles_from_file(db_manager) # Seeds the puzzle bank from puzzles.json once
+    poll_tracker.start()
+    await channel_publisher.resolve(application.bot)
+    if SENDS_OUTBOX:
+        outbox.start(application.bot) # Also picks up whatever a previous run left queued
+    if STATUS_PORT:
+        register_metric_collectors()
+        if SENDS_OUTBOX:
+            status_server.add_route("/health", lambda: health_check(application))
+        status_server.add_route("/metrics", metrics_endpoint)
+        await status_server.start()
+    # Today's interrupted daily run is resumed by leadership_job once this process holds the jobs lease
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stops background workers before the bot shuts down."""
+    await status_server.stop()
+    await note_coalescer.stop() # Generates the quizzes of notes still being collected
+    await outbox.stop()
+    await poll_tracker.stop() # After the outbox, so polls it sent last are indexed too
+    await user_cache.flush()
+    await leader_lease.release() # Lets another process take over the jobs right away
+    logger.info(f"AI usage since start: {ai_usage.stats()}")
+
+
+def register_handlers(application: Application) -> None:
+    """Adds this process role's update handlers (also used by benchmark.py)."""
+    if PROCESS_ROLE == "ingress":
+        # Every update is handed to the worker owning its user, nothing is handled here
+        application.add_handler(TypeHandler(Update, update_inbox.forward_update), group=-1)
+    else:
+        application.add_handler(CommandHandler("start", start_command))
+        application.add_handler(CommandHandler("settings", settings_command))
+        application.add_handler(CommandHandler("delivery", delivery_time_command))
+        application.add_handler(CallbackQueryHandler(level_choice_callback, pattern='level_*')) # Pattern for level callbacks
+        application.add_handler(CallbackQueryHandler(settings_choice_callback, pattern='settings_*')) # Pattern for level callbacks
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_maker_handler))
+        application.add_handler(PollAnswerHandler(poll_tracker.handle_answer))
+
+    application.add_error_handler(error_handler_telegram)
+
+
 def main() -> None:
     """Start the bot."""
     logger.info("Starting bot...")
@@ -266,34 +688,89 @@ def main() -> None:
     if not TELEGRAM_TOKEN:
         logger.critical("TELEGRAM_TOKEN is not set. Bot cannot start.")
         return
+    if BOT_MODE not in ("polling", "webhook"):
+        logger.critical(f"Unknown BOT_MODE '{BOT_MODE}', expected 'polling' or 'webhook'.")
+        return
+    if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET_TOKEN):
+        logger.critical("Webhook mode needs WEBHOOK_URL and WEBHOOK_SECRET_TOKEN. Bot cannot start.")
+        return
+    if PROCESS_ROLE not in ("single", "cluster", "ingress", "worker"):
+        logger.critical(f"Unknown PROCESS_ROLE '{PROCESS_ROLE}', expected 'single', 'cluster', 'ingress' or 'worker'.")
+        return
 
     try:
-        application = Application.builder().token(TELEGRAM_TOKEN).build() # removed persistence for now .persistence(persistence)
+        if PROCESS_ROLE == "cluster":
+            logger.info(f"Starting cluster: 1 ingress and {WORKER_COUNT} worker processes.")
+            run_cluster(os.path.abspath(__file__), WORKER_COUNT)
+            return
 
-        # Register handlers
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("settings", settings_command))
-        application.add_handler(CallbackQueryHandler(level_choice_callback, pattern='level_*')) # Pattern for level callbacks
-        application.add_handler(CallbackQueryHandler(settings_choice_callback, pattern='settings_*')) # Pattern for level callbacks
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_maker_handler))
+        builder = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .concurrent_updates(update_processor) # Chats in parallel, each chat's updates in order
+            .update_queue(PendingLimitQueue()) # Intake waits while UPDATE_MAX_PENDING updates are unfinished
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+        ) # removed persistence for now .persistence(persistence)
+        if PROCESS_ROLE == "worker":
+            builder = builder.updater(None) # Updates come from the inbox, not from Telegram
+        application = builder.build()
 
-        application.add_error_handler(error_handler_telegram)
+        register_handlers(application)
 
         # Schedule daily message
         job_queue = application.job_queue
         if job_queue: 
+            if DELIVERY_WINDOWS:
+                # Each user at their own time; the first tick also catches up buckets missed while the bot was down
+                job_queue.run_repeating(delivery_tick_job, interval=60, first=5, name="daily_quiz_delivery")
+                logger.info(f"Daily puzzles are delivered at each user's own time (default {DAILY_DELIVERY_TIME}, {DEFAULT_TIMEZONE or 'server time'}).")
+            else:
+                job_queue.run_daily(
+                    daily_quiz_job,
+                    time=dt_datetime.strptime(DAILY_DELIVERY_TIME, "%H:%M").time(),
+                    name="daily_quiz_puzzle"
+                )
+                logger.info(f"Daily quiz job scheduled for {DAILY_DELIVERY_TIME} server time.")
+
             job_queue.run_daily(
-                daily_quiz_job,
-                time=dt_time(hour=7, minute=30, second=00), # Specify timezone if needed: tzinfo=pytz.timezone('Your/Timezone')
-                name="daily_quiz_puzzle"
+                stock_puzzles_job,
+                time=dt_datetime.strptime(PUZZLE_GENERATION_TIME, "%H:%M").time(),
+                name="stock_puzzles"
             )
-            logger.info("Daily quiz job scheduled for 07:30 server time.")
+            logger.info(f"Puzzle stock top-up scheduled for {PUZZLE_GENERATION_TIME} server time.")
+
+            if METRICS_LOG_SECONDS:
+                job_queue.run_repeating(metrics_summary_job, interval=METRICS_LOG_SECONDS, first=METRICS_LOG_SECONDS, name="metrics_summary")
+            job_queue.run_repeating(flush_user_activity_job, interval=USER_ACTIVITY_FLUSH_SECONDS, name="flush_user_activity")
+            job_queue.run_repeating(prune_outbox_job, interval=dt_timedelta(hours=6), first=60, name="prune_outbox")
+            job_queue.run_repeating(review_tick_job, interval=REVIEW_TICK_SECONDS, first=REVIEW_TICK_SECONDS, name="review_tick")
+            job_queue.run_repeating(prune_poll_index_job, interval=dt_timedelta(hours=6), first=90, name="prune_poll_index")
+            job_queue.run_repeating(prune_channel_posts_job, interval=dt_timedelta(hours=6), first=120, name="prune_channel_posts")
+            # Scheduled jobs above only run in the process holding the jobs lease
+            job_queue.run_repeating(leadership_job, interval=LEADER_LEASE_SECONDS / 3, first=1, name="leadership")
         else:
             logger.warning("JobQueue not available. Daily quiz job not scheduled.")
 
 
-        logger.info("Bot is polling...")
-        application.run_polling(drop_pending_updates=True)
+        if PROCESS_ROLE == "worker":
+            logger.info(f"Worker {WORKER_INDEX} of {WORKER_COUNT} is running...")
+            asyncio.run(run_without_updater(application, lambda app: update_inbox.consume(app, WORKER_INDEX)))
+        elif BOT_MODE == "webhook":
+            logger.info(f"Bot is serving webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH} for {WEBHOOK_URL}...")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN, # Requests without the matching header are rejected with 403
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False # Updates that arrived while the bot was down are still delivered
+            )
+        else:
+            logger.info("Bot is polling...")
+            application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
 
     except Exception as e:
         logger.critical(f"Critical error during bot setup or runtime: {e}", exc_info=True)
@@ -0,0 +1,203 @@
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from config import logger
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# A collector returns one value, or one value per label value; it may be a coroutine function
+CollectorValue = Union[float, Dict[str, float]]
+Collector = Callable[[], Union[CollectorValue, Awaitable[CollectorValue]]]
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: Tuple[str, ...], key: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic count per label combination."""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    """
+    Bucketed distribution per label combination (cumulative buckets, sum and count, as Prometheus
+    expects). Quantiles for the summary log are estimated from the buckets.
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {} # Per-bucket counts (last one is +Inf), then sum
+        self._reported: Dict[Tuple[str, ...], List[float]] = {} # Snapshot at the last interval_summary()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+        series[index] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(cumulative)}")
+        return lines
+
+    def interval_summary(self) -> Dict[Tuple[str, ...], Dict[str, float]]:
+        """Count, mean, p50 and p95 per label combination of the observations since the previous call."""
+        summary = {}
+        for key, series in self._series.items():
+            previous = self._reported.get(key) or [0.0] * len(series)
+            delta = [now - before for now, before in zip(series, previous)]
+            self._reported[key] = list(series)
+            count = sum(delta[:-1])
+            if count:
+                summary[key] = {"count": count, "mean": delta[-1] / count,
+                                "p50": self._quantile(delta, count, 0.5), "p95": self._quantile(delta, count, 0.95)}
+        return summary
+
+    def _quantile(self, counts: List[float], total: float, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (the largest finite bound for the +Inf bucket)."""
+        seen = 0.0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics. Counters and histograms are updated in place by the instrumented code;
+    collectors are read when the metrics are rendered (queue depths, cache counters, ...).
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[Counter, Histogram]] = {}
+        self._collectors: List[Tuple[str, str, str, Optional[str], Collector]] = []
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_text, labelnames, buckets))
+
+    def collect(self, name: str, help_text: str, collector: Collector, label: Optional[str] = None, kind: str = "gauge") -> None:
+        """Registers a value read at render time. With `label`, collector returns {label value: value}."""
+        self._collectors.append((name, help_text, kind, label, collector))
+
+    async def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        for name, help_text, kind, label, collector in self._collectors:
+            try:
+                value = collector()
+                if inspect.isawaitable(value):
+                    value = await value
+            except Exception as e:
+                logger.error(f"Metrics: collector {name} failed: {e}")
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if label is None:
+                lines.append(f"{name} {_format_value(value)}")
+            else:
+                lines += [f"{name}{_format_labels((label,), (str(key),))} {_format_value(item)}" for key, item in sorted(value.items(), key=lambda kv: str(kv[0]))]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """One line per stage operation seen since the previous summary: count, p50/p95 latency and errors."""
+        parts = []
+        for key, stats in sorted(stage_seconds.interval_summary().items()):
+            stage, operation = key
+            errors = sum(value for (error_stage, error_operation, _), value in stage_errors._values.items()
+                         if error_stage == stage and error_operation == operation)
+            parts.append(f"{stage}.{operation} n={int(stats['count'])} mean={stats['mean'] * 1000:.1f}ms "
+                         f"p50<={stats['p50'] * 1000:g}ms p95<={stats['p95'] * 1000:g}ms errors_total={int(errors)}")
+        return "; ".join(parts) if parts else "no activity"
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram("quizpal_stage_duration_seconds", "Latency of one operation of a stage (db, ai, telegram, send, job, handler).", ("stage", "operation"))
+stage_errors = metrics.counter("quizpal_stage_errors_total", "Failed operations by stage, operation and error type.", ("stage", "operation", "error"))
+ai_tokens = metrics.counter("quizpal_ai_tokens_total", "AI tokens used, by kind of call and token type.", ("kind", "type"))
+
+
+def record_error(stage: str, operation: str, error: BaseException) -> None:
+    stage_errors.inc(stage=stage, operation=operation, error=type(error).__name__)
+
+
+@contextmanager
+def timed(stage: str, operation: str) -> Iterator[None]:
+    """Records the duration of the block in stage_seconds, and its exception (re-raised) in stage_errors."""
+    started = time.monotonic()
+    try:
+        yield
+    except Exception as e: # Cancellation is not an error
+        record_error(stage, operation, e)
+        raise
+    finally:
+        stage_seconds.observe(time.monotonic() - started, stage=stage, operation=operation)
+
+
+def instrumented(stage: str, operation: Optional[str] = None):
+    """Decorator for coroutine functions: times every call with timed(stage, operation or the function name)."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with timed(stage, operation or fn.__name__):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
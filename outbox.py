@@ -0,0 +1,227 @@
+import asyncio
+import json
+import time
+from typing import List, Optional, Dict, Any, Callable
+
+from telegram import Poll
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from config import (
+    logger,
+    OUTBOX_WORKERS,
+    OUTBOX_BATCH_SIZE,
+    OUTBOX_LEASE_SECONDS,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE_SECONDS,
+    OUTBOX_BACKOFF_MAX_SECONDS,
+    OUTBOX_POLL_SECONDS
+)
+from database import OutboxMessage
+from metrics import timed
+
+OUTBOX_METHODS = ("send_message", "send_poll")
+
+
+class Outbox:
+    """
+    Durable queue for outgoing polls and messages. Every send is first stored in the outbox table
+    (optionally under an idempotency key, so the same logical message is only queued once) and then
+    delivered by worker coroutines through the TelegramRateLimiter.
+    Messages survive restarts. Failed sends back off exponentially (or as long as RetryAfter asks),
+    and are dead-lettered after OUTBOX_MAX_ATTEMPTS. A Forbidden reply (the user blocked the bot)
+    dead-letters the whole chat: its pending messages are dropped and broadcasts skip it.
+    Each chat is always served by the same worker, so a chat's messages keep their order
+    (except that a message waiting for a retry is overtaken by later ones).
+    `on_sent(message, payload, result)` is called after each successful send with what Telegram returned.
+    """
+
+    def __init__(self,
+                 db_manager,
+                 rate_limiter,
+                 workers: int = OUTBOX_WORKERS,
+                 batch_size: int = OUTBOX_BATCH_SIZE,
+                 lease_seconds: float = OUTBOX_LEASE_SECONDS,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 poll_seconds: float = OUTBOX_POLL_SECONDS,
+                 on_sent: Optional[Callable[[OutboxMessage, Dict[str, Any], Any], None]] = None):
+        self.db_manager = db_manager
+        self.rate_limiter = rate_limiter
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds # Rows queued by other processes are only seen by polling
+        self.on_sent = on_sent
+        self._queues: List[asyncio.Queue] = [asyncio.Queue() for _ in range(max(1, workers))]
+        self._in_flight = set()
+        self._blocked = set() # Chats found blocked by this process, so already-claimed messages aren't attempted
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self.blocked_chats = 0
+
+    def start(self, bot) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._work(bot, queue)) for queue in self._queues]
+        logger.info(f"Outbox started with {len(self._queues)} workers.")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # Claimed messages that were never attempted can go out right after the next start
+        unsent = []
+        for queue in self._queues:
+            while not queue.empty():
+                unsent.append(queue.get_nowait().id)
+        self._in_flight.clear()
+        if unsent:
+            await self.db_manager.release_outbox(unsent)
+            logger.info(f"Outbox stopped, {len(unsent)} claimed messages left for the next start.")
+
+    async def send_message(self, chat_id: int, text: str, idempotency_key: Optional[str] = None, not_before: Optional[float] = None, **kwargs) -> bool:
+        """Queues bot.send_message(chat_id, text, **kwargs). kwargs must be JSON-serializable."""
+        return await self.enqueue(chat_id, "send_message", {"text": text, **kwargs}, idempotency_key, not_before)
+
+    async def send_poll(self,
+                        chat_id: int,
+                        question: str,
+                        options: List[str],
+                        correct_option_id: int,
+                        explanation: Optional[str] = None,
+                        is_anonymous: bool = False,
+                        idempotency_key: Optional[str] = None,
+                        not_before: Optional[float] = None
+                        ) -> bool:
+        """Queues a quiz poll (same arguments as utilities.send_quiz_poll)."""
+        payload = {
+            "question": question,
+            "options": options,
+            "type": Poll.QUIZ,
+            "correct_option_id": correct_option_id,
+            "is_anonymous": is_anonymous,
+            "explanation": explanation,
+        }
+        return await self.enqueue(chat_id, "send_poll", payload, idempotency_key, not_before)
+
+    async def enqueue(self, chat_id: int, method: str, payload: Dict[str, Any], idempotency_key: Optional[str] = None,
+                      not_before: Optional[float] = None) -> bool:
+        """
+        Stores a send in the outbox, due right away or at the Unix time `not_before`.
+        Returns False for duplicates (same key) and blocked chats.
+        """
+        if method not in OUTBOX_METHODS:
+            raise ValueError(f"Unsupported outbox method: {method}")
+        queued = await self.db_manager.enqueue_outbox(chat_id, method, json.dumps(payload, ensure_ascii=False), idempotency_key, not_before)
+        if queued:
+            self._wakeup.set()
+        else:
+            logger.debug("Outbox: not queueing %s for chat %s (duplicate key %s or blocked chat).", method, chat_id, idempotency_key)
+        return queued
+
+    async def unblock_chat(self, chat_id: int) -> bool:
+        """Called when a user talks to the bot again. Returns True if the chat had been blocked."""
+        self._blocked.discard(chat_id)
+        return await self.db_manager.unblock_chat(chat_id)
+
+    @property
+    def in_flight(self) -> int:
+        """Messages claimed from the table and not yet attempted."""
+        return len(self._in_flight)
+
+    async def stats(self) -> Dict[str, Any]:
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "dead": self.dead,
+            "blocked_chats": self.blocked_chats,
+            "in_flight": self.in_flight,
+            "rows": await self.db_manager.count_outbox(),
+        }
+
+    async def _dispatch(self) -> None:
+        """Claims due rows and hands each one to the worker that owns its chat."""
+        while True:
+            self._wakeup.clear()
+            capacity = self.batch_size - len(self._in_flight)
+            messages = await self.db_manager.claim_due_outbox(capacity, self.lease_seconds) if capacity > 0 else []
+            for message in messages:
+                if message.id in self._in_flight:
+                    continue
+                self._in_flight.add(message.id)
+                self._queues[hash(message.chat_id) % len(self._queues)].put_nowait(message)
+            if messages and len(messages) == capacity:
+                continue # There may be more due rows right away
+
+            timeout = self.poll_seconds
+            if capacity > 0:
+                next_attempt_at = await self.db_manager.get_next_outbox_attempt()
+                if next_attempt_at is not None:
+                    timeout = min(timeout, max(next_attempt_at - time.time(), 0.05))
+            else:
+                timeout = 0.1 # Workers are busy, check again soon
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self, bot, queue: asyncio.Queue) -> None:
+        while True:
+            message = await queue.get()
+            try:
+                await self._deliver(bot, message)
+            except Exception as e:
+                logger.error(f"Outbox: unexpected error delivering message {message.id}: {e}", exc_info=True)
+            finally:
+                self._in_flight.discard(message.id)
+                queue.task_done()
+                if len(self._in_flight) == self.batch_size // 2:
+                    self._wakeup.set() # Room for another claim
+
+    async def _deliver(self, bot, message: OutboxMessage) -> None:
+        if message.chat_id in self._blocked:
+            await self.db_manager.mark_outbox_dead(message.id, "Chat blocked the bot")
+            return
+        send = getattr(bot, message.method)
+        payload = json.loads(message.payload)
+        try:
+            with timed("telegram", message.method): # Includes waiting for the rate limits
+                result = await self.rate_limiter.run(message.chat_id, lambda: send(chat_id=message.chat_id, **payload))
+        except Forbidden as e:
+            self._blocked.add(message.chat_id)
+            dropped = await self.db_manager.block_chat(message.chat_id, str(e))
+            self.blocked_chats += 1
+            logger.warning(f"Outbox: chat {message.chat_id} blocked the bot ({e}), dropped {dropped} queued messages.")
+        except BadRequest as e:
+            await self._dead_letter(message, e)
+        except RetryAfter as e: # The rate limiter already retried in-process; try again once flood control allows
+            await self._retry_later(message, e, float(e.retry_after))
+        except Exception as e: # Timeouts and other network errors
+            await self._retry_later(message, e, min(OUTBOX_BACKOFF_BASE_SECONDS * 2 ** message.attempts, OUTBOX_BACKOFF_MAX_SECONDS))
+        else:
+            await self.db_manager.mark_outbox_sent(message.id)
+            self.sent += 1
+            if self.on_sent is not None:
+                try:
+                    self.on_sent(message, payload, result)
+                except Exception as e:
+                    logger.error(f"Outbox: on_sent failed for message {message.id}: {e}", exc_info=True)
+            logger.debug("Outbox: delivered %s %s to chat %s.", message.method, message.id, message.chat_id)
+
+    async def _retry_later(self, message: OutboxMessage, error: Exception, delay: float) -> None:
+        if message.attempts + 1 >= self.max_attempts:
+            await self._dead_letter(message, error)
+            return
+        self.retried += 1
+        logger.warning(f"Outbox: {message.method} {message.id} to chat {message.chat_id} failed ({error}), retrying in {delay:.0f}s.")
+        await self.db_manager.retry_outbox_later(message.id, time.time() + delay, str(error))
+
+    async def _dead_letter(self, message: OutboxMessage, error: Exception) -> None:
+        self.dead += 1
+        logger.error(f"Outbox: giving up on {message.method} {message.id} to chat {message.chat_id} after {message.attempts + 1} attempts: {error}")
+        await self.db_manager.mark_outbox_dead(message.id, str(error))
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from config import (
+    logger,
+    SAMPLED,
+    POLL_ANSWER_FLUSH_SECONDS,
+    POLL_ANSWER_BATCH_SIZE,
+    POLL_ANSWER_RETRY_SECONDS
+)
+from database import AnsweredItem, OutboxMessage, PollAnswer
+from channel_publisher import poll_content_hash
+
+
+def quiz_item_key(question: str, options: List[str], correct_option_id: int) -> str:
+    """Short content key of a quiz item (64 bits of its content hash), the same for every send of it."""
+    return poll_content_hash(question, options, correct_option_id)[:16]
+
+
+class PollTracker:
+    """
+    Counts users' answers to their quiz polls. The outbox reports every sent user poll (on_poll_sent),
+    which is indexed by poll id with its user, quiz item and correct option; poll_answer updates
+    (handle_answer) are matched against that index and added to the user's totals.
+    Both only append to in-memory buffers. A background task writes the buffers every flush_seconds,
+    or as soon as batch_size entries are waiting, each batch in one transaction, so the burst of
+    answers after the daily broadcast costs a few database writes a second instead of one per answer.
+    Answers that arrive before their poll is indexed (it was sent by another process whose buffer
+    isn't written yet) are retried for up to retry_seconds.
+    `on_counted(answered)` is awaited with every batch of newly counted answers.
+    """
+
+    def __init__(self,
+                 db_manager,
+                 flush_seconds: float = POLL_ANSWER_FLUSH_SECONDS,
+                 batch_size: int = POLL_ANSWER_BATCH_SIZE,
+                 retry_seconds: float = POLL_ANSWER_RETRY_SECONDS,
+                 on_counted: Optional[Callable[[List[AnsweredItem]], Awaitable[None]]] = None):
+        self.db_manager = db_manager
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.retry_seconds = retry_seconds
+        self.on_counted = on_counted
+        self._sent: List[tuple] = []
+        self._items: Dict[str, str] = {}
+        self._answers: List[PollAnswer] = []
+        self._unmatched: List[PollAnswer] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.indexed = 0
+        self.answers = 0
+        self.counted = 0
+        self.correct = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the background task and writes what is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def on_poll_sent(self, message: OutboxMessage, payload: Dict[str, Any], result: Any) -> None:
+        """Outbox on_sent hook: indexes non-anonymous quiz polls (those sent to users)."""
+        poll = getattr(result, "poll", None)
+        if message.method != "send_poll" or poll is None or payload.get("is_anonymous", True):
+            return
+        item_key = quiz_item_key(payload["question"], payload["options"], payload["correct_option_id"])
+        self._sent.append((poll.id, message.chat_id, item_key, payload["correct_option_id"], time.time()))
+        if item_key not in self._items:
+            self._items[item_key] = json.dumps(payload, ensure_ascii=False)
+        self._check_size()
+
+    async def handle_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """PollAnswerHandler callback: buffers the answer and returns right away."""
+        answer = update.poll_answer
+        if answer.user is None or not answer.option_ids: # Answered as a chat, or a retracted vote
+            return
+        self.answers += 1
+        self._answers.append(PollAnswer(answer.poll_id, answer.user.id, answer.option_ids[0], time.time()))
+        self._check_size()
+
+    def _check_size(self) -> None:
+        if len(self._sent) + len(self._answers) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing poll answers: {e}", exc_info=True)
+
+    async def flush(self) -> None:
+        """Writes buffered sent polls, then buffered answers (those retried included)."""
+        async with self._flush_lock:
+            if self._sent:
+                sent, items = self._sent, self._items
+                self._sent, self._items = [], {}
+                if await self.db_manager.add_poll_index(sent, items):
+                    self.indexed += len(sent)
+                else:
+                    logger.error(f"Lost {len(sent)} sent polls, answers to them won't be counted.")
+
+            answers = self._unmatched + self._answers
+            self._unmatched, self._answers = [], []
+            if not answers:
+                return
+            counted, unmatched = await self.db_manager.record_poll_answers(answers)
+            self.counted += len(counted)
+            self.correct += sum(1 for item in counted if item.correct)
+            cutoff = time.time() - self.retry_seconds
+            self._unmatched = [answer for answer in unmatched if answer.answered_at >= cutoff]
+            self.dropped += len(unmatched) - len(self._unmatched)
+            logger.info("Recorded %s poll answers (%s waiting for their poll).", len(counted), len(self._unmatched), extra=SAMPLED)
+            if counted and self.on_counted is not None:
+                await self.on_counted(counted)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "indexed": self.indexed,
+            "answers": self.answers,
+            "counted": self.counted,
+            "correct": self.correct,
+            "dropped": self.dropped, # Poll unknown: not a user quiz poll, expired, or never indexed
+            "buffered": len(self._sent) + len(self._answers) + len(self._unmatched),
+        }
@@ -1,6 +1,10 @@
-def get_ai_prompt(user_level, input_phrases):
-    return f"""
-        You are an expert English teacher creating engaging quizzes for intermediate English learners ({user_level}) to improve their understanding of idiomatic phrases and vocabulary. Your task is to generate a quiz based on a provided list of English phrases or words, ensuring each question has exactly 3 or 4 answer options (one correct, the rest plausible distractors).
+import hashlib
+
+
+# Static teacher instructions and output schema. Sent as the model's system instruction, unchanged
+# between calls, so only the small per-request payload below varies (and the prefix can be cached).
+SYSTEM_INSTRUCTION = """
+        You are an expert English teacher creating engaging quizzes for English learners at the CEFR level given in each request to improve their understanding of idiomatic phrases and vocabulary. Your task is to generate a quiz based on a provided list of English phrases or words, ensuring each question has exactly 3 or 4 answer options (one correct, the rest plausible distractors).
 
         **CEFR Level Guidance**:
         A1: Use simple vocabulary, basic sentence structures, and familiar contexts (e.g., daily routines). Distractors are obviously distinct but plausible.
@@ -21,7 +25,7 @@ def get_ai_prompt(user_level, input_phrases):
         - Matching: Provide a phrase and 4 meanings (one correct, three distractors).
         - Contextual usage: Provide a scenario and 4 phrases (one correct, three distractors).
         - Avoid repetitive phrasing (e.g., not “What’s the meaning of…” for every question).
-        - Adapt your English for a user at the [{user_level}] level. This means using vocabulary and grammar appropriate for this proficiency
+        - Adapt your English for a user at the learner level given in the request. This means using vocabulary and grammar appropriate for this proficiency
         - Explain why 
         
         **Input**:
@@ -35,6 +39,7 @@ def get_ai_prompt(user_level, input_phrases):
             - `question`: Question text (under 100 characters).
             - `options`: Array of exactly 3 or 4 strings (one correct, others plausible distractors).
             - `answer_index`: Integer (0–3 for 4 options; 0–2 for 3 options).
+            - `phrase`: The input phrase or word this question is about, copied exactly as it appears in the input (before any correction).
         - `notes`: Object with:
             - `skipped_phrases`: Array of phrases skipped (e.g., “xyz - not a recognized phrase”).
             - `corrections`: Array of strings for corrected phrases (e.g., “Changed ‘chil out’ to ‘chill out’”).
@@ -59,33 +64,87 @@ def get_ai_prompt(user_level, input_phrases):
         - Keep language clear and accessible for non-native speakers.
 
         **Example Output**:
-        {{
+        {
         "quiz": [
-            {{
+            {
             "question": "Q1",
             "options": ["Option 1", "Option 2", "Option 3", "Option 4"],
             "answer_index": 3,
-            "explanation": "Short explanation of why each option is correct or incorrect"
-            }},
-            {{
+            "explanation": "Short explanation of why each option is correct or incorrect",
+            "phrase": "phrase 1"
+            },
+            {
             "question": "Q2",
             "options": ["Option 1", "Option 2", "Option 3", "Option 4"],
             "answer_index": 0,
-            "explanation": "Short explanation of why each option is correct or incorrect"
-            }}
+            "explanation": "Short explanation of why each option is correct or incorrect",
+            "phrase": "phrase 2"
+            }
         ],
-        "notes": {{
+        "notes": {
             "skipped_phrases": [],
             "corrections": [],
             "message": "Awesome! Keep practicing these phrases! 😊🌟"
-        }}
-        }}
+        }
+        }
 
         **Response**:
         - Return only the JSON object, with no additional text, comments, or Markdown.
         - Ensure exactly 3 or 4 options for all question types, with one correct answer.
         - Include a motivational `notes.message` with 1–2 emojis.
 
-        **User Input:**
-        {input_phrases}
-    """
\ No newline at end of file
+        **Request Format**:
+        - Each request gives the learner's CEFR level after "Learner level:" and the phrases after "User Input:".
+"""
+
+BATCH_SYSTEM_INSTRUCTION = SYSTEM_INSTRUCTION + """
+        **Batch Mode**:
+        - The user input contains several independent sections, each starting with a header like "### Section 1".
+        - Treat every section as a separate request and apply all the rules above to each section on its own.
+        - Instead of a single `quiz`/`notes` object, return a JSON object with one key, `results`: an array with exactly one entry per section, in section order.
+        - Each entry contains `section` (the section number as an integer), `quiz` and `notes`, exactly as described in the Output Format.
+"""
+
+PUZZLE_SYSTEM_INSTRUCTION = SYSTEM_INSTRUCTION + """
+        **Daily Puzzle Mode**:
+        - There is no real user input; the input asks you to choose the phrases yourself. Do not add a note about missing input.
+        - Add a `question_type` string to each quiz item: one of "Multiple-choice", "Fill-in-the-blank", "Matching", "Contextual usage".
+"""
+
+
+def get_ai_prompt(user_level, input_phrases):
+    """Per-request payload that goes with SYSTEM_INSTRUCTION."""
+    return f"Learner level: {user_level}\n\nUser Input:\n{input_phrases}"
+
+
+def get_batch_ai_prompt(user_level, sections):
+    """Payload for several independent inputs of the same level, answered in one JSON reply (BATCH_SYSTEM_INSTRUCTION)."""
+    input_phrases = "\n\n".join(f"### Section {number}\n{section}" for number, section in enumerate(sections, start=1))
+    return get_ai_prompt(user_level, input_phrases) + f"\n\n({len(sections)} sections, return exactly {len(sections)} results.)"
+
+
+def get_puzzle_generation_prompt(user_level, count, avoid_phrases=()):
+    """Payload for daily puzzles at a level, without user input (PUZZLE_SYSTEM_INSTRUCTION)."""
+    avoid_text = f" Do not use any of these, they were used recently: {', '.join(avoid_phrases)}." if avoid_phrases else ""
+    input_phrases = (
+        f"(No user input. Choose {count} different useful English idioms, phrasal verbs or collocations "
+        f"that suit the {user_level} level and treat them as the input list.{avoid_text})"
+    )
+    return get_ai_prompt(user_level, input_phrases)
+
+
+def get_prompt_version() -> str:
+    """Short hash of every system instruction and payload template. Changes whenever any of these texts changes."""
+    template = "\n".join([
+        SYSTEM_INSTRUCTION,
+        BATCH_SYSTEM_INSTRUCTION,
+        PUZZLE_SYSTEM_INSTRUCTION,
+        get_ai_prompt("{user_level}", "{input_phrases}"),
+        get_batch_ai_prompt("{user_level}", ["{section}"]),
+        get_puzzle_generation_prompt("{user_level}", "{count}", ["{avoid_phrases}"]),
+    ])
+    return hashlib.sha256(template.encode('utf-8')).hexdigest()[:16]
+
+
+PROMPT_VERSION = get_prompt_version()
+
@@ -0,0 +1,79 @@
+from typing import List, Dict, Any
+
+from config import (
+    logger,
+    CEFR_LEVELS,
+    PUZZLE_STOCK_TARGET,
+    PUZZLE_GENERATION_BATCH,
+    PUZZLE_GENERATION_MAX_REQUESTS,
+    PUZZLE_GENERATION_MAX_TOKENS
+)
+from prompt import PUZZLE_SYSTEM_INSTRUCTION, get_puzzle_generation_prompt
+from utilities import generate_ai_json_async, ai_usage
+from quiz_validation import validate_quiz
+
+
+class PuzzleStocker:
+    """
+    Keeps the puzzle bank of every CEFR level topped up to PUZZLE_STOCK_TARGET unconsumed items,
+    generating them with the AI in batches. A run stops after max_requests AI calls, or once its calls
+    have used max_tokens tokens (0 for no token limit).
+    """
+
+    def __init__(self,
+                 db_manager,
+                 target: int = PUZZLE_STOCK_TARGET,
+                 batch_size: int = PUZZLE_GENERATION_BATCH,
+                 max_requests: int = PUZZLE_GENERATION_MAX_REQUESTS,
+                 max_tokens: int = PUZZLE_GENERATION_MAX_TOKENS):
+        self.db_manager = db_manager
+        self.target = target
+        self.batch_size = batch_size
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+
+    def _tokens_used_since(self, start_tokens: int) -> int:
+        return ai_usage.totals("puzzle_stock")["total_tokens"] - start_tokens
+
+    async def top_up(self) -> Dict[str, int]:
+        """Generates missing puzzles, lowest stock first. Returns {level: puzzles added}."""
+        stock = {level: await self.db_manager.count_available_puzzles(level) for level in CEFR_LEVELS}
+        added = {level: 0 for level in CEFR_LEVELS}
+        requests_left = self.max_requests
+        start_tokens = ai_usage.totals("puzzle_stock")["total_tokens"]
+
+        # Round-robin over the levels that are short, emptiest first, so a small budget is spread fairly
+        while requests_left > 0:
+            short_levels = sorted((level for level in CEFR_LEVELS if stock[level] < self.target), key=lambda level: stock[level])
+            if not short_levels:
+                break
+            for level in short_levels:
+                if self.max_tokens and self._tokens_used_since(start_tokens) >= self.max_tokens:
+                    requests_left = 0
+                if requests_left <= 0:
+                    break
+                count = min(self.batch_size, self.target - stock[level])
+                items = await self._generate(level, count)
+                requests_left -= 1
+                if not items:
+                    stock[level] = self.target # Don't keep spending budget on a level that fails
+                    continue
+                added[level] += await self.db_manager.add_puzzles(items, level=level, source="pregenerated")
+                stock[level] += len(items)
+
+        if requests_left <= 0:
+            logger.info(f"Puzzle stock top-up stopped at its budget of {self.max_requests} AI requests / {self.max_tokens or 'unlimited'} tokens.")
+        logger.info(f"Puzzle stock top-up finished. Added: {added}, tokens used: {self._tokens_used_since(start_tokens)}")
+        return added
+
+    async def _generate(self, level: str, count: int) -> List[Dict[str, Any]]:
+        avoid_phrases = await self.db_manager.get_recent_puzzle_phrases(level, limit=100)
+        response = await generate_ai_json_async(get_puzzle_generation_prompt(level, count, avoid_phrases),
+                                                system_instruction=PUZZLE_SYSTEM_INSTRUCTION,
+                                                kind="puzzle_stock")
+        items, rejected = validate_quiz(response.get('quiz') or [])
+        if rejected:
+            logger.debug(f"Dropped {len(rejected)} generated puzzles for level {level} that fail poll limits.")
+        if not items:
+            logger.warning(f"Puzzle generation for level {level} returned no usable items: {response.get('notes')}")
+        return items[:count]
@@ -0,0 +1,70 @@
+import asyncio
+from typing import List, Optional, Dict, Any, Tuple
+
+from config import logger, SAMPLED, AI_BATCH_WINDOW_SECONDS, AI_BATCH_MAX_SIZE
+from utilities import get_quiz_from_ai_async, get_batch_quiz_from_ai_async
+
+
+class QuizBatcher:
+    """
+    Collects quiz requests that arrive within a short window, groups them by level and
+    sends each group to the AI as one multi-section prompt. Every caller awaits its own section.
+    """
+
+    def __init__(self, window_seconds: float = AI_BATCH_WINDOW_SECONDS, max_batch_size: int = AI_BATCH_MAX_SIZE):
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks = set()
+        self.batches_sent = 0
+        self.requests_batched = 0
+
+    async def generate(self, input_phrases: str, user_level: Optional[str]) -> Dict[str, Any]:
+        """Returns the quiz for input_phrases, possibly generated together with other requests."""
+        if self.max_batch_size <= 1 or self.window_seconds <= 0:
+            return await get_quiz_from_ai_async(input_phrases, user_level=user_level)
+
+        loop = asyncio.get_running_loop()
+        level = user_level or ''
+        future = loop.create_future()
+        pending = self._pending.setdefault(level, [])
+        pending.append((input_phrases, future))
+
+        if len(pending) >= self.max_batch_size:
+            self._flush(level)
+        elif level not in self._timers:
+            self._timers[level] = loop.call_later(self.window_seconds, self._flush, level)
+        return await future
+
+    def _flush(self, level: str) -> None:
+        timer = self._timers.pop(level, None)
+        if timer:
+            timer.cancel()
+        batch = [(text, future) for text, future in self._pending.pop(level, []) if not future.cancelled()]
+        if not batch:
+            return
+        task = asyncio.create_task(self._run_batch(level, batch))
+        self._tasks.add(task) # Keep a reference until done
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, level: str, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        user_level = level or None
+        try:
+            if len(batch) == 1:
+                results = [await get_quiz_from_ai_async(batch[0][0], user_level=user_level)]
+            else:
+                logger.info("Sending batched AI request with %s sections for level %s.", len(batch), level or 'N/A', extra=SAMPLED)
+                results = await get_batch_quiz_from_ai_async([text for text, _ in batch], user_level=user_level)
+                self.batches_sent += 1
+                self.requests_batched += len(batch)
+        except Exception as e:
+            logger.error(f"Batched AI request for level {level or 'N/A'} failed: {e}", exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,184 @@
+import re
+import json
+import time
+import hashlib
+import datetime
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Tuple
+
+from config import logger, QUIZ_CACHE_MAX_SIZE, QUIZ_CACHE_TTL_SECONDS, QUIZ_CACHE_DB_TTL_DAYS
+from prompt import PROMPT_VERSION
+
+
+def normalize_phrase(phrase: str) -> str:
+    """Lowercases a phrase and collapses its whitespace."""
+    return re.sub(r"\s+", " ", phrase.lower()).strip()
+
+
+def split_phrases(input_phrases: str) -> List[str]:
+    """Splits user input on commas/newlines into normalized, de-duplicated phrases (input order kept)."""
+    return list(split_phrase_texts(input_phrases))
+
+
+def split_phrase_texts(input_phrases: str) -> Dict[str, str]:
+    """
+    Like split_phrases, but maps each normalized phrase (the cache key) to the text the user wrote,
+    which is what the AI should see (its casing and spelling are what gets corrected).
+    """
+    texts: Dict[str, str] = {}
+    for part in re.split(r"[,\n]", input_phrases):
+        phrase = normalize_phrase(part)
+        if phrase and phrase not in texts:
+            texts[phrase] = part.strip()
+    return texts
+
+
+def normalize_input(input_phrases: str) -> str:
+    """Re-joins the normalized phrases so equivalent inputs produce the same cache key."""
+    return ", ".join(split_phrases(input_phrases))
+
+
+class QuizCache:
+    """
+    Two-tier cache for AI quiz responses.
+    Tier 1 is an in-process LRU bounded by size and TTL, tier 2 is the quiz_cache SQLite table.
+    Keys include the prompt version, so a changed prompt template never serves old quizzes.
+    """
+
+    def __init__(self,
+                 db_manager,
+                 max_size: int = QUIZ_CACHE_MAX_SIZE,
+                 ttl_seconds: int = QUIZ_CACHE_TTL_SECONDS,
+                 db_ttl_days: int = QUIZ_CACHE_DB_TTL_DAYS,
+                 prompt_version: str = PROMPT_VERSION):
+        self.db_manager = db_manager
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.db_max_age = datetime.timedelta(days=db_ttl_days) if db_ttl_days > 0 else None
+        self.prompt_version = prompt_version
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def make_key(self, input_phrases: str, user_level: Optional[str]) -> str:
+        raw = f"{self.prompt_version}|{user_level or ''}|{normalize_input(input_phrases)}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def get(self, input_phrases: str, user_level: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Returns a cached quiz response, or None on a miss."""
+        key = self.make_key(input_phrases, user_level)
+
+        entry = self._entries.get(key)
+        if entry:
+            stored_at, quiz_data = entry
+            if time.monotonic() - stored_at <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                logger.debug("Quiz cache memory hit for key %.12s.", key)
+                return quiz_data
+            del self._entries[key]
+
+        cached_json = await self.db_manager.get_cached_quiz(key, max_age=self.db_max_age)
+        if cached_json:
+            try:
+                quiz_data = json.loads(cached_json)
+            except json.JSONDecodeError as e:
+                logger.error(f"Corrupt quiz cache entry {key[:12]}: {e}")
+            else:
+                self._remember(key, quiz_data)
+                self.db_hits += 1
+                logger.debug("Quiz cache database hit for key %.12s.", key)
+                return quiz_data
+
+        self.misses += 1
+        return None
+
+    async def put(self, input_phrases: str, user_level: Optional[str], quiz_data: Dict[str, Any]) -> None:
+        """Stores a quiz response in both tiers. Empty/failed responses are not cached."""
+        if not quiz_data or not quiz_data.get('quiz'):
+            return
+        key = self.make_key(input_phrases, user_level)
+        self._remember(key, quiz_data)
+        await self.db_manager.save_cached_quiz(
+            key,
+            self.prompt_version,
+            user_level,
+            normalize_input(input_phrases),
+            json.dumps(quiz_data, ensure_ascii=False)
+        )
+
+    async def invalidate(self, stale_only: bool = True) -> int:
+        """
+        Drops cached quizzes. With stale_only, only entries from other prompt versions are
+        removed from the database (current-version entries stay valid).
+        """
+        self._entries.clear()
+        return await self.db_manager.delete_quiz_cache(keep_prompt_version=self.prompt_version if stale_only else None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+            "memory_size": len(self._entries),
+        }
+
+    def _remember(self, key: str, quiz_data: Dict[str, Any]) -> None:
+        self._entries[key] = (time.monotonic(), quiz_data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class PhraseItemStore:
+    """
+    Stores generated quiz items per (phrase, level, prompt version) in the phrase_items table,
+    so phrases seen before never go back to the AI.
+    """
+
+    def __init__(self, db_manager, prompt_version: str = PROMPT_VERSION):
+        self.db_manager = db_manager
+        self.prompt_version = prompt_version
+        self.hits = 0
+        self.misses = 0
+
+    async def get_many(self, phrases: List[str], user_level: Optional[str]) -> Dict[str, Dict[str, Any]]:
+        """Returns {phrase: quiz item} for the phrases that already have a stored item."""
+        stored = await self.db_manager.get_phrase_items(phrases, user_level or '', self.prompt_version)
+        items = {}
+        for phrase, item_json in stored.items():
+            try:
+                items[phrase] = json.loads(item_json)
+            except json.JSONDecodeError as e:
+                logger.error(f"Corrupt phrase item for '{phrase}': {e}")
+        self.hits += len(items)
+        self.misses += len(phrases) - len(items)
+        return items
+
+    async def store_from_response(self, phrases: List[str], user_level: Optional[str], quiz_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """
+        Matches the items of an AI response back to the phrases they were generated for and stores them.
+        Only items whose `phrase` field matches an input phrase (after normalization) are stored;
+        the others (e.g. for a corrected phrase) can't be attributed safely and are left to the caller.
+        Returns {phrase: quiz item} for the matched phrases.
+        """
+        matched = match_items_to_phrases(phrases, (quiz_data or {}).get('quiz') or [])
+        await self.db_manager.save_phrase_items(
+            {phrase: json.dumps(item, ensure_ascii=False) for phrase, item in matched.items()},
+            user_level or '',
+            self.prompt_version
+        )
+        return matched
+
+
+def match_items_to_phrases(phrases: List[str], quiz_items: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Maps quiz items to the input phrases they belong to (see PhraseItemStore.store_from_response)."""
+    matched: Dict[str, Dict[str, Any]] = {}
+    for item in quiz_items:
+        phrase = normalize_phrase(str(item.get('phrase') or ''))
+        if phrase in phrases and phrase not in matched:
+            matched[phrase] = item
+    return matched
@@ -0,0 +1,156 @@
+from typing import Awaitable, Callable, Optional, Dict, Any
+
+from config import logger, AI_STREAMING
+from quiz_cache import QuizCache, PhraseItemStore, split_phrase_texts
+from quiz_batcher import QuizBatcher
+from utilities import get_quiz_from_ai_async, stream_quiz_from_ai_async
+from quiz_validation import normalize_quiz_item
+from user_limits import UserRateLimiter
+
+
+class QuizGenerator:
+    """
+    Produces quizzes for user notes, going to the AI only for what is not stored yet:
+    whole-input cache first, then per-phrase items, then one AI call for the missing phrases.
+    Only that AI call counts against the user's rate limit; stored quizzes are always served.
+    """
+
+    def __init__(self, db_manager, streaming: bool = AI_STREAMING, user_rate_limiter: Optional[UserRateLimiter] = None):
+        self.quiz_cache = QuizCache(db_manager)
+        self.phrase_store = PhraseItemStore(db_manager)
+        self.batcher = QuizBatcher()
+        self.streaming = streaming
+        self.user_rate_limiter = user_rate_limiter or UserRateLimiter()
+        self.items_rejected = 0
+        self.items_rerequested = 0
+
+    async def generate(self,
+                       input_phrases: str,
+                       user_level: Optional[str],
+                       on_item: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+                       user_id: Optional[int] = None
+                       ) -> Dict[str, Any]:
+        """
+        Returns the quiz for input_phrases. With `on_item`, every item of the returned quiz is also
+        passed to on_item as soon as it is available: stored items right away, generated ones as the
+        AI streams them (the returned order can differ from the order items were delivered in).
+        If user_id is over its AI rate limit, only stored items are returned and the notes say so.
+        """
+        quiz_response = await self.quiz_cache.get(input_phrases, user_level)
+        if quiz_response is not None:
+            await self._deliver(quiz_response.get('quiz') or [], on_item)
+            return quiz_response
+
+        phrase_texts = split_phrase_texts(input_phrases)
+        phrases = list(phrase_texts)
+        if not phrases: # Nothing to split on, let the AI handle it as-is (e.g. sample questions)
+            if (wait := self._rate_limited(user_id)):
+                return {"quiz": [], "notes": self._rate_limit_notes(wait)}
+            quiz_response = await self._generate_with_ai(input_phrases, user_level, on_item)
+            await self.quiz_cache.put(input_phrases, user_level, quiz_response)
+            return quiz_response
+
+        items = await self.phrase_store.get_many(phrases, user_level)
+        missing_phrases = [phrase for phrase in phrases if phrase not in items]
+        logger.debug("Phrase store: %s stored, %s to generate.", len(items), len(missing_phrases))
+        await self._deliver([items[phrase] for phrase in phrases if phrase in items], on_item)
+
+        notes: Dict[str, Any] = {}
+        extra_items = []
+        if missing_phrases and (wait := self._rate_limited(user_id)):
+            notes = self._rate_limit_notes(wait)
+        elif missing_phrases:
+            # The AI sees what the user wrote (the normalized phrases are only cache keys); the whole
+            # input as-is when nothing was stored, so sentences split on their commas stay intact
+            ai_input = input_phrases if len(missing_phrases) == len(phrases) else ", ".join(phrase_texts[phrase] for phrase in missing_phrases)
+            ai_response = await self._generate_with_ai(ai_input, user_level, on_item)
+            generated = await self.phrase_store.store_from_response(missing_phrases, user_level, ai_response)
+            items.update(generated)
+            notes = ai_response.get('notes') or {}
+            # Items the AI produced that don't map to a phrase (e.g. corrected input) are still sent
+            extra_items = [item for item in ai_response.get('quiz') or [] if item not in generated.values()]
+            if not items and not extra_items:
+                return ai_response # Nothing usable, pass the AI's error/notes through
+
+        if not notes:
+            notes = {"message": "Here's your quiz! Keep practicing! 😊🌟"}
+
+        quiz_response = {
+            "quiz": [items[phrase] for phrase in phrases if phrase in items] + extra_items,
+            "notes": notes
+        }
+        if len(items) == len(phrases): # Only cache complete quizzes
+            await self.quiz_cache.put(input_phrases, user_level, quiz_response)
+        return quiz_response
+
+    async def _generate_with_ai(self, input_phrases: str, user_level: Optional[str], on_item) -> Dict[str, Any]:
+        """
+        AI call whose items are checked against Telegram's poll limits before delivery. Fixable items
+        are repaired; the phrases of irreparable ones are re-requested once, in a single follow-up call.
+        """
+        valid_items = []
+        irreparable_items = []
+
+        async def deliver_valid(item) -> None:
+            normalized = normalize_quiz_item(item)
+            if normalized is None:
+                irreparable_items.append(item)
+                return
+            valid_items.append(normalized)
+            await self._deliver([normalized], on_item)
+
+        if on_item is not None and self.streaming:
+            # Streamed requests skip the batcher: waiting for a batch would delay the first poll
+            ai_response = await stream_quiz_from_ai_async(input_phrases, user_level, deliver_valid)
+        else:
+            ai_response = await self.batcher.generate(input_phrases, user_level)
+            for item in ai_response.get('quiz') or []:
+                await deliver_valid(item)
+
+        retry_phrases = [str(item.get('phrase') or item.get('question')) for item in irreparable_items
+                         if isinstance(item, dict) and (item.get('phrase') or item.get('question'))]
+        if retry_phrases:
+            logger.info(f"Re-requesting {len(retry_phrases)} quiz items that failed validation.")
+            self.items_rerequested += len(retry_phrases)
+            retry_response = await get_quiz_from_ai_async(", ".join(retry_phrases), user_level=user_level)
+            for item in retry_response.get('quiz') or []:
+                normalized = normalize_quiz_item(item)
+                if normalized is not None:
+                    valid_items.append(normalized)
+                    await self._deliver([normalized], on_item)
+        if irreparable_items:
+            self.items_rejected += len(irreparable_items)
+
+        ai_response['quiz'] = valid_items
+        return ai_response
+
+    def _rate_limited(self, user_id: Optional[int]) -> float:
+        """Seconds until user_id may trigger another AI call, 0.0 if it may now."""
+        return self.user_rate_limiter.check(user_id) if user_id is not None else 0.0
+
+    @staticmethod
+    def _rate_limit_notes(wait: float) -> Dict[str, Any]:
+        return {"message": f"⏳ You're sending notes faster than I can make quizzes! "
+                           f"Please send the new ones again in about {max(1, round(wait))} seconds. 😊"}
+
+    @staticmethod
+    async def _deliver(items, on_item) -> None:
+        if on_item is not None:
+            for item in items:
+                await on_item(item)
+
+    async def invalidate(self) -> int:
+        """Drops cache entries and phrase items generated with an older prompt template."""
+        return await self.quiz_cache.invalidate()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.quiz_cache.stats(),
+            "phrase_hits": self.phrase_store.hits,
+            "phrase_misses": self.phrase_store.misses,
+            "ai_batches_sent": self.batcher.batches_sent,
+            "ai_requests_batched": self.batcher.requests_batched,
+            "items_rejected": self.items_rejected,
+            "items_rerequested": self.items_rerequested,
+            "ai_rate_limited": self.user_rate_limiter.limited,
+        }
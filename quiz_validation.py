@@ -0,0 +1,96 @@
+from typing import List, Optional, Dict, Any, Tuple
+
+from telegram.constants import PollLimit
+
+from config import logger
+
+MAX_EXPLANATION_LINE_FEEDS = 2 # Telegram allows at most 2 line feeds in a quiz explanation
+
+
+def _truncate(text: str, limit: int) -> str:
+    """Cuts text to `limit` characters, at a word boundary when one is close, ending with an ellipsis."""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit - 1]
+    space = cut.rfind(' ')
+    if space > limit * 0.6:
+        cut = cut[:space]
+    return cut.rstrip(' ,.;:') + "…"
+
+
+def _answer_index(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+
+def normalize_quiz_item(item: Any) -> Optional[Dict[str, Any]]:
+    """
+    Checks a quiz item against Telegram's poll limits and repairs what can be repaired locally:
+    truncates long question/option/explanation text, drops empty or duplicate options, trims extra
+    options and fixes a numeric-string answer_index. Returns the repaired copy, or None when the item
+    can't be sent (no question, fewer than 2 options, or no valid correct option).
+    """
+    if not isinstance(item, dict):
+        return None
+
+    question = str(item.get('question') or '').strip()
+    if len(question) < PollLimit.MIN_QUESTION_LENGTH:
+        return None
+    options = item.get('options')
+    if not isinstance(options, list):
+        return None
+    answer_index = _answer_index(item.get('answer_index'))
+    if answer_index is None or not 0 <= answer_index < len(options):
+        return None
+
+    correct_option = _truncate(str(options[answer_index]).strip(), PollLimit.MAX_OPTION_LENGTH)
+    if not correct_option:
+        return None
+    cleaned_options = []
+    for position, option in enumerate(options):
+        option = _truncate(str(option).strip(), PollLimit.MAX_OPTION_LENGTH)
+        if position == answer_index:
+            cleaned_options.append(option)
+        elif option and option != correct_option and option not in cleaned_options:
+            cleaned_options.append(option)
+    if len(cleaned_options) != len(set(cleaned_options)): # Truncation made the correct option collide with another
+        return None
+    if len(cleaned_options) > PollLimit.MAX_OPTION_NUMBER:
+        keep = set(cleaned_options[:PollLimit.MAX_OPTION_NUMBER - 1]) | {correct_option}
+        cleaned_options = [option for option in cleaned_options if option in keep][:PollLimit.MAX_OPTION_NUMBER]
+    if len(cleaned_options) < PollLimit.MIN_OPTION_NUMBER:
+        return None
+
+    normalized = dict(item)
+    normalized['question'] = _truncate(question, PollLimit.MAX_QUESTION_LENGTH)
+    normalized['options'] = cleaned_options
+    normalized['answer_index'] = cleaned_options.index(correct_option)
+
+    explanation = item.get('explanation')
+    if explanation:
+        lines = str(explanation).strip().split('\n')
+        explanation = '\n'.join(lines[:MAX_EXPLANATION_LINE_FEEDS] + [' '.join(lines[MAX_EXPLANATION_LINE_FEEDS:])]).strip()
+        normalized['explanation'] = _truncate(explanation, PollLimit.MAX_EXPLANATION_LENGTH)
+    else:
+        normalized.pop('explanation', None)
+
+    if normalized != item:
+        logger.debug(f"Repaired quiz item: {question[:50]}")
+    return normalized
+
+
+def validate_quiz(items: List[Any]) -> Tuple[List[Dict[str, Any]], List[Any]]:
+    """Splits quiz items into (sendable items, after repair) and (items that could not be repaired)."""
+    valid, irreparable = [], []
+    for item in items:
+        normalized = normalize_quiz_item(item)
+        if normalized is None:
+            irreparable.append(item)
+        else:
+            valid.append(normalized)
+    return valid, irreparable
@@ -0,0 +1,70 @@
+import json
+import time
+from typing import Any, Dict, List
+
+from config import (
+    logger,
+    REVIEW_INTERVALS_HOURS,
+    REVIEW_BATCH_SIZE,
+    REVIEW_MAX_PER_USER,
+    REVIEW_RESEND_HOURS
+)
+from database import AnsweredItem, DueReview
+
+
+class ReviewScheduler:
+    """
+    Spaced repetition of the quiz items a user got wrong. Counted poll answers (from PollTracker)
+    schedule a review of every missed item after the first of REVIEW_INTERVALS_HOURS; each right
+    answer to a review moves it to the next interval, until the item is learned.
+    tick() sends the reviews that are due, read through the (due_at, user_id) index, so its cost
+    depends on the number of due reviews, not on the number of users or items.
+    """
+
+    def __init__(self,
+                 db_manager,
+                 outbox,
+                 intervals_hours: List[float] = REVIEW_INTERVALS_HOURS,
+                 batch_size: int = REVIEW_BATCH_SIZE,
+                 max_per_user: int = REVIEW_MAX_PER_USER,
+                 resend_hours: float = REVIEW_RESEND_HOURS):
+        self.db_manager = db_manager
+        self.outbox = outbox
+        self.intervals_hours = intervals_hours
+        self.batch_size = batch_size
+        self.max_per_user = max_per_user
+        self.resend_seconds = resend_hours * 3600
+        self.rescheduled = 0
+        self.sent = 0
+
+    async def record_answers(self, answered: List[AnsweredItem]) -> None:
+        """PollTracker on_counted hook: reschedules the reviews of the answered items."""
+        self.rescheduled += await self.db_manager.update_reviews(answered, self.intervals_hours)
+
+    async def tick(self) -> int:
+        """Queues every due review in the outbox, a short intro and the item's poll per user. Returns the polls queued."""
+        queued = 0
+        while True:
+            due = await self.db_manager.take_due_reviews(self.batch_size, self.max_per_user, self.resend_seconds)
+            if not due:
+                break
+            by_user: Dict[int, List[DueReview]] = {}
+            for review in due:
+                by_user.setdefault(review.user_id, []).append(review)
+            claimed_at = int(time.time())
+            for user_id, reviews in by_user.items():
+                intro = ("🔁 Review time! This question tripped you up before, give it another go:" if len(reviews) == 1
+                         else "🔁 Review time! These questions tripped you up before, give them another go:")
+                await self.outbox.send_message(user_id, intro, idempotency_key=f"review:{user_id}:{claimed_at}:intro")
+                for review in reviews:
+                    if await self.outbox.enqueue(user_id, "send_poll", json.loads(review.payload),
+                                                 idempotency_key=f"review:{user_id}:{review.item_key}:{claimed_at}"):
+                        queued += 1
+        self.sent += queued
+        if queued:
+            logger.info(f"Queued {queued} review polls.")
+        return queued
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rescheduled": self.rescheduled, "sent": self.sent}
+
@@ -0,0 +1,70 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from config import logger
+
+# A route handler returns (HTTP status code, content type, body)
+RouteHandler = Callable[[], Awaitable[Tuple[int, str, str]]]
+
+_REASONS = {200: "OK", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class StatusServer:
+    """
+    Tiny HTTP/1.0 server on the bot's event loop for operational endpoints (e.g. /health),
+    separate from the webhook listener so it also works in polling mode.
+    Only GET and HEAD are supported and every connection is closed after one response.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes: Dict[str, RouteHandler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def add_route(self, path: str, handler: RouteHandler) -> None:
+        self._routes[path] = handler
+
+    async def start(self) -> None:
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Status server listening on {self.host}:{self.port} ({', '.join(self._routes)}).")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), timeout=5)).decode('latin-1').split()
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass # Headers are not needed
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1].split('?', 1)[0]
+
+            handler = self._routes.get(path)
+            if method not in ("GET", "HEAD"):
+                status, content_type, body = 405, "text/plain", "Method Not Allowed\n"
+            elif handler is None:
+                status, content_type, body = 404, "text/plain", "Not Found\n"
+            else:
+                try:
+                    status, content_type, body = await handler()
+                except Exception as e:
+                    logger.error(f"Status server: error serving {path}: {e}", exc_info=True)
+                    status, content_type, body = 500, "text/plain", "Internal Server Error\n"
+
+            payload = body.encode('utf-8')
+            head = (f"HTTP/1.0 {status} {_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}; charset=utf-8\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "Connection: close\r\n\r\n")
+            writer.write(head.encode('latin-1') + (payload if method != "HEAD" else b""))
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,129 @@
+import asyncio
+from typing import Any, Awaitable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import logger, UPDATE_CONCURRENCY, UPDATE_SHARDS, UPDATE_MAX_PENDING
+
+
+def update_chat_key(update: object) -> Optional[int]:
+    """The chat an update belongs to (the user for chat-less updates like poll answers), or None."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class PendingLimitQueue(asyncio.Queue):
+    """
+    The Application's update_queue, with backpressure. Application takes every update off the queue
+    at once and starts a task for it, so a plain queue never fills up; here put() (polling and the
+    webhook server both await it) waits instead while `max_pending` updates are queued or not yet
+    processed (Application calls task_done() once an update's handlers finished).
+    Polling then stops fetching and webhook requests are answered later, so the backlog stays with Telegram.
+    """
+
+    def __init__(self, max_pending: int = UPDATE_MAX_PENDING):
+        super().__init__()
+        self.max_pending = max(1, max_pending)
+        self._room = asyncio.Event()
+        self._room.set()
+        self.paused = 0
+
+    async def put(self, item: object) -> None:
+        if isinstance(item, Update): # Control items (the stop signal) never wait
+            while self._unfinished_tasks >= self.max_pending:
+                self._room.clear()
+                self.paused += 1
+                await self._room.wait()
+        await super().put(item)
+
+    def task_done(self) -> None:
+        super().task_done()
+        if self._unfinished_tasks < self.max_pending:
+            self._room.set()
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently (up to `concurrency` at once) while updates
+    of the same chat run one after another, in arrival order.
+    An update first waits for its chat's lock and only then for a free slot, so a busy chat
+    queues behind itself instead of occupying slots other chats could use.
+    Chats are grouped into `shards` (chat id modulo shards) for the queue depth metrics in stats().
+    """
+
+    def __init__(self,
+                 concurrency: int = UPDATE_CONCURRENCY,
+                 shards: int = UPDATE_SHARDS,
+                 max_pending: int = UPDATE_MAX_PENDING):
+        # Only caps the updates inside do_process_update at once; intake is bounded by PendingLimitQueue
+        super().__init__(max_concurrent_updates=max(max_pending, concurrency))
+        self.concurrency = concurrency
+        self.shards = max(1, shards)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+        self._shard_depth: List[int] = [0] * self.shards
+        self._pending = 0
+        self._running = 0
+        self.processed = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_key = update_chat_key(update)
+        self._pending += 1
+        try:
+            if chat_key is None:
+                async with self._slots:
+                    await self._run(coroutine)
+            else:
+                await self._process_in_chat_order(chat_key, coroutine)
+        finally:
+            self._pending -= 1
+
+    async def _process_in_chat_order(self, chat_key: int, coroutine: Awaitable[Any]) -> None:
+        shard = chat_key % self.shards
+        self._shard_depth[shard] += 1
+        lock = self._chat_locks.get(chat_key)
+        if lock is None:
+            lock = self._chat_locks[chat_key] = asyncio.Lock()
+        self._chat_waiters[chat_key] = self._chat_waiters.get(chat_key, 0) + 1
+        try:
+            async with lock:
+                async with self._slots:
+                    await self._run(coroutine)
+        finally:
+            self._shard_depth[shard] -= 1
+            self._chat_waiters[chat_key] -= 1
+            if not self._chat_waiters[chat_key]: # Last update of this chat, forget its lock
+                del self._chat_waiters[chat_key]
+                del self._chat_locks[chat_key]
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        self._running += 1
+        try:
+            await coroutine
+        finally:
+            self._running -= 1
+            self.processed += 1
+
+    async def initialize(self) -> None:
+        logger.info(f"Processing updates with per-chat ordering, up to {self.concurrency} chats at once.")
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Backpressure snapshot: running updates, updates waiting, and queued updates per shard."""
+        return {
+            "running": self._running,
+            "waiting": self._pending - self._running,
+            "active_chats": len(self._chat_locks),
+            "processed": self.processed,
+            "shard_depth": list(self._shard_depth),
+            "max_shard_depth": max(self._shard_depth),
+        }
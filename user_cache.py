@@ -0,0 +1,96 @@
+import datetime
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+
+from config import logger, USER_CACHE_MAX_SIZE
+
+
+class UserProfileCache:
+    """
+    Bounded read-through cache of user rows (level, daily_puzzle, ...) in front of DatabaseManager.
+    Settings changes are written through and patched into the cached profile in place.
+    "Last seen" timestamps are only recorded in memory by touch() and written in one batch by flush(),
+    so the per-message path makes no database round-trips once a profile is cached.
+    """
+
+    def __init__(self, db_manager, max_size: int = USER_CACHE_MAX_SIZE):
+        self.db_manager = db_manager
+        self.max_size = max_size
+        self._profiles: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._pending_touches: Dict[int, datetime.datetime] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get_profile(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Returns the user's row (as DatabaseManager.get_user does), loading it on a cache miss."""
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self._profiles.move_to_end(user_id)
+            self.hits += 1
+            return profile
+
+        self.misses += 1
+        profile = await self.db_manager.get_user(user_id)
+        if profile is not None:
+            self._remember(user_id, profile)
+        return profile
+
+    async def update(self,
+                     user_id: int,
+                     username: Optional[str] = None,
+                     level: Optional[str] = None,
+                     daily_puzzle: Optional[bool] = None,
+                     delivery_minute: Optional[int] = None,
+                     timezone: Optional[str] = None
+                     ) -> bool:
+        """Same as DatabaseManager.add_or_update_user, keeping the cached profile in sync."""
+        success = await self.db_manager.add_or_update_user(user_id, username=username, level=level, daily_puzzle=daily_puzzle,
+                                                           delivery_minute=delivery_minute, timezone=timezone)
+        if not success:
+            return False
+        self._pending_touches.pop(user_id, None) # The write above already set the timestamp
+
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            if username is not None:
+                profile['username'] = username
+            if level is not None:
+                profile['level'] = level
+            if daily_puzzle is not None:
+                profile['daily_puzzle'] = daily_puzzle
+            if delivery_minute is not None:
+                profile['delivery_minute'] = delivery_minute
+            if timezone is not None:
+                profile['timezone'] = timezone
+        return True
+
+    def touch(self, user_id: int) -> None:
+        """Records that the user was active now. Written to the database on the next flush()."""
+        self._pending_touches[user_id] = datetime.datetime.now()
+
+    async def flush(self) -> int:
+        """Writes all pending "last seen" timestamps in one batch. Returns how many users were written."""
+        if not self._pending_touches:
+            return 0
+        touches, self._pending_touches = self._pending_touches, {}
+        if not await self.db_manager.touch_users(touches):
+            # Put them back unless a newer touch arrived in the meantime
+            for user_id, timestamp in touches.items():
+                self._pending_touches.setdefault(user_id, timestamp)
+            return 0
+        logger.debug(f"Flushed last-seen timestamps for {len(touches)} users.")
+        return len(touches)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._profiles),
+            "pending_touches": len(self._pending_touches),
+        }
+
+    def _remember(self, user_id: int, profile: Dict[str, Any]) -> None:
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
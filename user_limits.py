@@ -0,0 +1,124 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+from config import (
+    logger,
+    SAMPLED,
+    NOTE_COALESCE_SECONDS,
+    NOTE_COALESCE_MAX_SECONDS,
+    AI_USER_MAX_CALLS,
+    AI_USER_PERIOD_SECONDS
+)
+from broadcast import TokenBucket
+
+
+class _Burst:
+    """Messages of one chat collected so far, and when they are due to be processed."""
+
+    def __init__(self, deadline: float, max_deadline: float, context: Any):
+        self.items: List[Any] = []
+        self.deadline = deadline
+        self.max_deadline = max_deadline
+        self.context = context
+        self.flush_now = asyncio.Event()
+
+
+class NoteCoalescer:
+    """
+    Merges messages a chat sends in quick succession into one call of `process(items, context)`.
+    A burst is processed once the chat has been quiet for `window_seconds`, or `max_wait_seconds`
+    after its first message at the latest. While a burst of a chat is being processed, new messages
+    of that chat collect into the next burst, which starts when the previous one is done.
+    add() returns right away, so a burst never holds up the chat's other updates.
+    """
+
+    def __init__(self,
+                 process: Callable[[List[Any], Any], Awaitable[None]],
+                 window_seconds: float = NOTE_COALESCE_SECONDS,
+                 max_wait_seconds: float = NOTE_COALESCE_MAX_SECONDS):
+        self.process = process
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max(max_wait_seconds, window_seconds)
+        self._bursts: Dict[int, _Burst] = {}
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.messages = 0
+        self.bursts = 0
+
+    def add(self, chat_id: int, item: Any, context: Any = None) -> bool:
+        """Adds a message to the chat's open burst. Returns True if it started a new burst."""
+        self.messages += 1
+        now = asyncio.get_running_loop().time()
+        burst = self._bursts.get(chat_id)
+        if burst is not None:
+            burst.items.append(item)
+            burst.deadline = min(now + self.window_seconds, burst.max_deadline)
+            burst.context = context
+            return False
+
+        burst = self._bursts[chat_id] = _Burst(now + self.window_seconds, now + self.max_wait_seconds, context)
+        burst.items.append(item)
+        task = asyncio.create_task(self._run(chat_id, burst))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, chat_id: int, burst: _Burst) -> None:
+        loop = asyncio.get_running_loop()
+        while not burst.flush_now.is_set() and (remaining := burst.deadline - loop.time()) > 0:
+            try:
+                await asyncio.wait_for(burst.flush_now.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock: # Messages keep joining this burst while the chat's previous burst finishes
+                if self._bursts.get(chat_id) is burst:
+                    del self._bursts[chat_id]
+                self.bursts += 1
+                if len(burst.items) > 1:
+                    logger.info("Coalesced %s messages from chat %s into one request.", len(burst.items), chat_id, extra=SAMPLED)
+                await self.process(burst.items, burst.context)
+        except Exception as e:
+            logger.error(f"Error processing coalesced messages of chat {chat_id}: {e}", exc_info=True)
+        finally:
+            if not lock.locked() and chat_id not in self._bursts:
+                self._chat_locks.pop(chat_id, None)
+
+    async def stop(self) -> None:
+        """Processes all open bursts right away and waits for them (used at shutdown)."""
+        for burst in self._bursts.values():
+            burst.flush_now.set()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"messages": self.messages, "bursts": self.bursts, "open_bursts": len(self._bursts)}
+
+
+class UserRateLimiter:
+    """
+    Allows each user `max_calls` calls per `period_seconds` (a token bucket per user, so a user
+    may burst up to max_calls and then gets one more call every period/max_calls seconds).
+    """
+
+    def __init__(self, max_calls: int = AI_USER_MAX_CALLS, period_seconds: float = AI_USER_PERIOD_SECONDS):
+        self.max_calls = max_calls
+        self.rate = max_calls / period_seconds if period_seconds > 0 else 0.0
+        self._buckets: Dict[int, TokenBucket] = {}
+        self.limited = 0
+
+    def check(self, user_id: int) -> float:
+        """Takes a call for user_id. Returns 0.0 if allowed, otherwise the seconds until the next allowed call."""
+        if self.max_calls <= 0 or self.rate <= 0: # Limit disabled
+            return 0.0
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) > 10000: # Forget users whose bucket has fully refilled
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.idle}
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, capacity=self.max_calls)
+        wait = bucket.try_take()
+        if wait > 0:
+            self.limited += 1
+        return wait
@@ -1,13 +1,29 @@
-import sqlite3
+import asyncio
 import json
-import datetime
-from typing import List, Optional, Dict, Any
+import os
+import time
+from typing import Awaitable, Callable, List, Optional, Dict, Any
 
 from google import genai
 from telegram import Poll
 
-from config import logger, GOOGLE_AI_TOKEN, CHANNEL_ID, DATABASE_NAME
-from prompt import get_ai_prompt
+from config import (
+    logger,
+    SAMPLED,
+    GOOGLE_AI_TOKEN,
+    CHANNEL_ID,
+    AI_MODEL_NAME,
+    AI_MAX_CONCURRENCY,
+    AI_TIMEOUT_SECONDS
+)
+from prompt import (
+    SYSTEM_INSTRUCTION,
+    BATCH_SYSTEM_INSTRUCTION,
+    get_ai_prompt,
+    get_batch_ai_prompt
+)
+from database import DatabaseManager # Re-exported, DatabaseManager used to live here
+from metrics import ai_tokens, record_error, stage_seconds, timed
 
 try:
     ai_model = genai.Client(api_key=GOOGLE_AI_TOKEN)
@@ -16,308 +32,404 @@ except Exception as e:
     logger.error(f"Failed to configure Google AI Client: {e}")
     ai_model = None
 
-
-class DatabaseManager:
-    def __init__(self, db_name: str = DATABASE_NAME):
-        self.db_name = db_name
-        self.conn = None
-        try:
-            self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-            logger.info(f"Successfully connected to database: {self.db_name}")
-            self._create_tables()
-        except sqlite3.Error as e:
-            logger.error(f"Error connecting to database {self.db_name}: {e}")
-            raise
-
-    def _create_tables(self):
-        if not self.conn:
-            logger.error("Cannot create tables: Database connection not established.")
-            return
-        try:
-            cursor = self.conn.cursor()
-            # 0 for False, 1 for True
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL UNIQUE,
-                username TEXT,
-                level TEXT CHECK(level IN ('A1', 'A2', 'B1', 'B2', 'C1', 'C2')),
-                daily_puzzle INTEGER DEFAULT 1,
-                timestamp DATETIME NOT NULL
-            )
-            ''')
-            self.conn.commit()
-            logger.info("Table 'users' checked/created successfully.")
-        except sqlite3.Error as e:
-            logger.error(f"Error creating table 'users': {e}")
-
-    def add_or_update_user(self,
-                           user_id: int,
-                           username: Optional[str] = None,
-                           level: Optional[str] = None,
-                           daily_puzzle: Optional[bool] = None
-                           ) -> bool:
-        if not self.conn:
-            logger.error("Cannot add/update user: Database connection not established.")
-            return False
-
-        current_timestamp = datetime.datetime.now()
-        cursor = self.conn.cursor()
-
-        try:
-            # Check if user exists
-            cursor.execute("SELECT id FROM users WHERE user_id = ?", (user_id,))
-            existing_user_row = cursor.fetchone()
-
-            if existing_user_row:  # User exists, update them
-                update_parts = []
-                params = []
-
-                if username is not None:
-                    update_parts.append("username = ?")
-                    params.append(username)
-                if level is not None:
-                    update_parts.append("level = ?")
-                    params.append(level)
-                if daily_puzzle is not None: # If a preference for daily_puzzle is explicitly passed
-                    update_parts.append("daily_puzzle = ?")
-                    params.append(1 if daily_puzzle else 0) # Convert boolean to 0 or 1
-                if not update_parts:
-                    cursor.execute("UPDATE users SET timestamp = ? WHERE user_id = ?",
-                                    (current_timestamp, user_id))
-                    logger.info(f"User {user_id} timestamp updated (no other fields provided for update).")
-                else:
-                    update_parts.append("timestamp = ?")
-                    params.append(current_timestamp)
-
-                    set_clause = ", ".join(update_parts)
-                    params.append(user_id)  # For the WHERE clause
-
-                    sql_update_query = f"UPDATE users SET {set_clause} WHERE user_id = ?"
-                    cursor.execute(sql_update_query, tuple(params))
-                    updated_fields_log = [part.split(' ')[0] for part in update_parts] # e.g., ['username', 'level', 'timestamp']
-                    logger.info(f"User {user_id} updated. Fields: {updated_fields_log}.")
-
-            else:  # New user, insert them
-                username_to_save = username
-
-                # 1 = True/ 0 = False
-                daily_puzzle_value_to_insert = 1 # Default to True for new users if not specified
-                if daily_puzzle is not None:
-                    daily_puzzle_value_to_insert = 1 if daily_puzzle else 0
-
-                # Note: The users table in _create_tables has daily_puzzle INTEGER DEFAULT 1
-                # So, if daily_puzzle_value_to_insert is not included in the INSERT statement and
-                # the daily_puzzle parameter was None, it would default to 1.
-                # To be explicit:
-                cursor.execute('''
-                    INSERT INTO users (user_id, username, level, timestamp, daily_puzzle)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, username_to_save, level, current_timestamp, daily_puzzle_value_to_insert))
-                logger.info(f"User {username_to_save} (ID: {user_id}) added with level {level}, daily_puzzle set to {bool(daily_puzzle_value_to_insert)}.")
-
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError as e:
-            logger.error(f"Integrity error for user {user_id} (Username: {username}): {e}. User might already exist or other constraint violation.")
-            return False
-        except sqlite3.Error as e:
-            logger.error(f"Database error for user {user_id} (Username: {username}): {e}")
-            return False
-
-    def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Retrieves all data for a user by their user_id."""
-        cursor = self.conn.cursor()
-        try:
-            # Ensure you select all columns you need, including the new one
-            cursor.execute("SELECT id, user_id, username, level, timestamp, daily_puzzle FROM users WHERE user_id = ?", (user_id,))
-            row = cursor.fetchone()
-            if row:
-                # Get column names from cursor.description
-                columns = [description[0] for description in cursor.description]
-                user_data = dict(zip(columns, row))
-
-                # Convert daily_puzzle from 0/1 to True/False for easier use in Python
-                if 'daily_puzzle' in user_data and user_data['daily_puzzle'] is not None:
-                    user_data['daily_puzzle'] = bool(user_data['daily_puzzle'])
-                else: # Handle case where it might be NULL if not properly defaulted or if schema was manually altered
-                    user_data['daily_puzzle'] = True # Default to True if NULL for some reason
-
-                logger.debug(f"User data found for user_id {user_id}: {user_data}")
-                return user_data
-            else:
-                logger.info(f"No user found with user_id {user_id}.")
-                return None
-        except sqlite3.Error as e:
-            logger.error(f"Error fetching user {user_id}: {e}")
-            return None
-
-    def get_users_with_daily_puzzle_enabled(self) -> List[Dict[str, Any]]:
-        """Retrieves all users who have the daily_puzzle preference set to True (1)."""
-        if not self.conn:
-            logger.error("Cannot get users with daily puzzle enabled: Database connection not established.")
-            return []
-
-        users_list = []
-        cursor = self.conn.cursor()
-        try:
-            # Select all columns for users where daily_puzzle is 1 (True)
-            cursor.execute("""
-                SELECT id, user_id, username, level, timestamp, daily_puzzle
-                FROM users
-                WHERE daily_puzzle = 1
-            """)
-            rows = cursor.fetchall()
-
-            if rows:
-                # Get column names from cursor.description
-                columns = [description[0] for description in cursor.description]
-                for row in rows:
-                    user_data = dict(zip(columns, row))
-
-                    # Convert daily_puzzle from 0/1 to True/False for easier use in Python
-                    if 'daily_puzzle' in user_data and user_data['daily_puzzle'] is not None:
-                        user_data['daily_puzzle'] = bool(user_data['daily_puzzle'])
-                    else:
-                        # This case should ideally not happen if the column has a DEFAULT
-                        # and is consistently set. Defaulting to True if somehow NULL.
-                        user_data['daily_puzzle'] = True
-
-                    users_list.append(user_data)
-                logger.debug(f"Found {len(users_list)} users with daily puzzle enabled.")
-            else:
-                logger.debug("No users found with daily puzzle enabled.")
-
-            return users_list
-        except sqlite3.Error as e:
-            logger.error(f"Error fetching users with daily puzzle enabled: {e}")
-            return [] # Return an empty list in case of an error
-
-    def get_all_user_ids(self) -> List[int]:
-        """Retrieves all user_ids from the database."""
-        if not self.conn:
-            logger.error("Cannot get all user IDs: Database connection not established.")
-            return []
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute("SELECT user_id FROM users")
-            user_ids = [row[0] for row in cursor.fetchall()]
-            logger.debug(f"Retrieved {len(user_ids)} user IDs.")
-            return user_ids
-        except sqlite3.Error as e:
-            logger.error(f"Error fetching all user IDs: {e}")
-            return []
-
-    def close_connection(self):
-        if self.conn:
-            try:
-                self.conn.close()
-                logger.info("Database connection closed.")
-            except sqlite3.Error as e:
-                logger.error(f"Error closing database connection: {e}")
-        else:
-            logger.info("No active database connection to close.")
-
-def read_puzzles_from_file(file_path='puzzles.json') -> Optional[Dict[str, Any]]:
-    """Reads one puzzle from puzzles.json and updates the file."""
+# Caps concurrent in-flight AI requests across all handlers
+_ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+
+class AIUsageStats:
+    """Running token counts and latency of AI calls, per kind of call (quiz, batch, puzzle_stock, ...)."""
+
+    FIELDS = ("calls", "prompt_tokens", "cached_tokens", "output_tokens", "total_tokens", "latency_ms")
+
+    def __init__(self):
+        self._totals: Dict[str, Dict[str, int]] = {}
+
+    def record(self, kind: str, response, latency: float) -> Dict[str, int]:
+        """Adds one call from the response's usage_metadata. Returns that call's counts."""
+        usage = getattr(response, 'usage_metadata', None)
+        call = {
+            "calls": 1,
+            "prompt_tokens": getattr(usage, 'prompt_token_count', None) or 0,
+            "cached_tokens": getattr(usage, 'cached_content_token_count', None) or 0,
+            "output_tokens": getattr(usage, 'candidates_token_count', None) or 0,
+            "total_tokens": getattr(usage, 'total_token_count', None) or 0,
+            "latency_ms": int(latency * 1000),
+        }
+        totals = self._totals.setdefault(kind, dict.fromkeys(self.FIELDS, 0))
+        for field in self.FIELDS:
+            totals[field] += call[field]
+        stage_seconds.observe(latency, stage="ai", operation=kind)
+        for token_type in ("prompt", "cached", "output"):
+            ai_tokens.inc(call[f"{token_type}_tokens"], kind=kind, type=token_type)
+        logger.info("AI call (%s): %s prompt tokens (%s cached), %s output tokens, %s ms.", kind, call['prompt_tokens'],
+                    call['cached_tokens'], call['output_tokens'], call['latency_ms'], extra=SAMPLED)
+        return call
+
+    def totals(self, kind: Optional[str] = None) -> Dict[str, int]:
+        """Totals of one kind of call, or of all calls."""
+        if kind is not None:
+            return dict(self._totals.get(kind) or dict.fromkeys(self.FIELDS, 0))
+        combined = dict.fromkeys(self.FIELDS, 0)
+        for totals in self._totals.values():
+            for field in self.FIELDS:
+                combined[field] += totals[field]
+        return combined
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {kind: dict(totals) for kind, totals in self._totals.items()}
+
+
+ai_usage = AIUsageStats()
+
+
+def load_puzzles_from_file(file_path='puzzles.json') -> List[Dict[str, Any]]:
+    """Reads the 'quiz' items of a puzzles.json file (without modifying it)."""
     try:
-        with open(file_path, 'r+', encoding='utf-8') as file:
+        with open(file_path, 'r', encoding='utf-8') as file:
             content = file.read()
             if not content:
                 logger.warning(f"Puzzle file {file_path} is empty.")
-                return None
+                return []
             quiz_data = json.loads(content)
 
             if not quiz_data.get('quiz'):
                 logger.warning(f"No 'quiz' array found in {file_path} or it's empty.")
-                return None
-
-            # Get last 3 quizzes and delete them
-            puzzle = quiz_data['quiz'][0:3] 
-            del quiz_data['quiz'][0:3]
-
-            file.seek(0) # Go to the beginning of the file
-            json.dump(quiz_data, file, indent=4) # Write the updated data back
-            file.truncate() # Remove any leftover old content
-            logger.debug(f"Read and removed one puzzle from {file_path}.")
-            return puzzle
+                return []
+            return quiz_data['quiz']
     except FileNotFoundError:
-        logger.error(f"Puzzle file {file_path} not found.")
-        return None
+        logger.debug(f"Puzzle file {file_path} not found.")
+        return []
     except json.JSONDecodeError as e:
         logger.error(f"Error decoding JSON from {file_path}: {e}")
-        return None
+        return []
     except Exception as e:
         logger.error(f"An unexpected error occurred while reading puzzles from {file_path}: {e}")
-        return None
-
-async def send_poll_to_user_and_channel(context, user_chat_id, question, options, correct_option_id, explanation):
-    """Sends a poll to a user and optionally to a channel."""
+        return []
+
+
+async def import_puzzles_from_file(db_manager, file_path='puzzles.json') -> int:
+    """One-time import of a puzzles.json file into the puzzle bank. Re-running it for the same file is a no-op."""
+    puzzles = await asyncio.to_thread(load_puzzles_from_file, file_path)
+    if not puzzles:
+        return 0
+    imported = await db_manager.import_puzzles(puzzles, source=os.path.abspath(file_path))
+    if imported:
+        logger.info(f"Imported {imported} puzzles from {file_path} into the puzzle bank.")
+    return imported
+
+async def send_quiz_poll(bot, chat_id, question, options, correct_option_id, explanation, is_anonymous=False):
+    """Sends a single quiz poll. Unlike send_poll_to_user_and_channel, errors are raised to the caller."""
+    return await bot.send_poll(
+        chat_id=chat_id,
+        question=question,
+        options=options,
+        type=Poll.QUIZ,
+        correct_option_id=correct_option_id,
+        is_anonymous=is_anonymous,
+        explanation=explanation
+    )
+
+
+async def send_poll_to_user_and_channel(context, user_chat_id, question, options, correct_option_id, explanation,
+                                        channel_publisher=None, outbox=None, idempotency_key=None):
+    """
+    Sends a poll to a user and optionally to a channel.
+    With an outbox the user's poll is queued there (durable, retried) instead of sent inline;
+    with a channel_publisher the channel copy is queued (and deduplicated) as well.
+    """
     try:
-        await context.bot.send_poll(
-            chat_id=user_chat_id,
-            question=question,
-            options=options,
-            type=Poll.QUIZ,
-            correct_option_id=correct_option_id,
-            is_anonymous=False, # User polls are not anonymous to track progress (if needed)
-            explanation=explanation
-        )
-        logger.info(f"Sent poll to user {user_chat_id}.")
-
-        if CHANNEL_ID: # Only send to channel if CHANNEL_ID is set
-            await context.bot.send_poll(
-                chat_id=str(CHANNEL_ID),
-                question=question,
-                options=options,
-                type=Poll.QUIZ,
-                correct_option_id=correct_option_id,
-                is_anonymous=True, # Channel polls are anonymous
-                explanation=explanation
-            )
-            logger.info(f"Sent poll to channel {CHANNEL_ID}.")
-        else:
-            logger.debug("CHANNEL_ID not set, skipping poll to channel.")
+        with timed("send", "poll_to_user_and_channel"):
+            # User polls are not anonymous to track progress (if needed)
+            if outbox is not None:
+                await outbox.send_poll(user_chat_id, question, options, correct_option_id, explanation, idempotency_key=idempotency_key)
+                logger.info("Queued poll for user %s.", user_chat_id, extra=SAMPLED)
+            else:
+                await send_quiz_poll(context.bot, user_chat_id, question, options, correct_option_id, explanation)
+                logger.info("Sent poll to user %s.", user_chat_id, extra=SAMPLED)
+
+            if channel_publisher is not None:
+                await channel_publisher.publish(question, options, correct_option_id, explanation)
+            elif CHANNEL_ID: # Only send to channel if CHANNEL_ID is set
+                # Channel polls are anonymous
+                await send_quiz_poll(context.bot, CHANNEL_ID, question, options, correct_option_id, explanation, is_anonymous=True)
+                logger.info("Sent poll to channel %s.", CHANNEL_ID, extra=SAMPLED)
+            else:
+                logger.debug("CHANNEL_ID not set, skipping poll to channel.")
 
     except Exception as e:
         logger.error(f"Error sending poll: {e}", exc_info=True)
 
 
+class QuizStreamParser:
+    """
+    Incremental parser for the AI's JSON reply. feed() takes text chunks as they stream in and returns
+    every element of the top-level `quiz` array as soon as its closing brace has arrived.
+    The complete text (for `notes`) is parsed once the stream ends, by result().
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_key = None
+        self._in_quiz = False
+        self._item_start = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.text += chunk
+        items = []
+        text = self.text
+        for position in range(self._position, len(text)):
+            char = text[position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1: # Strings directly in the top-level object: keys (or plain values)
+                        self._last_key = text[self._string_start + 1:position]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = position
+            elif char in '{[':
+                if char == '[' and self._depth == 1 and self._last_key == 'quiz':
+                    self._in_quiz = True
+                elif char == '{' and self._depth == 2 and self._in_quiz:
+                    self._item_start = position
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if char == '}' and self._depth == 2 and self._in_quiz and self._item_start is not None:
+                    try:
+                        items.append(json.loads(text[self._item_start:position + 1]))
+                    except json.JSONDecodeError as e:
+                        logger.warning(f"Skipping unparsable streamed quiz item: {e}")
+                    self._item_start = None
+                elif self._depth == 1:
+                    self._in_quiz = False
+        self._position = len(text)
+        return items
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        """The complete reply, or None if it is not valid JSON."""
+        try:
+            return json.loads(self.text)
+        except json.JSONDecodeError as e:
+            logger.error(f"AI JSON decoding error: {e}. Raw response: {self.text[:1000]}")
+            return None
+
+
+def _parse_ai_response(response) -> Dict[str, Any]:
+    """Turns a raw generate_content response into the quiz dict used by the handlers."""
+    if response.prompt_feedback and response.prompt_feedback.block_reason:
+        logger.error(f"AI content generation blocked. Reason: {response.prompt_feedback.block_reason_message}")
+        return {"quiz": [], "notes": {"message": "Sorry, I couldn't process that request due to content restrictions. 😔"}}
+
+    if not response.text:
+        logger.error("AI response structure not recognized or empty.")
+        return {"quiz": [], "notes": {"message": "Received an unexpected response from the AI. 😕"}}
+    response_text = response.text
+
+    logger.debug("Raw AI response text: %.100s...", response_text) # Log beginning of response
+    try:
+        quiz_data = json.loads(response_text)
+    except json.JSONDecodeError as e:
+        logger.error(f"AI JSON decoding error: {e}. Raw response: {response_text[:1000]}", exc_info=True)
+        return {"quiz": [], "notes": {"message": "I had a little trouble understanding the AI's reply. Please try again! 🛠️"}}
+    logger.info("Successfully generated and parsed quiz from AI.", extra=SAMPLED)
+    return quiz_data
+
+
 def get_quiz_from_ai(input_phrases: str, user_level: Optional[str] = "B1-B2") -> Optional[Dict[str, Any]]:
     """
     Generates a quiz using Google AI based on input phrases and user level.
+    Blocking; async handlers should use get_quiz_from_ai_async instead.
     """
     if not ai_model:
         logger.error("AI model not initialized. Cannot generate quiz.")
         return {"quiz": [], "notes": {"message": "AI service is currently unavailable. 😥"}}
 
     prompt = get_ai_prompt(user_level, input_phrases)
-    
+
     try:
-        logger.debug(f"Sending prompt to AI for phrases: {input_phrases}")
+        logger.debug("Sending prompt to AI for phrases: %s", input_phrases)
         # The new API uses generate_content
+        started = time.monotonic()
         response = ai_model.models.generate_content(
-            model="gemini-2.0-flash",
+            model=AI_MODEL_NAME,
             contents=prompt,
-            config={"response_mime_type": "application/json"},
+            config=_ai_config(SYSTEM_INSTRUCTION),
         )
-        if response.prompt_feedback and response.prompt_feedback.block_reason:
-            logger.error(f"AI content generation blocked. Reason: {response.prompt_feedback.block_reason_message}")
-            return {"quiz": [], "notes": {"message": "Sorry, I couldn't process that request due to content restrictions. 😔"}}
+        ai_usage.record("quiz", response, time.monotonic() - started)
+        return _parse_ai_response(response)
+    except Exception as e:
+        record_error("ai", "quiz", e)
+        logger.error(f"Error getting quiz from AI: {e}", exc_info=True)
+        return {"quiz": [], "notes": {"message": "Something went wrong while talking to the AI. Please try again later. 🤖"}}
 
-        if not response.text:
-            logger.error("AI response structure not recognized or empty.")
-            return {"quiz": [], "notes": {"message": "Received an unexpected response from the AI. 😕"}}
-        response_text = response.text
 
+async def get_quiz_from_ai_async(input_phrases: str, user_level: Optional[str] = "B1-B2") -> Optional[Dict[str, Any]]:
+    """
+    Async variant of get_quiz_from_ai built on the client's aio surface.
+    See generate_ai_json_async for the concurrency, timeout and cancellation behaviour.
+    """
+    logger.debug("Sending async prompt to AI for phrases: %s", input_phrases)
+    return await generate_ai_json_async(get_ai_prompt(user_level, input_phrases))
 
-        logger.debug(f"Raw AI response text: {response_text[:100]}...") # Log beginning of response
-        quiz_data = json.loads(response_text)
-        logger.info("Successfully generated and parsed quiz from AI.")
-        return quiz_data
-    except json.JSONDecodeError as e:
-        logger.error(f"AI JSON decoding error: {e}. Raw response: {response_text[:1000]}", exc_info=True)
-        return {"quiz": [], "notes": {"message": "I had a little trouble understanding the AI's reply. Please try again! 🛠️"}}
+
+async def get_batch_quiz_from_ai_async(sections: List[str], user_level: Optional[str] = "B1-B2") -> List[Dict[str, Any]]:
+    """
+    Generates quizzes for several independent inputs of the same level in one AI call.
+    Returns one quiz dict per section, in order. Sections missing from the AI reply get an empty quiz;
+    a reply without per-section results (one combined quiz) is discarded and each section asked for alone.
+    """
+    batch_response = await generate_ai_json_async(get_batch_ai_prompt(user_level, sections),
+                                                  system_instruction=BATCH_SYSTEM_INSTRUCTION,
+                                                  kind="batch")
+    if 'results' not in batch_response:
+        if _is_error_reply(batch_response): # Hand the error to every section
+            return [batch_response for _ in sections]
+        # A single combined quiz mixes everyone's notes; ask for each section on its own instead
+        logger.warning(f"Batch AI reply had no per-section results, retrying {len(sections)} sections one by one.")
+        return list(await asyncio.gather(*(get_quiz_from_ai_async(section, user_level) for section in sections)))
+
+    results_by_section = {}
+    for position, result in enumerate(batch_response.get('results') or [], start=1):
+        if isinstance(result, dict):
+            try:
+                section = int(result.get('section', position)) # The model often answers "1" instead of 1
+            except (TypeError, ValueError):
+                section = position
+            results_by_section[section] = result
+
+    missing_message = {"quiz": [], "notes": {"message": "I had a little trouble understanding the AI's reply. Please try again! 🛠️"}}
+    return [
+        {"quiz": results_by_section[number].get('quiz') or [], "notes": results_by_section[number].get('notes') or {}}
+        if number in results_by_section else missing_message
+        for number in range(1, len(sections) + 1)
+    ]
+
+
+def _is_error_reply(response: Dict[str, Any]) -> bool:
+    """True for the replies the AI helpers return on failure: no quiz, and notes with only a message."""
+    notes = response.get('notes')
+    return response.get('quiz') == [] and isinstance(notes, dict) and set(notes) == {'message'}
+
+
+async def stream_quiz_from_ai_async(input_phrases: str,
+                                    user_level: Optional[str],
+                                    on_item: Callable[[Dict[str, Any]], Awaitable[None]]
+                                    ) -> Dict[str, Any]:
+    """
+    Streaming variant of get_quiz_from_ai_async: `on_item` is awaited for every quiz item as soon as it
+    has been generated. Returns the complete reply, whose `quiz` holds exactly the items passed to on_item.
+    """
+    logger.debug("Streaming prompt to AI for phrases: %s", input_phrases)
+    return await stream_ai_json_async(get_ai_prompt(user_level, input_phrases), on_item)
+
+
+def _ai_config(system_instruction: str) -> Dict[str, Any]:
+    return {"system_instruction": system_instruction, "response_mime_type": "application/json"}
+
+
+async def generate_ai_json_async(prompt: str,
+                                 system_instruction: str = SYSTEM_INSTRUCTION,
+                                 kind: str = "quiz"
+                                 ) -> Dict[str, Any]:
+    """
+    Sends a prompt (the per-request payload) with a static system instruction to the AI and returns
+    the parsed JSON reply (or a quiz-shaped error dict). Token usage is recorded in ai_usage under `kind`.
+    At most AI_MAX_CONCURRENCY calls are in flight at once; each call is bounded by
+    AI_TIMEOUT_SECONDS (time spent waiting for a free slot is not counted).
+    Cancelling the calling task cancels the underlying request.
+    """
+    if not ai_model:
+        logger.error("AI model not initialized. Cannot generate quiz.")
+        return {"quiz": [], "notes": {"message": "AI service is currently unavailable. 😥"}}
+
+    try:
+        async with _ai_semaphore:
+            started = time.monotonic()
+            response = await asyncio.wait_for(
+                ai_model.aio.models.generate_content(
+                    model=AI_MODEL_NAME,
+                    contents=prompt,
+                    config=_ai_config(system_instruction),
+                ),
+                timeout=AI_TIMEOUT_SECONDS
+            )
+        ai_usage.record(kind, response, time.monotonic() - started)
+        return _parse_ai_response(response)
+    except asyncio.TimeoutError as e:
+        record_error("ai", kind, e)
+        logger.error(f"AI request timed out after {AI_TIMEOUT_SECONDS}s.")
+        return {"quiz": [], "notes": {"message": "The AI is taking too long right now. Please try again in a moment. ⏳"}}
     except Exception as e:
+        record_error("ai", kind, e)
         logger.error(f"Error getting quiz from AI: {e}", exc_info=True)
-        return {"quiz": [], "notes": {"message": "Something went wrong while talking to the AI. Please try again later. 🤖"}}
\ No newline at end of file
+        return {"quiz": [], "notes": {"message": "Something went wrong while talking to the AI. Please try again later. 🤖"}}
+
+
+async def stream_ai_json_async(prompt: str,
+                               on_item: Callable[[Dict[str, Any]], Awaitable[None]],
+                               system_instruction: str = SYSTEM_INSTRUCTION,
+                               kind: str = "quiz_stream"
+                               ) -> Dict[str, Any]:
+    """
+    Like generate_ai_json_async, but consumes generate_content_stream and awaits `on_item` for each
+    `quiz` element as soon as it is complete. If the stream fails part-way, the items already
+    delivered are returned with an error note. AI_TIMEOUT_SECONDS bounds the whole stream.
+    """
+    if not ai_model:
+        logger.error("AI model not initialized. Cannot generate quiz.")
+        return {"quiz": [], "notes": {"message": "AI service is currently unavailable. 😥"}}
+
+    parser = QuizStreamParser()
+    delivered: List[Dict[str, Any]] = []
+    last_chunk = None
+
+    async def consume() -> None:
+        nonlocal last_chunk
+        stream = await ai_model.aio.models.generate_content_stream(
+            model=AI_MODEL_NAME,
+            contents=prompt,
+            config=_ai_config(system_instruction),
+        )
+        async for chunk in stream:
+            last_chunk = chunk
+            if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                raise ValueError(f"AI content generation blocked. Reason: {chunk.prompt_feedback.block_reason_message}")
+            for item in parser.feed(chunk.text or ""):
+                delivered.append(item)
+                if len(delivered) == 1:
+                    stage_seconds.observe(time.monotonic() - started, stage="ai", operation=f"{kind}_first_item")
+                    logger.debug(f"First streamed quiz item after {int((time.monotonic() - started) * 1000)} ms.")
+                await on_item(item)
+
+    try:
+        async with _ai_semaphore:
+            started = time.monotonic()
+            await asyncio.wait_for(consume(), timeout=AI_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError as e:
+        record_error("ai", kind, e)
+        logger.error(f"AI stream timed out after {AI_TIMEOUT_SECONDS}s ({len(delivered)} items delivered).")
+        return {"quiz": delivered, "notes": {"message": "The AI is taking too long right now. Please try again in a moment. ⏳"}}
+    except Exception as e:
+        record_error("ai", kind, e)
+        logger.error(f"Error streaming quiz from AI ({len(delivered)} items delivered): {e}", exc_info=True)
+        return {"quiz": delivered, "notes": {"message": "Something went wrong while talking to the AI. Please try again later. 🤖"}}
+    finally:
+        if last_chunk is not None:
+            ai_usage.record(kind, last_chunk, time.monotonic() - started) # Usage totals arrive with the last chunk
+
+    quiz_data = parser.result()
+    if not isinstance(quiz_data, dict):
+        return {"quiz": delivered, "notes": {} if delivered else {"message": "I had a little trouble understanding the AI's reply. Please try again! 🛠️"}}
+    logger.info("Successfully streamed quiz from AI (%s items).", len(delivered), extra=SAMPLED)
+    quiz_data['quiz'] = delivered
+    return quiz_data